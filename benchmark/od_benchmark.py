@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+
+"""
+End-to-end sync benchmark of onedrive-d against the mock server.
+
+A synthetic tree is put on the mock drive (download) or in the local repo
+(upload). The daemon's workers, started the way Monitor starts them, then
+sync the repo from a recursive 'sy' task, and the benchmark reports how long
+the task queue took to drain (time to converge), files/s and MB/s. A full and
+an incremental scan of the synced tree then measure the cost of deep scans
+that find nothing to do.
+
+Everything runs in a temporary dir: onedrive-d must be installed (~/.onedrive
+exists), but its config and entry database are not touched.
+
+Example: python3 -m benchmark.od_benchmark --scenario download --files 2000 --latency 0.02
+"""
+
+import os
+import sys
+import time
+import atexit
+import logging
+import argparse
+import tempfile
+from onedrive_d import od_glob
+from . import od_mock_server
+
+
+def make_local_tree(root_path, num_dirs, num_files, file_size, fanout=8):
+	folders = [root_path]
+	for i in range(num_dirs):
+		path = folders[i // fanout] + '/dir{}'.format(i)
+		os.mkdir(path)
+		folders.append(path)
+	block = os.urandom(min(file_size, 65536) or 1)
+	content = (block * (file_size // len(block) + 1))[:file_size]
+	for i in range(num_files):
+		with open(folders[i % len(folders)] + '/file{}.bin'.format(i), 'wb') as f:
+			f.write(content)
+
+
+def get_local_stats(root_path):
+	ret = {'folders': 0, 'files': 0, 'bytes': 0}
+	for dir_path, dir_names, file_names in os.walk(root_path):
+		ret['folders'] += len(dir_names)
+		for name in file_names:
+			ret['files'] += 1
+			ret['bytes'] += os.path.getsize(os.path.join(dir_path, name))
+	return ret
+
+
+def wait_for_convergence(taskmgr, poll_interval=0.02):
+	"""
+	Return when there is no task added or being handled.
+	"""
+	while taskmgr.count_tasks() > 0:
+		time.sleep(poll_interval)
+
+
+def run_scan(mon, args='recursive,'):
+	start_time = time.monotonic()
+	mon.taskmgr.add_task('sy', local_path=mon.config.params['ONEDRIVE_ROOT_PATH'],
+		remote_id=mon.root_entry_id, args=args)
+	wait_for_convergence(mon.taskmgr)
+	return time.monotonic() - start_time
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark onedrive-d against a mock OneDrive server.')
+	parser.add_argument('--scenario', choices=['download', 'upload'], default='download')
+	parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread', help='TRANSFER_ENGINE to use')
+	parser.add_argument('--workers', type=int, default=4, help='NUM_OF_WORKERS')
+	parser.add_argument('--max-workers', type=int, default=16, help='MAX_NUM_OF_WORKERS')
+	parser.add_argument('--dirs', type=int, default=20, help='number of folders in the tree')
+	parser.add_argument('--files', type=int, default=500, help='number of small files in the tree')
+	parser.add_argument('--file-size', type=int, default=16384, help='size of each small file in bytes')
+	parser.add_argument('--large-files', type=int, default=0, help='number of files transferred by blocks')
+	parser.add_argument('--large-file-size', type=int, default=8 << 20, help='size of each large file in bytes')
+	parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+	parser.add_argument('--bandwidth', type=float, default=0, help='bytes per second per connection; 0 for no limit')
+	parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failing with HTTP 500')
+	parser.add_argument('--throttle-rate', type=float, default=0, help='fraction of requests throttled with HTTP 429')
+	parser.add_argument('--upload-limit', type=int, default=0, help='UPLOAD_LIMIT in bytes per second')
+	parser.add_argument('--download-limit', type=int, default=0, help='DOWNLOAD_LIMIT in bytes per second')
+	parser.add_argument('--verbose', action='store_true', help='print the log of onedrive-d')
+	args = parser.parse_args()
+
+	work_dir = tempfile.TemporaryDirectory(prefix='od_benchmark_')
+	local_root = work_dir.name + '/OneDrive'
+	os.mkdir(local_root)
+
+	# redirect config and databases before any module opens them
+	config = od_glob.get_config_instance(setup_mode=True)
+	od_glob.ConfigSet.APP_CONF_PATH = work_dir.name
+	od_glob.ConfigSet.APP_CONF_FILE = work_dir.name + '/config_v2.json'
+	config.ignore_list = None
+	config.params['ONEDRIVE_ROOT_PATH'] = local_root
+	config.params['NUM_OF_WORKERS'] = args.workers
+	config.params['MAX_NUM_OF_WORKERS'] = args.max_workers
+	config.params['TRANSFER_ENGINE'] = args.engine
+	config.params['UPLOAD_LIMIT'] = args.upload_limit
+	config.params['DOWNLOAD_LIMIT'] = args.download_limit
+	# a failing mock should fail fast rather than hold the benchmark for an hour
+	config.params['API_CALL_DEADLINE'] = 120
+	if not args.verbose:
+		od_glob.get_logger().setLevel(logging.WARNING)
+
+	from onedrive_d import od_onedrive_api
+	from onedrive_d import od_mon_cli
+	if args.engine == 'asyncio':
+		# loaded before patch_api() so that it is pointed at the mock too
+		from onedrive_d import od_async_api
+
+	server = od_mock_server.MockServer(latency=args.latency, bandwidth=args.bandwidth,
+		error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+	if args.scenario == 'download':
+		server.drive.make_tree(args.dirs, args.files, args.file_size)
+		if args.large_files > 0:
+			server.drive.make_tree(0, args.large_files, args.large_file_size, prefix='large')
+	else:
+		make_local_tree(local_root, args.dirs, args.files, args.file_size)
+		for i in range(args.large_files):
+			with open(local_root + '/large{}.bin'.format(i), 'wb') as f:
+				f.write(os.urandom(args.large_file_size))
+	server.start()
+	api = od_onedrive_api.get_instance()
+	server.patch_api(api)
+
+	mon = od_mon_cli.Monitor()
+	atexit.unregister(mon.cleanup)
+	mon.root_entry_id = server.drive.root_id
+	mon.create_workers()
+
+	print('scenario: {}, engine: {}, workers: {}-{}, latency: {}s, bandwidth: {} B/s, error rate: {}, throttle rate: {}'.format(
+		args.scenario, args.engine, args.workers, args.max_workers, args.latency, args.bandwidth or 'unlimited', args.error_rate, args.throttle_rate))
+	converge_time = run_scan(mon)
+	rescan_time = run_scan(mon)
+	num_requests = server.stats.get('requests', 0)
+	incremental_rescan_time = run_scan(mon, 'recursive,incremental,')
+	num_incremental_requests = server.stats.get('requests', 0) - num_requests
+	server_stats = dict(server.stats)
+
+	local_stats = get_local_stats(local_root)
+	remote_stats = server.drive.get_stats()
+	if args.scenario == 'download':
+		stats = local_stats
+	else:
+		stats = remote_stats
+	is_converged = local_stats['files'] == remote_stats['files'] and local_stats['bytes'] == remote_stats['bytes']
+
+	print('files: {}, folders: {}, bytes: {}'.format(stats['files'], stats['folders'], stats['bytes']))
+	print('time to converge: {:.2f} s'.format(converge_time))
+	print('throughput: {:.1f} files/s, {:.2f} MB/s'.format(
+		stats['files'] / converge_time, stats['bytes'] / converge_time / 1000000))
+	print('rescan without changes: {:.2f} s'.format(rescan_time))
+	print('incremental rescan without changes: {:.2f} s, {} requests'.format(incremental_rescan_time, num_incremental_requests))
+	print('requests: {}, injected errors: {}, injected throttles: {}'.format(
+		server_stats.get('requests', 0), server_stats.get('injected_errors', 0), server_stats.get('injected_throttles', 0)))
+	print('connections: {}'.format(api.get_connection_stats()))
+	print('local and remote trees match: {}'.format(is_converged))
+
+	mon.cleanup()
+	server.shutdown()
+	work_dir.cleanup()
+	if not is_converged:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
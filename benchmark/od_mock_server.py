@@ -0,0 +1,466 @@
+#!/usr/bin/python3
+
+"""
+A local stand-in for the Live API v5.0 endpoints used by onedrive_d.
+
+It keeps a drive in memory and answers the requests OneDriveAPI sends:
+entry properties, folder listings (with limit / offset), content (with
+Range), PUT uploads, BITS Create-Session / Fragment / Close-Session, mkdir,
+MOVE / COPY, DELETE and token refresh. Point OneDriveAPI at it with
+MockServer.patch_api().
+
+Latency, bandwidth and error rates can be injected to see how the client
+behaves on a slow or failing service.
+
+Run alone: python3 -m benchmark.od_mock_server --port 8080
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import collections
+import http.server
+import urllib.parse
+from datetime import datetime, timezone
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+
+def time_to_str(t=None):
+	if t is None:
+		t = datetime.now(timezone.utc)
+	return t.strftime(DATETIME_FORMAT)
+
+
+class MockDrive:
+
+	"""
+	The entries of one user's drive. Ids look like the real ones, e.g.,
+	'folder.<cid>' for the root and 'file.<cid>.<cid>!<n>' for the others,
+	so that OneDriveAPI derives the same BITS URLs from them.
+	"""
+
+	def __init__(self, user_id='a1b2c3d4e5f60789'):
+		self.user_id = user_id
+		self.root_id = 'folder.' + user_id
+		self.lock = threading.Lock()
+		self.next_num = 100
+		self.entries = {}
+		# parent id -> {name: id}
+		self.children = {}
+		self.contents = {}
+		self.bits_sessions = {}
+		self.entries[self.root_id] = self.new_entry('folder', 'SkyDrive', None, self.root_id)
+		self.children[self.root_id] = collections.OrderedDict()
+
+	def new_entry(self, type, name, parent_id, entry_id=None, size=0, client_updated_time=None):
+		now = time_to_str()
+		if entry_id is None:
+			self.next_num += 1
+			entry_id = '{}.{}.{}!{}'.format(type, self.user_id, self.user_id, self.next_num)
+		return {
+			'id': entry_id,
+			'name': name,
+			'type': type,
+			'parent_id': parent_id,
+			'size': size,
+			'created_time': now,
+			'updated_time': now,
+			'client_updated_time': client_updated_time or now
+		}
+
+	def resolve_id(self, entry_id):
+		if entry_id == 'me/skydrive':
+			return self.root_id
+		return entry_id
+
+	def touch(self, folder_id):
+		if folder_id in self.entries:
+			self.entries[folder_id]['updated_time'] = time_to_str()
+
+	def add_entry(self, type, name, parent_id, content=None, client_updated_time=None):
+		"""
+		Add an entry, replacing the entry of the same name in the folder.
+		Caller must hold the lock.
+		"""
+		old_id = self.children[parent_id].get(name)
+		if old_id is not None:
+			self.remove_entry(old_id)
+		entry = self.new_entry(type, name, parent_id, size=len(content or b''),
+			client_updated_time=client_updated_time)
+		self.entries[entry['id']] = entry
+		self.children[parent_id][name] = entry['id']
+		if type == 'folder':
+			self.children[entry['id']] = collections.OrderedDict()
+		else:
+			self.contents[entry['id']] = bytes(content or b'')
+		self.touch(parent_id)
+		return entry
+
+	def remove_entry(self, entry_id):
+		"""
+		Caller must hold the lock.
+		"""
+		entry = self.entries.pop(entry_id)
+		for child_id in list(self.children.get(entry_id, {}).values()):
+			self.remove_entry(child_id)
+		self.children.pop(entry_id, None)
+		self.contents.pop(entry_id, None)
+		if entry['parent_id'] is not None:
+			self.children[entry['parent_id']].pop(entry['name'], None)
+			self.touch(entry['parent_id'])
+
+	def copy_entry(self, entry_id, parent_id):
+		"""
+		Caller must hold the lock.
+		"""
+		entry = self.entries[entry_id]
+		ret = self.add_entry(entry['type'], entry['name'], parent_id, self.contents.get(entry_id),
+			entry['client_updated_time'])
+		for child_id in list(self.children.get(entry_id, {}).values()):
+			self.copy_entry(child_id, ret['id'])
+		return ret
+
+	def make_tree(self, num_dirs, num_files, file_size, parent_id=None, fanout=8, prefix=''):
+		"""
+		Fill the drive with num_files files of file_size random-ish bytes,
+		spread over num_dirs folders nested fanout per level.
+
+		@param prefix: prepended to the names of the new entries.
+		"""
+		with self.lock:
+			if parent_id is None:
+				parent_id = self.root_id
+			folders = [parent_id]
+			for i in range(num_dirs):
+				parent = folders[i // fanout]
+				folders.append(self.add_entry('folder', prefix + 'dir{}'.format(i), parent)['id'])
+			block = os.urandom(min(file_size, 65536) or 1)
+			for i in range(num_files):
+				content = (block * (file_size // len(block) + 1))[:file_size]
+				self.add_entry('file', prefix + 'file{}.bin'.format(i), folders[i % len(folders)], content)
+
+	def get_stats(self):
+		with self.lock:
+			files = [e for e in self.entries.values() if e['type'] == 'file']
+			return {
+				# not counting the root
+				'folders': len(self.entries) - len(files) - 1,
+				'files': len(files),
+				'bytes': sum(e['size'] for e in files)
+			}
+
+
+class MockRequestHandler(http.server.BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+	CHUNK_SIZE = 65536
+
+	def log_message(self, format, *args):
+		pass
+
+	@property
+	def drive(self):
+		return self.server.drive
+
+	def get_path(self):
+		"""
+		Return the request path relative to the server root, without the query.
+		"""
+		return urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/')
+
+	def get_query(self):
+		return dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+
+	def read_body(self):
+		n = int(self.headers.get('Content-Length', 0))
+		data = self.rfile.read(n)
+		self.server.throttle(len(data))
+		self.server.count('bytes_in', len(data))
+		return data
+
+	def send(self, status, body=b'', headers=None):
+		if isinstance(body, (dict, list)):
+			body = json.dumps(body).encode()
+			headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+		self.send_response(status)
+		for key, value in (headers or {}).items():
+			self.send_header(key, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		for i in range(0, len(body), self.CHUNK_SIZE):
+			chunk = body[i:i + self.CHUNK_SIZE]
+			self.wfile.write(chunk)
+			self.server.throttle(len(chunk))
+		self.server.count('bytes_out', len(body))
+
+	def error_body(self, status, code, message=''):
+		return status, {'error': {'code': code, 'message': message}}
+
+	def inject_fault(self):
+		"""
+		Sleep for the latency and maybe answer with an injected error.
+		Return True if the request is answered.
+		"""
+		self.server.count('requests')
+		if self.server.latency > 0:
+			time.sleep(self.server.latency)
+		if random.random() < self.server.error_rate:
+			self.server.count('injected_errors')
+			self.read_body()
+			self.send(*self.error_body(500, 'server_internal_error', 'injected error'))
+			return True
+		if random.random() < self.server.throttle_rate:
+			self.server.count('injected_throttles')
+			self.read_body()
+			self.send(429, {'error': {'code': 'request_throttled', 'message': 'injected throttle'}},
+				{'Retry-After': str(self.server.retry_after)})
+			return True
+		return False
+
+	def do_GET(self):
+		if self.inject_fault():
+			return
+		self.send(*self.answer_get(self.get_path()))
+
+	def answer_get(self, path):
+		"""
+		Return the (status, body, headers) of a GET request. Responses are built
+		while holding the drive lock and sent after releasing it.
+		"""
+		with self.drive.lock:
+			if path == 'me':
+				return 200, {'id': self.drive.user_id, 'name': 'Mock User'}
+			if path == 'me/skydrive/quota':
+				used = sum(len(c) for c in self.drive.contents.values())
+				return 200, {'quota': 1 << 40, 'available': (1 << 40) - used}
+			m = re.match(r'^(.+)/(files|content)$', path)
+			entry_id = self.drive.resolve_id(m.group(1) if m else path)
+			if entry_id not in self.drive.entries:
+				return self.error_body(404, 'resource_not_found', entry_id)
+			if m is None:
+				return 200, dict(self.drive.entries[entry_id])
+			if m.group(2) == 'files':
+				children = [dict(self.drive.entries[i]) for i in self.drive.children.get(entry_id, {}).values()]
+				query = self.get_query()
+				offset = int(query.get('offset', 0))
+				if 'limit' in query:
+					children = children[offset:offset + int(query['limit'])]
+				return 200, {'data': children}
+			content = self.drive.contents.get(entry_id)
+		if content is None:
+			return self.error_body(400, 'request_url_invalid', 'not a file')
+		rng = self.headers.get('Range')
+		if rng is None:
+			return 200, content
+		range_from, range_to = rng.split('=')[1].split('-')
+		range_from = int(range_from)
+		range_to = min(int(range_to) if range_to else len(content) - 1, len(content) - 1)
+		return 206, content[range_from:range_to + 1], \
+			{'Content-Range': 'bytes {}-{}/{}'.format(range_from, range_to, len(content))}
+
+	def do_PUT(self):
+		if self.inject_fault():
+			return
+		self.send(*self.answer_put(self.get_path(), self.read_body()))
+
+	def answer_put(self, path, data):
+		m = re.match(r'^(.+)/files/([^/]+)$', path)
+		with self.drive.lock:
+			if m is not None:
+				folder_id = self.drive.resolve_id(m.group(1))
+				if folder_id not in self.drive.children:
+					return self.error_body(404, 'resource_not_found', folder_id)
+				entry = self.drive.add_entry('file', m.group(2), folder_id, data)
+				return 201, {'id': entry['id'], 'name': entry['name'], 'source': ''}
+			entry_id = self.drive.resolve_id(path)
+			if entry_id not in self.drive.entries:
+				return self.error_body(404, 'resource_not_found', entry_id)
+			entry = self.drive.entries[entry_id]
+			for key, value in json.loads(data.decode() or '{}').items():
+				if key in ('name', 'description'):
+					entry[key] = value
+			entry['updated_time'] = time_to_str()
+			return 200, dict(entry)
+
+	def do_POST(self):
+		if self.inject_fault():
+			return
+		path = self.get_path()
+		data = self.read_body()
+		if self.headers.get('X-Http-Method-Override') == 'BITS_POST':
+			self.send(*self.answer_bits(path, data))
+		elif path == 'oauth20_token.srf':
+			self.send(200, {
+				'token_type': 'bearer', 'expires_in': 3600, 'scope': '',
+				'access_token': 'mock_access_token', 'refresh_token': 'mock_refresh_token',
+				'user_id': self.drive.user_id
+			})
+		else:
+			self.send(*self.answer_mkdir(path, data))
+
+	def answer_mkdir(self, path, data):
+		with self.drive.lock:
+			parent_id = self.drive.resolve_id(path)
+			if parent_id not in self.drive.children:
+				return self.error_body(404, 'resource_not_found', parent_id)
+			name = json.loads(data.decode())['name']
+			if name in self.drive.children[parent_id]:
+				return self.error_body(409, 'resource_already_exists', name)
+			return 201, dict(self.drive.add_entry('folder', name, parent_id))
+
+	def answer_bits(self, path, data):
+		# bits/<cid>/items/<cid>!<n>/<name> or bits/<cid>/users/0x<cid>/LiveFolders/<name>
+		m = re.match(r'^bits/([^/]+)/(items/([^/]+)|users/[^/]+/LiveFolders)/([^/]+)$', path)
+		packet_type = self.headers.get('BITS-Packet-Type')
+		if m is None:
+			return 404, b''
+		if m.group(3) is not None:
+			parent_id = 'folder.' + m.group(1) + '.' + m.group(3)
+		else:
+			parent_id = self.drive.root_id
+		name = m.group(4)
+		with self.drive.lock:
+			if packet_type == 'Create-Session':
+				if parent_id not in self.drive.children:
+					return 404, b''
+				session_id = '{{{:08X}-MOCK}}'.format(random.getrandbits(32))
+				self.drive.bits_sessions[session_id] = bytearray()
+				return 201, b'', {'BITS-Packet-Type': 'Ack', 'BITS-Session-Id': session_id}
+			session_id = self.headers.get('BITS-Session-Id')
+			session = self.drive.bits_sessions.get(session_id)
+			if session is None:
+				return 500, b'', {'X-ClientErrorCode': 'UploadSessionNotFound'}
+			if packet_type == 'Fragment':
+				# Content-Range: bytes <from>-<to>/<total>
+				range_from = int(self.headers['Content-Range'].split(' ')[1].split('-')[0])
+				if range_from != len(session):
+					return 416, b'', {'BITS-Received-Content-Range': str(len(session))}
+				session.extend(data)
+				return 200, b'', {'BITS-Packet-Type': 'Ack', 'BITS-Received-Content-Range': str(len(session))}
+			if packet_type == 'Close-Session':
+				del self.drive.bits_sessions[session_id]
+				if parent_id not in self.drive.children:
+					return 404, b''
+				entry = self.drive.add_entry('file', name, parent_id, session)
+				return 201, b'', {'BITS-Packet-Type': 'Ack', 'X-Resource-Id': entry['id'].split('.')[-1]}
+		return 400, b''
+
+	def handle_copy(self, is_move):
+		if self.inject_fault():
+			return
+		self.send(*self.answer_copy(self.get_path(), self.read_body(), is_move))
+
+	def answer_copy(self, path, data, is_move):
+		entry_id = self.drive.resolve_id(path)
+		with self.drive.lock:
+			dest_id = self.drive.resolve_id(json.loads(data.decode())['destination'])
+			if entry_id not in self.drive.entries or dest_id not in self.drive.children:
+				return self.error_body(404, 'resource_not_found', entry_id)
+			entry = self.drive.copy_entry(entry_id, dest_id)
+			if is_move:
+				self.drive.remove_entry(entry_id)
+			return 201, dict(entry)
+
+	def do_COPY(self):
+		self.handle_copy(False)
+
+	def do_MOVE(self):
+		self.handle_copy(True)
+
+	def do_DELETE(self):
+		if self.inject_fault():
+			return
+		entry_id = self.drive.resolve_id(self.get_path())
+		with self.drive.lock:
+			if entry_id in self.drive.entries and entry_id != self.drive.root_id:
+				self.drive.remove_entry(entry_id)
+		self.send(204)
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+
+	"""
+	@param latency: seconds to wait before answering each request.
+	@param bandwidth: bytes per second each connection may send or receive; 0 for no limit.
+	@param error_rate: fraction of requests answered with HTTP 500 server_internal_error.
+	@param throttle_rate: fraction of requests answered with HTTP 429 and Retry-After.
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, host='127.0.0.1', port=0, drive=None, latency=0, bandwidth=0,
+			error_rate=0, throttle_rate=0, retry_after=1):
+		super().__init__((host, port), MockRequestHandler)
+		self.drive = drive or MockDrive()
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.error_rate = error_rate
+		self.throttle_rate = throttle_rate
+		self.retry_after = retry_after
+		self.stats = collections.Counter()
+		self.stats_lock = threading.Lock()
+
+	def get_base_uri(self):
+		return 'http://{}:{}/'.format(*self.server_address)
+
+	def count(self, key, n=1):
+		with self.stats_lock:
+			self.stats[key] += n
+
+	def throttle(self, num_bytes):
+		if self.bandwidth > 0:
+			time.sleep(num_bytes / self.bandwidth)
+
+	def start(self):
+		threading.Thread(target=self.serve_forever, name='mock_server', daemon=True).start()
+
+	def patch_api(self, api):
+		"""
+		Send the requests of OneDriveAPI object api, and of AsyncOneDriveAPI if
+		it is loaded, to this server.
+		"""
+		base = self.get_base_uri()
+		api_class = type(api)
+		api_class.API_URI = base
+		api_class.OAUTH_TOKEN_URI = base + 'oauth20_token.srf'
+		api_class.BITS_URI = base + 'bits/{0}/'
+		async_api = sys.modules.get('onedrive_d.od_async_api')
+		if async_api is not None:
+			async_api.AsyncOneDriveAPI.API_URI = base
+		# connectivity is probed against the mock server too
+		api.threadman.PROBE_HOST, api.threadman.PROBE_PORT = self.server_address
+		api.ROOT_ENTRY_ID = self.drive.root_id
+		api.set_access_token('mock_access_token', 3600)
+		api.set_refresh_token('mock_refresh_token')
+		api.set_user_id(self.drive.user_id)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Serve a mock OneDrive (Live API v5.0) locally.')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+	parser.add_argument('--bandwidth', type=float, default=0, help='bytes per second per connection; 0 for no limit')
+	parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failing with HTTP 500')
+	parser.add_argument('--throttle-rate', type=float, default=0, help='fraction of requests throttled with HTTP 429')
+	parser.add_argument('--dirs', type=int, default=0, help='number of folders to create')
+	parser.add_argument('--files', type=int, default=0, help='number of files to create')
+	parser.add_argument('--file-size', type=int, default=4096, help='size of each file in bytes')
+	args = parser.parse_args()
+	server = MockServer(args.host, args.port, latency=args.latency, bandwidth=args.bandwidth,
+		error_rate=args.error_rate, throttle_rate=args.throttle_rate)
+	server.drive.make_tree(args.dirs, args.files, args.file_size)
+	print('serving drive {} (root id {}) at {}'.format(server.drive.user_id, server.drive.root_id, server.get_base_uri()))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,651 @@
+#!/usr/bin/python3
+
+"""
+asyncio counterpart of the OneDrive REST API for onedrive_d.
+
+AsyncOneDriveAPI sends the same requests as OneDriveAPI with aiohttp, so that
+a single thread can keep a large number of requests in flight. It shares the
+access token, the retry policy and the metadata cache of the OneDriveAPI
+singleton.
+
+Notes:
+
+ * The API object belongs to the event loop that calls start().
+ * Tokens are refreshed by OneDriveAPI in an executor thread, so refreshes
+   started here and by worker threads are still done once.
+ * When there is network issue at an API call, the coroutine waits for the
+   thread manager to see the network back, like the threads do, but without
+   blocking the event loop.
+"""
+
+import os
+import fcntl
+import time
+import urllib
+import asyncio
+import aiohttp
+import requests
+from . import od_glob
+from . import od_onedrive_api
+
+async_api_instance = None
+
+
+def get_instance():
+	global async_api_instance
+	if async_api_instance is None:
+		async_api_instance = AsyncOneDriveAPI(od_onedrive_api.get_instance())
+	return async_api_instance
+
+
+class AsyncOneDriveAPI:
+
+	API_URI = od_onedrive_api.OneDriveAPI.API_URI
+	STREAM_CHUNK_SIZE = od_onedrive_api.OneDriveAPI.STREAM_CHUNK_SIZE
+	COMMIT_BLOCKS = od_onedrive_api.OneDriveAPI.COMMIT_BLOCKS
+	LIST_PAGE_SIZE = od_onedrive_api.OneDriveAPI.LIST_PAGE_SIZE
+
+	logger = od_glob.get_logger()
+
+	def __init__(self, api):
+		"""
+		@param api: the OneDriveAPI object to share the token, the retry policy
+			and the metadata cache with.
+		"""
+		self.api = api
+		self.http_client = None
+		config = od_glob.get_config_instance()
+		self.max_connections = config.params['ASYNC_MAX_CONNECTIONS']
+
+	async def start(self):
+		# a stalled connection is dropped, but a long transfer is not
+		timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120)
+		self.http_client = aiohttp.ClientSession(
+			connector=aiohttp.TCPConnector(limit=self.max_connections), timeout=timeout)
+
+	async def close(self):
+		if self.http_client is not None:
+			await self.http_client.close()
+			self.http_client = None
+
+	def get_headers(self, headers=None):
+		"""
+		Return the headers of a request with the current access token, which
+		may have been refreshed since the last attempt.
+		"""
+		ret = {}
+		if self.api.client_access_token is not None:
+			ret['Authorization'] = 'Bearer ' + self.api.client_access_token
+		if headers is not None:
+			ret.update(headers)
+		return ret
+
+	def check_throttling(self, response):
+		"""
+		Raise OneDriveThrottledError if the server asks us to slow down.
+		"""
+		if response.status == requests.codes.too_many_requests or \
+				response.status == requests.codes.service_unavailable:
+			retry_after = od_onedrive_api.parse_retry_after(response.headers.get('retry-after'))
+			response.release()
+			raise od_onedrive_api.OneDriveThrottledError(
+				{'error': 'throttled', 'error_description': 'HTTP ' + str(response.status)}, retry_after)
+
+	async def throttle(self, direction, num_bytes):
+		"""
+		Wait until num_bytes may be sent in direction. See BandwidthLimiter.
+		"""
+		delay = self.api.bandwidth.reserve(direction, num_bytes)
+		if delay > 0:
+			await asyncio.sleep(delay)
+
+	async def iter_throttled_content(self, response):
+		"""
+		Yield the body of a response by chunks within the download limit.
+		"""
+		async for chunk in response.content.iter_chunked(self.STREAM_CHUNK_SIZE):
+			await self.throttle(od_onedrive_api.BandwidthLimiter.DOWNLOAD, len(chunk))
+			yield chunk
+
+	async def iter_throttled_file(self, local_path, hasher=None):
+		"""
+		Yield the content of a file by chunks within the upload limit. The
+		chunks are read, and fed to hasher if given, in an executor thread.
+		"""
+		loop = asyncio.get_running_loop()
+		f = await loop.run_in_executor(None, open, local_path, 'rb')
+
+		def read_chunk():
+			offset = f.tell()
+			chunk = f.read(self.STREAM_CHUNK_SIZE)
+			if hasher is not None:
+				hasher.update(offset, chunk)
+			return chunk
+
+		try:
+			while True:
+				chunk = await loop.run_in_executor(None, read_chunk)
+				if len(chunk) == 0:
+					break
+				await self.throttle(od_onedrive_api.BandwidthLimiter.UPLOAD, len(chunk))
+				yield chunk
+		finally:
+			f.close()
+
+	async def parse_response(self, response, error, ok_status=requests.codes.ok):
+		"""
+		@param ok_status: the expected HTTP status code, or a tuple of them.
+		"""
+		self.check_throttling(response)
+		try:
+			body = await response.read()
+		finally:
+			response.release()
+		# metadata goes first; bulk transfers make up for it
+		self.api.bandwidth.charge(od_onedrive_api.BandwidthLimiter.DOWNLOAD, len(body))
+		return self.api.parse_body(response.status, body, error, ok_status)
+
+	async def call_with_retry(self, attempt, recover_auth=True, on_retry=None):
+		"""
+		Await attempt(), a coroutine function that sends one request and handles
+		its response, until it returns. Failures are retried according to the
+		rules of RetryPolicy; when the policy gives up, the last error is raised.
+
+		@param recover_auth: whether to refresh the access token on auth errors.
+		@param on_retry: called with the error before every retry.
+		"""
+		loop = asyncio.get_running_loop()
+		policy = self.api.retry_policy
+		start_time = time.monotonic()
+		num_retries = 0
+		auth_recovered = False
+		while True:
+			if recover_auth and self.api.is_token_expiring():
+				await loop.run_in_executor(None, self.api.refresh_expiring_token)
+			# the token the attempt is sent with
+			token_generation = self.api.token_generation
+			try:
+				ret = await attempt()
+				policy.on_success()
+				return ret
+			except od_onedrive_api.OneDriveAuthError:
+				if not recover_auth or auth_recovered:
+					raise
+				auth_recovered = True
+				await loop.run_in_executor(None, self.api.auto_recover_auth_error, token_generation)
+			except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+				if policy.is_past_deadline(start_time):
+					raise
+				self.logger.info('network connection error.')
+				if on_retry is not None:
+					on_retry(e)
+				self.api.threadman.report_error()
+				try:
+					is_connected = await asyncio.wait_for(
+						asyncio.wrap_future(self.api.threadman.get_connection_future()), policy.get_time_left(start_time))
+				except asyncio.TimeoutError:
+					is_connected = False
+				if not is_connected:
+					raise
+			except (od_onedrive_api.OneDriveThrottledError, od_onedrive_api.OneDriveServerInternalError) as e:
+				delay = policy.get_retry_delay(e, num_retries, start_time)
+				if delay is None:
+					raise
+				num_retries += 1
+				self.logger.warning('%s %s. Retry in %.1f seconds.', type(e).__name__, e, delay)
+				if on_retry is not None:
+					on_retry(e)
+				await asyncio.sleep(delay)
+
+	async def request_json(self, method, uri, ok_status=requests.codes.ok, **kwargs):
+		"""
+		Send a request and return its parsed JSON response.
+		"""
+		async def attempt():
+			response = await self.http_client.request(method, uri, headers=self.get_headers(), **kwargs)
+			return await self.parse_response(response, od_onedrive_api.OneDriveAPIException, ok_status)
+
+		return await self.call_with_retry(attempt)
+
+	async def get_property(self, entry_id='me/skydrive', use_cache=True):
+		"""
+		@param use_cache: return the cached property of the entry if it has not expired.
+		"""
+		key = ('prop', entry_id)
+		if use_cache:
+			ret = self.api.metadata_cache.get(key)
+			if ret is not None:
+				return ret
+		ret = await self.request_json('GET', self.API_URI + entry_id)
+		self.api.metadata_cache.put(key, ret, ret.get('updated_time'))
+		return ret
+
+	async def list_entries(self, folder_id='me/skydrive', type='files', limit=None, offset=0):
+		"""
+		@param type: 'files' (default) for all files. 'shared' for shared files (used internally).
+		@param limit: if given, return at most limit entries starting from offset.
+		"""
+		if limit is not None:
+			params = {'limit': limit, 'offset': offset}
+		else:
+			params = None
+		return (await self.request_json('GET', self.API_URI + folder_id + '/' + type, params=params))['data']
+
+	async def iter_entries(self, folder_id='me/skydrive', type='files', page_size=None, updated_time=None):
+		"""
+		Yield the entries of a folder page by page. See OneDriveAPI.iter_entries().
+		"""
+		cache = self.api.metadata_cache
+		key = ('list', folder_id, type)
+		entries = None
+		if updated_time is None and cache.has(key):
+			updated_time = (await self.get_property(folder_id, use_cache=False)).get('updated_time')
+		if updated_time is not None:
+			entries = cache.get(key, updated_time)
+		if entries is not None:
+			for entry in entries:
+				yield entry
+			return
+		if page_size is None:
+			page_size = self.LIST_PAGE_SIZE
+		# huge listings are not kept so as not to flush the whole cache
+		max_cached = cache.capacity // 8
+		entries = []
+		offset = 0
+		while True:
+			page = await self.list_entries(folder_id, type, limit=page_size, offset=offset)
+			if entries is not None:
+				entries.extend(page)
+				if len(entries) > max_cached:
+					entries = None
+			for entry in page:
+				yield entry
+			if len(page) < page_size:
+				break
+			offset += len(page)
+		if entries is not None:
+			cache.put(key, entries, updated_time, max(1, len(entries)))
+
+	async def put(self, name, folder_id='me/skydrive', local_path=None, data=None, overwrite=True, hasher=None):
+		"""
+		Upload a small file or data to a folder. See OneDriveAPI.put().
+		The whole content is sent in one request, so large files should be
+		uploaded with bits_put() instead.
+		"""
+		if name == '':
+			raise od_onedrive_api.OneDriveValueError(
+				{'error': 'empty_name', 'error_description': 'The file name cannot be empty.'})
+		uri = self.API_URI + folder_id + '/files/' + name + '?' + urllib.parse.urlencode({
+			'downsize_photo_uploads': False,
+			'overwrite': overwrite
+		})
+
+		if data is not None:
+			if isinstance(data, str):
+				data = data.encode('utf-8')
+		elif local_path is not None:
+			if not os.path.isfile(local_path):
+				raise od_onedrive_api.OneDriveValueError(
+					{'error': 'wrong_file_type', 'error_description': 'The local path "' + local_path + '" is not a file.'})
+		else:
+			raise od_onedrive_api.OneDriveValueError(
+				{'error': 'upload_null_content', 'error_description': 'local_path and data cannot both be null.'})
+
+		async def attempt():
+			if data is not None:
+				# aiohttp sends the body in one piece, so it waits for the limiter up front
+				await self.throttle(od_onedrive_api.BandwidthLimiter.UPLOAD, len(data))
+				body = data
+				headers = None
+			else:
+				# a retry sends the file from the beginning
+				body = self.iter_throttled_file(local_path, hasher)
+				headers = {'Content-Length': str(os.path.getsize(local_path))}
+			response = await self.http_client.put(uri, data=body, headers=self.get_headers(headers))
+			return await self.parse_response(response, od_onedrive_api.OneDriveAPIException,
+				(requests.codes.ok, requests.codes.created))
+
+		try:
+			ret = await self.call_with_retry(attempt)
+		finally:
+			# the upload may have been done even if the reply was lost
+			self.api.forget_listing(folder_id)
+		return await self.get_property(ret['id'], use_cache=False)
+
+	async def get(self, entry_id, local_path=None, hasher=None):
+		"""
+		If local_path is given, the content is written to the file chunk by chunk
+		as it arrives. Otherwise the whole content is returned as bytes.
+
+		@param hasher: a ContentHasher to feed the bytes written to local_path.
+		"""
+		async def attempt():
+			# a connection dropped in the middle of the body starts over
+			async with self.http_client.get(self.API_URI + entry_id + '/content', headers=self.get_headers()) as r:
+				if r.status != requests.codes.ok:
+					await self.parse_response(r, od_onedrive_api.OneDriveAPIException)
+				if local_path is None:
+					return b''.join([chunk async for chunk in self.iter_throttled_content(r)])
+				# the file is written in an executor thread, not to stall the event loop on the disk
+				loop = asyncio.get_running_loop()
+				if hasher is not None:
+					hasher.reset()
+				f = await loop.run_in_executor(None, open, local_path, 'wb')
+
+				def write_chunk(chunk):
+					if hasher is not None:
+						hasher.update(f.tell(), chunk)
+					f.write(chunk)
+
+				try:
+					async for chunk in self.iter_throttled_content(r):
+						await loop.run_in_executor(None, write_chunk, chunk)
+				finally:
+					await loop.run_in_executor(None, f.close)
+				return True
+
+		return await self.call_with_retry(attempt)
+
+	async def get_block(self, entry_id, fd, range_from, range_to, sizer=None, hasher=None):
+		"""
+		Download bytes range_from to range_to (inclusive) of an entry and write
+		them to the same offsets of file descriptor fd.
+
+		@param sizer: an AdaptiveBlockSize to report the transfer speed to.
+		@param hasher: a ContentHasher to feed the bytes written to.
+		@return same as OneDriveAPI.get_block().
+		"""
+		loop = asyncio.get_running_loop()
+		# the first byte not written yet. A retry asks for the range from here
+		cursor = range_from
+
+		def write_chunk(chunk, offset):
+			os.pwrite(fd, chunk, offset)
+			if hasher is not None:
+				hasher.update(offset, chunk)
+
+		async def attempt():
+			nonlocal cursor
+			headers = {
+				'Range': 'bytes={0}-{1}'.format(cursor, range_to)
+			}
+			async with self.http_client.get(self.API_URI + entry_id + '/content', headers=self.get_headers(headers)) as r:
+				self.check_throttling(r)
+				if r.status != requests.codes.partial or 'content-range' not in r.headers:
+					if 'invalid_token' in r.headers.get('www-authenticate', ''):
+						raise od_onedrive_api.OneDriveAuthError()
+					if r.status >= 500:
+						raise od_onedrive_api.OneDriveServerInternalError(
+							{'error': {'code': 'server_error', 'message': 'HTTP ' + str(r.status)}})
+					# a server that ignores Range replies 200 with the whole file
+					self.logger.debug('failed downloading block. HTTP %d.', r.status)
+					self.logger.debug(r.headers)
+					if 400 <= r.status < 500:
+						raise od_onedrive_api.OneDriveAPIException(
+							{'error': {'code': 'download_refused', 'message': 'HTTP ' + str(r.status)}})
+					return False
+				block = od_onedrive_api.parse_content_range(r.headers['content-range'], cursor, range_to)
+				if block is None:
+					# writing a range other than the one asked for would leave holes in the file
+					raise od_onedrive_api.OneDriveServerInternalError({'error': {'code': 'bad_content_range',
+						'message': 'Content-Range "{}" for bytes {}-{}'.format(r.headers['content-range'], cursor, range_to)}})
+				block_from, block_to = block
+				offset = block_from
+				# written as it arrives, so that neither memory nor the download limit is held by a whole block
+				async for chunk in self.iter_throttled_content(r):
+					# never past the range the reply claims
+					chunk = chunk[:block_to + 1 - offset]
+					await loop.run_in_executor(None, write_chunk, chunk, offset)
+					offset += len(chunk)
+					cursor = offset
+				return True
+
+		while cursor <= range_to:
+			prev_cursor = cursor
+			start_time = time.monotonic()
+			try:
+				if not await self.call_with_retry(
+						attempt, on_retry=lambda e: sizer.on_failure() if sizer is not None else None):
+					return False
+			except (od_onedrive_api.OneDriveThrottledError, od_onedrive_api.OneDriveServerInternalError,
+					od_onedrive_api.OneDriveAuthError, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+				self.logger.error(e)
+				return False
+			if cursor == prev_cursor:
+				self.logger.error('failed downloading block. Empty reply at byte %d.', cursor)
+				return False
+			if sizer is not None:
+				sizer.on_success(cursor - prev_cursor, time.monotonic() - start_time)
+		return True
+
+	async def get_by_blocks(self, entry_id, local_path, file_size, block_size, num_ranges=1, cursor=0, on_commit=None,
+			min_block_size=None, max_block_size=None, hasher=None):
+		"""
+		Download a large file by blocks, up to num_ranges at a time.
+		See OneDriveAPI.get_by_blocks(). on_commit is called in an executor thread.
+		"""
+		try:
+			if cursor > 0:
+				fd = os.open(local_path, os.O_WRONLY)
+			else:
+				fd = os.open(local_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+		except OSError as e:
+			self.logger.error(e)
+			return False
+		try:
+			os.posix_fallocate(fd, 0, file_size)
+		except OSError:
+			# the filesystem does not support preallocation
+			os.ftruncate(fd, file_size)
+		self.logger.debug('download file to "%s" from %d with %d ranges...', local_path, cursor, num_ranges)
+		loop = asyncio.get_running_loop()
+		sizer = od_onedrive_api.AdaptiveBlockSize(block_size, min_block_size, max_block_size)
+		failed = False
+		# the error of a range the server refused
+		refusals = []
+
+		async def fetch(range_from, range_to):
+			nonlocal failed
+			if failed:
+				return range_from, range_to, False
+			try:
+				if await self.get_block(entry_id, fd, range_from, range_to, sizer, hasher):
+					return range_from, range_to, True
+			except od_onedrive_api.OneDriveAPIException as e:
+				refusals.append(e)
+			failed = True
+			return range_from, range_to, False
+
+		running = set()
+		try:
+			# blocks finish out of order; the cursor only passes contiguous ones
+			finished = {}
+			committed = cursor
+			next_offset = cursor
+			while True:
+				while not failed and next_offset < file_size and len(running) < max(1, num_ranges):
+					range_to = min(next_offset + sizer.get(), file_size) - 1
+					running.add(asyncio.ensure_future(fetch(next_offset, range_to)))
+					next_offset = range_to + 1
+				if len(running) == 0:
+					break
+				done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+				for future in done:
+					range_from, range_to, is_done = future.result()
+					if is_done:
+						finished[range_from] = range_to + 1
+				while cursor in finished:
+					cursor = finished.pop(cursor)
+				# after a failure, what is done is committed for the next attempt
+				if on_commit is not None and cursor > committed and (cursor - committed >= self.COMMIT_BLOCKS * sizer.get() or
+						cursor == file_size or (failed and len(running) == 0)):
+					# both touch the disk, so they are kept off the event loop
+					await loop.run_in_executor(None, os.fdatasync, fd)
+					await loop.run_in_executor(None, on_commit, cursor)
+					committed = cursor
+		finally:
+			for future in running:
+				future.cancel()
+			os.close(fd)
+		if len(refusals) > 0:
+			raise refusals[0]
+		if failed:
+			return False
+		self.logger.debug('file saved.')
+		return True
+
+	async def bits_create_session(self, url, local_path):
+		"""
+		Send a BITS Create-Session request to url.
+
+		@return the session id, or None if the server refuses.
+		"""
+		headers = {
+			'X-Http-Method-Override': 'BITS_POST',
+			'Content-Length': '0',
+			'BITS-Packet-Type': 'Create-Session',
+			'BITS-Supported-Protocols': '{7df0354d-249b-430f-820d-3d2a9bef4931}'
+		}
+		self.logger.debug('getting session token for BITS upload...')
+
+		async def attempt():
+			async with self.http_client.post(url, headers=self.get_headers(headers)) as response:
+				self.check_throttling(response)
+				if response.status != requests.codes.created:
+					if 'invalid_token' in response.headers.get('www-authenticate', ''):
+						raise od_onedrive_api.OneDriveAuthError()
+					# unknown error should be further analyzed
+					self.logger.debug("failed BITS Create-Session request to upload \"%s\". HTTP %d.", local_path, response.status)
+					self.logger.debug(response.headers)
+					return None
+				return response.headers['bits-session-id']
+
+		return await self.call_with_retry(attempt)
+
+	async def bits_put(self, name, folder_id, local_path=None, block_size=1048576, session=None, on_session=None,
+			min_block_size=None, max_block_size=None, hasher=None):
+		"""
+		Upload a large file with Microsoft BITS API. See OneDriveAPI.bits_put().
+		Fragments are read from disk in an executor thread.
+
+		@return None if an unrecoverable error occurs; or a file property dict.
+		"""
+		try:
+			source_size = os.path.getsize(local_path)
+		except OSError:
+			self.logger.error("cannot get file size of \"" + local_path + "\"")
+			return None
+
+		url = self.api.get_bits_url(name, folder_id)
+		if url is None:
+			self.logger.error("cannot request BITS. folder_id is invalid.")
+			return None
+
+		# BITS: Create-Session, unless a saved session can be reattached
+		is_resumed = session is not None and session['url'] == url
+		if is_resumed:
+			session_id = session['session_id']
+			source_cursor = session['cursor']
+			self.logger.debug('reattaching to BITS session at byte %d.', source_cursor)
+		else:
+			session_id = await self.bits_create_session(url, local_path)
+			if session_id is None:
+				return None
+			source_cursor = 0
+			if on_session is not None:
+				on_session(session_id, url, source_cursor)
+
+		# BITS: upload file by blocks
+		self.logger.debug('uploading file "%s".', local_path)
+		loop = asyncio.get_running_loop()
+		sizer = od_onedrive_api.AdaptiveBlockSize(block_size, min_block_size, max_block_size)
+		source_file = open(local_path, 'rb')
+		fcntl.lockf(source_file, fcntl.LOCK_SH)
+		# resyncs since the last fragment the server took; each counts as a retry of the fragment
+		num_resyncs = 0
+		try:
+			while source_cursor < source_size:
+				data = await loop.run_in_executor(None, os.pread, source_file.fileno(),
+					min(sizer.get(), source_size - source_cursor), source_cursor)
+				if len(data) == 0:
+					self.logger.error('file "%s" was truncated during upload.', local_path)
+					break
+				target_cursor = source_cursor + len(data) - 1
+				self.logger.debug("uploading block %d - %d (total: %d B)", source_cursor, target_cursor, source_size)
+				headers = {
+					'X-Http-Method-Override': 'BITS_POST',
+					'BITS-Packet-Type': 'Fragment',
+					'BITS-Session-Id': session_id,
+					'Content-Range': 'bytes {}-{}/{}'.format(source_cursor, target_cursor, source_size)
+				}
+
+				async def attempt():
+					await self.throttle(od_onedrive_api.BandwidthLimiter.UPLOAD, len(data))
+					async with self.http_client.post(url, data=data, headers=self.get_headers(headers)) as response:
+						self.check_throttling(response)
+						if response.status != requests.codes.ok:
+							self.logger.debug('an error occurred uploading the block. HTTP %d.', response.status)
+							self.logger.debug(response.headers)
+						return response.status, response.headers.get('bits-received-content-range')
+
+				start_time = time.monotonic()
+				status, received = await self.call_with_retry(attempt, on_retry=lambda e: sizer.on_failure())
+				if status == requests.codes.requested_range_not_satisfiable and received is not None:
+					# the server holds a different amount of data than we thought
+					source_cursor = int(received)
+					num_resyncs += 1
+					if num_resyncs > self.api.retry_policy.max_attempts:
+						self.logger.error('BITS session of "%s" keeps refusing fragments at byte %d.', local_path, source_cursor)
+						break
+				elif status != requests.codes.ok:
+					if is_resumed:
+						# the saved session has probably expired. start over
+						self.logger.info('cannot reattach to BITS session. Start a new one.')
+						is_resumed = False
+						session_id = await self.bits_create_session(url, local_path)
+						if session_id is not None:
+							source_cursor = 0
+							if on_session is not None:
+								on_session(session_id, url, source_cursor)
+							continue
+					break
+				else:
+					if hasher is not None and not is_resumed:
+						await loop.run_in_executor(None, hasher.update, source_cursor, data)
+					source_cursor = int(received)
+					num_resyncs = 0
+					sizer.on_success(len(data), time.monotonic() - start_time)
+					if on_session is not None:
+						on_session(session_id, url, source_cursor)
+		finally:
+			fcntl.lockf(source_file, fcntl.LOCK_UN)
+			source_file.close()
+		if source_cursor < source_size:
+			return None
+
+		# BITS: close session
+		self.logger.debug('BITS upload completed. Closing session...')
+		headers = {
+			'X-Http-Method-Override': 'BITS_POST',
+			'BITS-Packet-Type': 'Close-Session',
+			'BITS-Session-Id': session_id,
+			'Content-Length': '0'
+		}
+
+		async def attempt():
+			async with self.http_client.post(url, headers=self.get_headers(headers)) as response:
+				self.check_throttling(response)
+				if response.status != requests.codes.ok and response.status != requests.codes.created:
+					if 'expired_token' in response.headers.get('www-authenticate', ''):
+						raise od_onedrive_api.OneDriveAuthError()
+					self.logger.debug('An error occurred when closing BITS session. HTTP %d', response.status)
+					self.logger.debug(response.headers)
+					return None
+				return response.headers['x-resource-id']
+
+		res_id = await self.call_with_retry(attempt)
+		if res_id is None:
+			return None
+		self.logger.debug('BITS session successfully closed.')
+		self.api.forget_listing(folder_id)
+		return await self.get_property('file.' + res_id[:res_id.index('!')] + '.' + res_id, use_cache=False)
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+"""
+asyncio task dispatcher of onedrive-d.
+
+An alternative to WorkerThread, used when TRANSFER_ENGINE is 'asyncio'.
+
+One thread runs an event loop that keeps up to ASYNC_MAX_TRANSFERS uploads
+and downloads in flight with AsyncOneDriveAPI, so the number of concurrent
+transfers is no longer the number of threads. The other tasks mostly walk
+local dirs and the entry database, so they are handed to a pool of
+NUM_OF_WORKERS threads that handle them like WorkerThread does.
+"""
+
+import os
+import json
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from . import od_glob
+from . import od_async_api
+from . import od_onedrive_api
+from . import od_sqlite
+from . import od_worker_thread
+
+
+class AsyncDispatcher(threading.Thread):
+
+	logger = od_glob.get_logger()
+	config = od_glob.get_config_instance()
+	# tasks handled by coroutines; all others are handled by the thread pool
+	TRANSFER_TYPES = od_sqlite.TaskManager.BULK_TASK_TYPES
+
+	def __init__(self):
+		super().__init__()
+		self.name = 'async_dispatcher'
+		self.daemon = True
+		self.running = True
+		# whether the poller only waits for one kind of tasks because all slots of the other kind are taken
+		self.is_polling_restricted = False
+		self.api = od_async_api.get_instance()
+		# for helpers shared with WorkerThread
+		self.handler = od_worker_thread.TaskHandler()
+		self.local = threading.local()
+
+	def stop(self):
+		self.running = False
+
+	def init_handler_thread(self):
+		"""
+		Give a thread of the pool its own task handler and database connections.
+		"""
+		handler = od_worker_thread.TaskHandler()
+		handler.taskmgr = od_sqlite.TaskManager()
+		handler.entrymgr = self.get_thread_entrymgr()
+		self.local.handler = handler
+
+	def get_thread_entrymgr(self):
+		"""
+		Return the EntryManager of the calling thread, e.g., an executor thread of the event loop.
+		"""
+		entrymgr = getattr(self.local, 'entrymgr', None)
+		if entrymgr is None:
+			entrymgr = od_sqlite.EntryManager()
+			self.local.entrymgr = entrymgr
+		return entrymgr
+
+	def handle_task_in_thread(self, task):
+		self.local.handler.handle_task(task)
+
+	async def run_task(self, task, handler_pool, slots, slot_released):
+		"""
+		@param slots: the semaphore acquired for the task, released when it is done.
+		@param slot_released: the event set when a slot is released.
+		"""
+		try:
+			if task['type'] in AsyncDispatcher.TRANSFER_TYPES:
+				try:
+					if task['type'] == 'up':
+						await self.upload_file(task)
+					else:
+						await self.download_file(task)
+				except (od_onedrive_api.OneDriveAPIException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+					# the retry policy gave up on the request. The next deep scan will retry the task.
+					self.logger.error('failed task %s on "%s": %s', task['type'], task['local_path'], e)
+					self.handler.give_up_task(task)
+				except Exception as e:
+					# same as in TaskHandler.handle_task()
+					self.logger.exception('failed task %s on "%s": %s', task['type'], task['local_path'], e)
+					self.handler.give_up_task(task)
+			else:
+				await asyncio.get_running_loop().run_in_executor(handler_pool, self.handle_task_in_thread, task)
+		except Exception as e:
+			self.logger.exception(e)
+		finally:
+			slots.release()
+			slot_released.set()
+			if self.is_polling_restricted:
+				# let the poller fetch the other kind of tasks again
+				self.taskmgr.inc_sem()
+
+	async def upload_file(self, task):
+		"""
+		Same as WorkerThread.upload_file().
+		"""
+		source = self.handler.get_upload_source(task)
+		if source is None:
+			return
+		local_fsize, fingerprint = source
+		hasher = od_onedrive_api.ContentHasher()
+		if local_fsize >= self.config.params['BITS_FILE_MIN_SIZE']:
+			new_entry = await self.upload_file_by_bits(task['local_path'], task['remote_parent_id'], hasher)
+			if new_entry is None:
+				self.logger.error('failed to BITS upload "' + task['local_path'] + '".')
+				self.handler.give_up_task(task)
+				return
+		else:
+			new_entry = await self.api.put(os.path.basename(task['local_path']),
+				folder_id=task['remote_parent_id'],
+				local_path=task['local_path'],
+				hasher=hasher)
+		self.handler.finish_upload(task, new_entry, fingerprint, hasher.get_hexdigest(local_fsize))
+
+	async def upload_file_by_bits(self, local_path, remote_parent_id, hasher=None):
+		"""
+		Same as WorkerThread.upload_file_by_bits().
+		"""
+		try:
+			session, save_session = self.handler.get_upload_session(local_path, remote_parent_id)
+		except OSError as e:
+			self.logger.error(e)
+			return None
+		new_entry = await self.api.bits_put(os.path.basename(local_path),
+			folder_id=remote_parent_id,
+			local_path=local_path,
+			block_size=self.config.params['BITS_BLOCK_SIZE'],
+			session=session,
+			on_session=save_session,
+			min_block_size=self.config.params['BITS_BLOCK_SIZE_MIN'],
+			max_block_size=self.config.params['BITS_BLOCK_SIZE_MAX'],
+			hasher=hasher)
+		self.entrymgr.del_transfer(local_path)
+		return new_entry
+
+	async def download_file(self, task):
+		"""
+		Same as WorkerThread.download_file().
+		"""
+		self.handler.echoes.expect(task['local_path'], self.handler.get_part_path(task['local_path']))
+		try:
+			entry = json.loads(task['extra_info'])
+			hasher = od_onedrive_api.ContentHasher()
+			if entry['size'] >= self.config.params['BITS_FILE_MIN_SIZE']:
+				if not await self.download_file_by_blocks(task['local_path'], entry, hasher):
+					self.logger.error(
+						'failed to download to file "%s" by blocks.', task['local_path'])
+					self.handler.give_up_task(task)
+					return
+			else:
+				is_done = False
+				try:
+					is_done = await self.api.get(task['remote_id'], self.handler.get_part_path(task['local_path']), hasher)
+				finally:
+					if not is_done:
+						self.handler.discard_part_file(task['local_path'])
+				if not self.handler.finish_part_file(task['local_path'], is_done):
+					self.logger.error('failed to download file "%s".', task['local_path'])
+					self.handler.give_up_task(task)
+					return
+			self.handler.finish_download(task, entry, hasher.get_hexdigest(entry['size']))
+		finally:
+			self.handler.echoes.settle(task['local_path'], self.handler.get_part_path(task['local_path']))
+
+	async def download_file_by_blocks(self, local_path, entry, hasher=None):
+		"""
+		Same as WorkerThread.download_file_by_blocks().
+		"""
+		cursor = self.handler.get_download_cursor(local_path, entry)
+		try:
+			is_done = await self.api.get_by_blocks(entry['id'], self.handler.get_part_path(local_path), entry['size'],
+				self.config.params['BITS_BLOCK_SIZE'], self.config.params['BITS_DOWNLOAD_RANGES'],
+				cursor=cursor, on_commit=lambda c: self.get_thread_entrymgr().update_transfer_cursor(local_path, c),
+				min_block_size=self.config.params['BITS_BLOCK_SIZE_MIN'],
+				max_block_size=self.config.params['BITS_BLOCK_SIZE_MAX'],
+				hasher=hasher if cursor == 0 else None)
+		except od_onedrive_api.OneDriveAPIException as e:
+			self.logger.error(e)
+			self.handler.discard_part_file(local_path)
+			return False
+		return self.handler.finish_part_file(local_path, is_done)
+
+	async def dispatch(self):
+		loop = asyncio.get_running_loop()
+		await self.api.start()
+		transfer_slots = asyncio.Semaphore(self.config.params['ASYNC_MAX_TRANSFERS'])
+		# metadata tasks are not claimed faster than the handler pool can take them
+		handler_slots = asyncio.Semaphore(self.config.params['NUM_OF_WORKERS'])
+		slot_released = asyncio.Event()
+		# waiting for the task semaphore blocks, so it is done in its own thread
+		poller = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name + '_poller')
+		handler_pool = ThreadPoolExecutor(max_workers=self.config.params['NUM_OF_WORKERS'],
+			thread_name_prefix=self.name + '_handler', initializer=self.init_handler_thread)
+		running = set()
+		try:
+			while self.running:
+				if transfer_slots.locked() and handler_slots.locked():
+					slot_released.clear()
+					await slot_released.wait()
+					continue
+				# either kind of tasks is still fetched when all slots of the other kind are taken
+				self.is_polling_restricted = transfer_slots.locked() or handler_slots.locked()
+				await loop.run_in_executor(poller, functools.partial(self.taskmgr.dec_sem,
+					fast_lane=transfer_slots.locked(), transfers_only=handler_slots.locked()))
+				self.is_polling_restricted = False
+				if not self.running:
+					break
+				task = self.taskmgr.get_task(transfer_slots.locked(), handler_slots.locked())
+				if task is None:
+					self.logger.debug('got null task.')
+					continue
+				self.logger.debug('got task: %s on "%s"', task['type'], task['local_path'])
+				if task['type'] in AsyncDispatcher.TRANSFER_TYPES:
+					slots = transfer_slots
+				else:
+					slots = handler_slots
+				# never blocks, as a kind of tasks is only fetched when one of its slots is free
+				await slots.acquire()
+				future = asyncio.ensure_future(self.run_task(task, handler_pool, slots, slot_released))
+				running.add(future)
+				future.add_done_callback(running.discard)
+			if len(running) > 0:
+				await asyncio.wait(running)
+		finally:
+			poller.shutdown()
+			handler_pool.shutdown()
+			await self.api.close()
+
+	def run(self):
+		self.taskmgr = od_sqlite.TaskManager()
+		self.entrymgr = od_sqlite.EntryManager()
+		self.handler.taskmgr = self.taskmgr
+		self.handler.entrymgr = self.entrymgr
+		asyncio.run(self.dispatch())
+		self.taskmgr = None
+		self.entrymgr.close()
+		self.logger.debug('stopped.')
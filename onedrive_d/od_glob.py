@@ -103,19 +103,78 @@ class ConfigSet:
 
 	params = {
 		'NETWORK_ERROR_RETRY_INTERVAL': 10,  # in seconds
+		# the probe interval doubles up to this while the network is down
+		'NETWORK_ERROR_RETRY_MAX_INTERVAL': 120,  # in seconds
 		'DEEP_SCAN_INTERVAL': 60,  # in seconds
+		# tasks for local changes are added once there is no change for INOTIFY_QUIET_WINDOW seconds,
+		# but no later than INOTIFY_MAX_DELAY seconds after the first change
+		'INOTIFY_QUIET_WINDOW': 1,  # in seconds
+		'INOTIFY_MAX_DELAY': 10,  # in seconds
+		# events caused by the daemon's own writes are ignored if they come within this time
+		'INOTIFY_ECHO_TIMEOUT': 60,  # in seconds
+		# if set, deep scans in between skip the dirs that have not changed. Remote changes below
+		# such a dir then wait for the next full scan. 0 means every scan is full.
+		'FULL_SCAN_INTERVAL': 0,  # in seconds
+		# keep the task queue in ~/.onedrive/tasks.db, so that a restart continues pending work
+		# and does not need a full scan
+		'TASK_JOURNAL': False,
+		# what to do with pending tasks at shutdown: 'persist' them in the task journal,
+		# 'drain' the queue for up to SHUTDOWN_DRAIN_TIMEOUT seconds first, or 'discard' them
+		'SHUTDOWN_MODE': 'persist',
+		'SHUTDOWN_DRAIN_TIMEOUT': 60,  # in seconds
 		'NUM_OF_WORKERS': 4,
+		# the pool of workers grows up to this many threads while tasks pile up,
+		# and shrinks back to NUM_OF_WORKERS when they are done
+		'MAX_NUM_OF_WORKERS': 16,
+		'WORKER_SCALE_INTERVAL': 5,  # in seconds
+		# the pool shrinks when more than this fraction of API calls is throttled or fails on the server
+		'WORKER_MAX_ERROR_RATE': 0.05,
+		# and stops growing when tasks take this many times longer than they used to
+		'WORKER_MAX_LATENCY_RATIO': 2,
+		# workers of NUM_OF_WORKERS that only handle metadata tasks, never uploads or downloads
+		'NUM_OF_FAST_LANE_WORKERS': 1,
+		# max number of metadata tasks a worker claims at once
+		'TASK_BATCH_SIZE': 32,
+		# 'thread' runs NUM_OF_WORKERS worker threads. 'asyncio' runs transfers
+		# as coroutines in one thread and requires aiohttp.
+		'TRANSFER_ENGINE': 'thread',
+		# number of transfers and connections the asyncio engine keeps at once
+		'ASYNC_MAX_TRANSFERS': 64,
+		'ASYNC_MAX_CONNECTIONS': 64,
 		# files > 4 MiB will be uploaded with BITS API
 		'BITS_FILE_MIN_SIZE': 4194304,
-		# 512 KiB per block for BITS API
+		# 512 KiB per block for BITS API to start with
 		'BITS_BLOCK_SIZE': 524288,
+		# block size adapts to throughput between 256 KiB and 16 MiB
+		'BITS_BLOCK_SIZE_MIN': 262144,
+		'BITS_BLOCK_SIZE_MAX': 16777216,
+		# number of blocks of one file to download concurrently
+		'BITS_DOWNLOAD_RANGES': 4,
+		# number of remote entries to cache metadata for, and for how long
+		'METADATA_CACHE_SIZE': 100000,
+		'METADATA_CACHE_TTL': 3600,  # in seconds
+		# retry throttled and failed API calls with exponential backoff
+		'RETRY_BASE_DELAY': 1,  # in seconds
+		'RETRY_MAX_DELAY': 300,  # in seconds
+		'RETRY_MAX_ATTEMPTS': 8,
+		# give up an API call after this long. None means never.
+		'API_CALL_DEADLINE': 3600,  # in seconds
+		# refresh the access token this long before it expires
+		'TOKEN_REFRESH_MARGIN': 300,  # in seconds
+		# bandwidth limits in bytes per second. 0 means no limit.
+		'BANDWIDTH_LIMIT': 0,  # upload and download combined
+		'UPLOAD_LIMIT': 0,
+		'DOWNLOAD_LIMIT': 0,
+		# time-of-day limits, e.g., [{"start": "09:00", "end": "18:00", "upload": 131072}]
+		'BANDWIDTH_SCHEDULE': [],
 		'ONEDRIVE_ROOT_PATH': None,
 		'ONEDRIVE_TOKENS': None,
 		'ONEDRIVE_TOKENS_EXP': None,
 		'USE_GUI': False,
 		'MIN_LOG_LEVEL': logging.DEBUG,
 		'LOG_FILE_PATH': '/var/log/onedrive_d.log',
-		'LAST_RUN_TIMESTAMP': '1970-01-01T00:00:00+0000'
+		'LAST_RUN_TIMESTAMP': '1970-01-01T00:00:00+0000',
+		'LAST_FULL_SCAN_TIMESTAMP': '1970-01-01T00:00:00+0000'
 	}
 
 	logger = get_logger()
@@ -177,6 +236,10 @@ class ConfigSet:
 		ConfigSet.params['LAST_RUN_TIMESTAMP'] = time_to_str(now())
 		ConfigSet.is_dirty = True
 
+	def set_last_full_scan_timestamp(self):
+		ConfigSet.params['LAST_FULL_SCAN_TIMESTAMP'] = time_to_str(now())
+		ConfigSet.is_dirty = True
+
 	def get_access_token(self):
 		if ConfigSet.params['ONEDRIVE_TOKENS'] is not None:
 			return ConfigSet.params['ONEDRIVE_TOKENS']
@@ -1,18 +1,155 @@
 #!/usr/bin/python3
 
+import os
 import csv
+import time
 import shutil
 import subprocess
 import threading
+import collections
 from time import sleep
 
 from . import od_glob
 from . import od_sqlite
 
 
+class EventCoalescer(threading.Thread):
+
+	"""
+	Collect the tasks caused by inotify events and add them to TaskManager only
+	after events stop for quiet_window seconds, or max_delay seconds after the
+	first one. A later task for the same local path replaces the earlier one,
+	so a burst of events costs one task per affected path, e.g., one sync per
+	dir instead of one per changed file.
+	"""
+
+	def __init__(self, quiet_window, max_delay):
+		super().__init__()
+		self.name = 'inotify_coalescer'
+		self.daemon = True
+		self.running = True
+		self.quiet_window = quiet_window
+		self.max_delay = max_delay
+		self.cond = threading.Condition()
+		# local_path -> arguments of TaskManager.add_task()
+		self.pending = collections.OrderedDict()
+		self.first_event_time = None
+		self.last_event_time = None
+		self.logger = od_glob.get_logger()
+
+	def add_task(self, type, local_path, remote_id='', remote_parent_id='', args=''):
+		"""
+		Same arguments as TaskManager.add_task().
+		"""
+		with self.cond:
+			if len(self.pending) == 0:
+				self.first_event_time = time.monotonic()
+			self.last_event_time = time.monotonic()
+			# moved to the end so that tasks are added in the order of their last events
+			self.pending.pop(local_path, None)
+			self.pending[local_path] = (type, remote_id, remote_parent_id, args)
+			self.cond.notify()
+
+	def discard(self, local_path):
+		"""
+		Drop the pending task of a path, e.g., when a deleted file reappears.
+		"""
+		with self.cond:
+			self.pending.pop(local_path, None)
+
+	def stop(self):
+		with self.cond:
+			self.running = False
+			self.cond.notify()
+
+	def flush(self):
+		with self.cond:
+			pending, self.pending = self.pending, collections.OrderedDict()
+		if len(pending) > 0:
+			self.logger.debug('adding %d tasks for inotify events.', len(pending))
+		for local_path, (type, remote_id, remote_parent_id, args) in pending.items():
+			self.taskmgr.add_task(type, local_path, remote_id, remote_parent_id, args=args)
+
+	def run(self):
+		self.taskmgr = od_sqlite.TaskManager()
+		# local changes go before the work of deep scans
+		self.taskmgr.priority = od_sqlite.TaskManager.PRIORITY_INTERACTIVE
+		while True:
+			with self.cond:
+				while self.running and len(self.pending) == 0:
+					self.cond.wait()
+				if not self.running:
+					break
+				due_time = min(self.last_event_time + self.quiet_window, self.first_event_time + self.max_delay)
+				if time.monotonic() < due_time:
+					self.cond.wait(due_time - time.monotonic())
+					continue
+			self.flush()
+		# add what is left so that it can be kept or drained at shutdown
+		self.flush()
+		self.taskmgr = None
+
+
+class EchoSuppressor:
+
+	"""
+	Tell the inotify events caused by the daemon's own writes from the ones
+	caused by the user.
+
+	A thread calls expect() before it writes, moves or removes local paths,
+	and settle() when it is done. Events of a path are echoes while the path
+	is being written, and, for timeout seconds after that, as long as the
+	path still has the mtime and size (or absence) it was left with. Any
+	other change of the path is the user's.
+	"""
+
+	def __init__(self, timeout):
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		# local_path -> number of writes in progress
+		self.writing = {}
+		# local_path -> (expiry time, expected state), in the order they were settled
+		self.settled = collections.OrderedDict()
+
+	def get_state(self, local_path):
+		try:
+			st = os.stat(local_path)
+			return st.st_mtime_ns, st.st_size
+		except OSError:
+			return None
+
+	def expect(self, *local_paths):
+		with self.lock:
+			for local_path in local_paths:
+				self.writing[local_path] = self.writing.get(local_path, 0) + 1
+
+	def settle(self, *local_paths):
+		expiry_time = time.monotonic() + self.timeout
+		states = [self.get_state(local_path) for local_path in local_paths]
+		with self.lock:
+			for local_path, state in zip(local_paths, states):
+				self.writing[local_path] -= 1
+				if self.writing[local_path] == 0:
+					del self.writing[local_path]
+				self.settled.pop(local_path, None)
+				self.settled[local_path] = (expiry_time, state)
+
+	def is_echo(self, local_path):
+		with self.lock:
+			now = time.monotonic()
+			while len(self.settled) > 0 and next(iter(self.settled.values()))[0] < now:
+				self.settled.popitem(last=False)
+			if local_path in self.writing:
+				return True
+			if local_path not in self.settled:
+				return False
+			expected_state = self.settled[local_path][1]
+		return self.get_state(local_path) == expected_state
+
+
 class INotifyThread(threading.Thread):
 
-	pause_event = threading.Event()
+	echoes = EchoSuppressor(od_glob.get_config_instance().params['INOTIFY_ECHO_TIMEOUT'])
 
 	def __init__(self, root_path, root_id, ignore_list):
 		super().__init__()
@@ -23,8 +160,11 @@ class INotifyThread(threading.Thread):
 		self.root_id = root_id
 		self.ignore_list = ignore_list
 		self.logger = od_glob.get_logger()
+		config = od_glob.get_config_instance()
+		self.coalescer = EventCoalescer(config.params['INOTIFY_QUIET_WINDOW'], config.params['INOTIFY_MAX_DELAY'])
 
 	def stop(self):
+		self.coalescer.stop()
 		self.subp.terminate()
 		subprocess.call(['kill', '-s', '9', str(self.subp.pid)])
 		self.logger.debug('inotifywait killed.')
@@ -32,11 +172,12 @@ class INotifyThread(threading.Thread):
 
 	def parse_record(self, row):
 
-		if INotifyThread.pause_event.is_set():
-			return
-
 		path, event, name = row
 
+		if INotifyThread.echoes.is_echo(path + name):
+			self.logger.debug('ignored echo "%s" of "%s%s".', event, path, name)
+			return
+
 		if self.ignore_list.is_ignorable(name, path):
 			# if the file / dir is in ignore list, skip it
 			self.logger.debug('ignored "%s%s".', path, name)
@@ -44,6 +185,10 @@ class INotifyThread(threading.Thread):
 
 		parent_entry = self.entrymgr.get_entry(isdir=True, local_path=path[:-1])
 
+		if 'CLOSE_WRITE' in event or 'MOVED_TO' in event:
+			# the path exists again, so a pending removal is obsolete
+			self.coalescer.discard(path + name)
+
 		if 'CLOSE_WRITE' in event:
 			# the situation is complex. cannot simply upload without knowing its remote status.
 			# sync its parent without recursion
@@ -83,7 +228,7 @@ class INotifyThread(threading.Thread):
 			target_entry = self.entrymgr.get_entry(isdir=isdir,
 				local_path=path + name)
 			if target_entry is not None:
-				self.taskmgr.add_task('rm' if isdir else 'rf',
+				self.coalescer.add_task('rm' if isdir else 'rf',
 					local_path=path + name,
 					remote_id=target_entry['remote_id'],
 					remote_parent_id=target_entry['remote_parent_id'])
@@ -109,10 +254,10 @@ class INotifyThread(threading.Thread):
 			pass
 
 	def sync_root(self):
-		self.taskmgr.add_task('sy', self.root_path[:-1], self.root_id, '')
+		self.coalescer.add_task('sy', self.root_path[:-1], self.root_id, '')
 
 	def sync_path(self, path, entry, args=''):
-		self.taskmgr.add_task('sy', path[:-1],
+		self.coalescer.add_task('sy', path[:-1],
 			remote_id=entry['remote_id'],
 			remote_parent_id=entry['remote_parent_id'],
 			args='')
@@ -131,8 +276,8 @@ class INotifyThread(threading.Thread):
 		# 		ignore_list.append(fnmatch.translate(item).replace('\\Z(?ms)', ''))
 		# 		inotify_args += ['--exclude', '(' +'|'.join(ignore_list) + ')']
 
-		self.taskmgr = od_sqlite.TaskManager()
 		self.entrymgr = od_sqlite.EntryManager()
+		self.coalescer.start()
 
 		self.logger.debug('starting inotifywait process.')
 		self.subp = subprocess.Popen(
@@ -148,6 +293,6 @@ class INotifyThread(threading.Thread):
 				# del csv_rows
 
 		self.logger.debug('exit while loop.')
-		self.taskmgr = None
+		self.coalescer.join()
 		self.entrymgr.close()
 		self.logger.debug('stopped.')
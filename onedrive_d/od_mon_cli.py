@@ -23,6 +23,10 @@ class Monitor:
 		self.taskmgr = None
 		self.entrymgr = None
 		self.inotify_thread = None
+		self.dispatcher = None
+		self.worker_pool = None
+		# whether the task journal brought back the whole queue of the last run
+		self.is_queue_restored = False
 		atexit.register(self.cleanup)
 		signal.signal(signal.SIGTERM, self.stop)
 
@@ -42,7 +46,8 @@ class Monitor:
 				sys.exit(1)
 		else:
 			# the token exists and is not expired
-			self.api.set_access_token(tokens['access_token'])
+			self.api.set_access_token(tokens['access_token'],
+				(od_glob.str_to_time(self.config.params['ONEDRIVE_TOKENS_EXP']) - od_glob.now()).total_seconds())
 			self.api.set_refresh_token(tokens['refresh_token'])
 			self.api.set_user_id(tokens['user_id'])
 		self.root_entry_id = self.api.get_property()['id']
@@ -54,11 +59,25 @@ class Monitor:
 
 	def create_workers(self):
 		self.taskmgr = od_sqlite.TaskManager()
-		for i in range(0, self.config.params['NUM_OF_WORKERS']):
-			od_worker_thread.WorkerThread().start()
+		journal_path = self.config.APP_CONF_PATH + '/tasks.db'
+		if self.config.params['TASK_JOURNAL']:
+			self.taskmgr.open_journal(journal_path)
+			self.is_queue_restored = self.taskmgr.journal.was_intact
+		elif os.path.exists(journal_path):
+			# the tasks of this run are not kept, so the recorded queue goes stale
+			journal = od_sqlite.TaskJournal(journal_path)
+			journal.clear()
+			journal.close()
+		if self.config.params['TRANSFER_ENGINE'] == 'asyncio':
+			# requires aiohttp, so it is only imported when chosen
+			from . import od_async_dispatcher
+			self.dispatcher = od_async_dispatcher.AsyncDispatcher()
+			self.dispatcher.start()
+			return
+		self.worker_pool = od_worker_thread.WorkerPool()
+		self.worker_pool.start()
 
 	def create_inotify_thread(self):
-		od_inotify_thread.INotifyThread.pause_event.clear()
 		self.inotify_thread = od_inotify_thread.INotifyThread(
 			root_path=self.config.params['ONEDRIVE_ROOT_PATH'],
 			root_id=self.root_entry_id,
@@ -67,6 +86,12 @@ class Monitor:
 
 	def heart_beat(self):
 		self.entrymgr = od_sqlite.EntryManager()
+		if self.is_queue_restored:
+			# pending work was kept, so a restart only runs the full scans that are due
+			last_full_scan_time = od_glob.str_to_time(self.config.params['LAST_FULL_SCAN_TIMESTAMP'])
+		else:
+			# the first scan is full, for changes made when the daemon was off and the work the last run dropped
+			last_full_scan_time = None
 		while True:
 			# self.taskmgr.add_task(**{
 			# 	'type': 'sy',
@@ -74,17 +99,42 @@ class Monitor:
 			# 	'remote_id': root_entry_id,
 			# 	'args': 'recursive,'
 			# })
+			if last_full_scan_time is None or \
+					(od_glob.now() - last_full_scan_time).total_seconds() >= self.config.params['FULL_SCAN_INTERVAL']:
+				last_full_scan_time = od_glob.now()
+				self.config.set_last_full_scan_timestamp()
+				args = 'recursive,'
+			else:
+				args = 'recursive,incremental,'
 			self.taskmgr.add_task('sy',
 				local_path=self.config.params['ONEDRIVE_ROOT_PATH'],
 				remote_id=self.root_entry_id,
-				args='recursive,')
+				args=args)
 			time.sleep(self.config.params['DEEP_SCAN_INTERVAL'])
+			self.logger.debug('connection stats: %s', self.api.get_connection_stats())
+			self.logger.debug('metadata cache: %d hits, %d misses.', self.api.metadata_cache.hits, self.api.metadata_cache.misses)
 			gc.collect()
 
+	def drain_tasks(self):
+		"""
+		Wait for the task queue to empty, for at most SHUTDOWN_DRAIN_TIMEOUT seconds.
+		"""
+		self.logger.info('waiting for %d tasks to finish.', self.taskmgr.count_tasks())
+		deadline = time.monotonic() + self.config.params['SHUTDOWN_DRAIN_TIMEOUT']
+		while self.taskmgr.count_tasks() > 0 and time.monotonic() < deadline:
+			time.sleep(0.1)
+
 	def cleanup(self):
 		self.logger.debug('cleaning up.')
+		persist_tasks = False
+		if self.taskmgr is not None:
+			if self.config.params['SHUTDOWN_MODE'] == 'drain':
+				self.drain_tasks()
+			persist_tasks = self.config.params['TASK_JOURNAL'] and self.config.params['SHUTDOWN_MODE'] != 'discard'
 		if self.entrymgr is not None:
-			self.entrymgr.del_unvisited_entries()
+			if not persist_tasks or self.taskmgr.count_tasks() == 0:
+				# records not visited by a scan that is to be continued are still valid
+				self.entrymgr.del_unvisited_entries()
 			self.entrymgr.close()
 			self.logger.debug('entry manager closed.')
 		if self.inotify_thread is not None:
@@ -92,17 +142,18 @@ class Monitor:
 			self.inotify_thread.join()
 			self.logger.debug('inotify thread stopped.')
 		if self.taskmgr is not None:
-			self.taskmgr.clean_tasks()
+			self.taskmgr.clean_tasks(persist=persist_tasks)
 			self.logger.debug('task queue cleaned.')
-			od_worker_thread.WorkerThread.worker_lock.acquire()
-			for w in od_worker_thread.WorkerThread.worker_list:
-				w.stop()
-			for w in od_worker_thread.WorkerThread.worker_list:
+			if self.worker_pool is not None:
+				self.worker_pool.stop()
+				self.worker_pool.join()
+			if self.dispatcher is not None:
+				self.dispatcher.stop()
+				# workers waiting for the network give up their tasks
+				self.api.threadman.cancel_waits()
 				self.taskmgr.inc_sem()
-			for w in od_worker_thread.WorkerThread.worker_list:
-				self.logger.debug('waiting for thread %s.', w.name)
-				w.join()
-			od_worker_thread.WorkerThread.worker_lock.release()
+				self.logger.debug('waiting for thread %s.', self.dispatcher.name)
+				self.dispatcher.join()
 			self.taskmgr.close()
 
 	def start(self):
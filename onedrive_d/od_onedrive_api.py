@@ -12,18 +12,30 @@ Notes:
    and thread manager will wake it up when the network seems fine. When the caller
    is waken up, it will retry the function that failed before.
  * When refresh_token is set, API will try to get new access_token automatically
-   and retry the function call later.
+   and retry the function call later. The token is also refreshed shortly before
+   it expires. Only one thread refreshes at a time; the others wait for it and
+   use the new token.
+ * When the server is throttling or failing, the call is retried with backoff
+   as decided by RetryPolicy, and eventually the error is raised to the caller.
 
 Bullets 3 and 4 are like interrupt handling.
 """
 
 import os
 import json
+import hashlib
 import urllib
 import functools
 import fcntl
+import collections
+import random
+import email.utils
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 # import imghdr
 import requests
+from requests.adapters import HTTPAdapter
 # for debugging
 from time import sleep
 from . import od_glob
@@ -43,6 +55,8 @@ class OneDriveAPIException(Exception):
 
 	def __init__(self, args=None):
 		super().__init__()
+		self.errno = 0
+		self.message = ''
 		if args is None:
 			pass
 		elif 'error_description' in args:
@@ -52,12 +66,9 @@ class OneDriveAPIException(Exception):
 			args = args['error']
 			self.errno = args['code']
 			self.message = args['message']
-		else:
-			self.errno = 0
-			self.message = ''
 
 	def __str__(self):
-		return self.message + ' (' + self.errno + ')'
+		return '{} ({})'.format(self.message, self.errno)
 
 
 class OneDriveAuthError(OneDriveAPIException):
@@ -72,6 +83,18 @@ class OneDriveServerInternalError(OneDriveAPIException):
 	pass
 
 
+class OneDriveThrottledError(OneDriveAPIException):
+
+	"""
+	Raised when the server asks the client to slow down (HTTP 429 or 503).
+	"""
+
+	def __init__(self, args=None, retry_after=None):
+		super().__init__(args)
+		# seconds to wait as requested by the server, or None
+		self.retry_after = retry_after
+
+
 class OneDriveValueError(OneDriveAPIException):
 
 	"""
@@ -80,6 +103,462 @@ class OneDriveValueError(OneDriveAPIException):
 	pass
 
 
+class TokenBucket:
+
+	"""
+	A token bucket that lets rate bytes per second through on average, with
+	bursts of up to burst bytes. A rate of 0 means no limit.
+
+	Callers reserve bytes before moving them and wait for the returned time.
+	The bucket can go into debt, so bytes that must not be delayed can be
+	charged at once and later reservations wait to pay them back.
+	"""
+
+	def __init__(self, rate=0, burst=None):
+		self.lock = threading.Lock()
+		self.set_rate(rate, burst)
+
+	def set_rate(self, rate, burst=None):
+		"""
+		@param burst: bytes that can be sent at once. Default: rate, i.e., one second of traffic.
+		"""
+		with self.lock:
+			self.rate = rate
+			self.burst = burst if burst is not None else rate
+			self.tokens = self.burst
+			self.last_time = time.monotonic()
+
+	def reserve(self, num_bytes):
+		"""
+		Take num_bytes from the bucket and return the number of seconds to wait
+		before sending them.
+		"""
+		with self.lock:
+			if not self.rate:
+				return 0
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+			self.last_time = now
+			self.tokens -= num_bytes
+			if self.tokens >= 0:
+				return 0
+			return -self.tokens / self.rate
+
+
+class BandwidthLimiter:
+
+	"""
+	Limit the bytes per second OneDriveAPI transfers, in total and per direction.
+
+	The limits can change by time of day following a schedule, a list of dicts
+	like {'start': '09:00', 'end': '18:00', 'upload': 131072}. Keys 'total',
+	'upload' and 'download' missing from an item keep the default limits. A
+	window that ends before it starts spans midnight.
+
+	File content waits for the limiter. Metadata responses are only charged,
+	so they are never delayed and bulk transfers give way to them instead.
+	"""
+
+	UPLOAD = 'upload'
+	DOWNLOAD = 'download'
+	# how often the schedule is checked, in seconds
+	SCHEDULE_CHECK_INTERVAL = 60
+
+	def __init__(self, total=0, upload=0, download=0, schedule=None):
+		self.default_limits = {'total': total, 'upload': upload, 'download': download}
+		self.schedule = schedule or []
+		self.buckets = {'total': TokenBucket(), 'upload': TokenBucket(), 'download': TokenBucket()}
+		self.next_check_time = 0
+		self.lock = threading.Lock()
+		self.update_limits()
+
+	def get_limits(self, minute_of_day):
+		limits = dict(self.default_limits)
+		for item in self.schedule:
+			start_hour, start_minute = item['start'].split(':')
+			end_hour, end_minute = item['end'].split(':')
+			start = int(start_hour) * 60 + int(start_minute)
+			end = int(end_hour) * 60 + int(end_minute)
+			if start <= minute_of_day < end or (end < start and (minute_of_day >= start or minute_of_day < end)):
+				for key in limits:
+					if key in item:
+						limits[key] = item[key]
+		return limits
+
+	def update_limits(self):
+		with self.lock:
+			if time.monotonic() < self.next_check_time:
+				return
+			self.next_check_time = time.monotonic() + BandwidthLimiter.SCHEDULE_CHECK_INTERVAL
+		t = time.localtime()
+		limits = self.get_limits(t.tm_hour * 60 + t.tm_min)
+		for key, bucket in self.buckets.items():
+			if bucket.rate != limits[key]:
+				bucket.set_rate(limits[key])
+
+	def is_limited(self, direction):
+		self.update_limits()
+		return bool(self.buckets['total'].rate or self.buckets[direction].rate)
+
+	def reserve(self, direction, num_bytes):
+		"""
+		Return the number of seconds to wait before sending num_bytes in direction.
+		"""
+		self.update_limits()
+		return max(self.buckets['total'].reserve(num_bytes), self.buckets[direction].reserve(num_bytes))
+
+	def consume(self, direction, num_bytes):
+		"""
+		Block until num_bytes may be sent in direction.
+		"""
+		delay = self.reserve(direction, num_bytes)
+		if delay > 0:
+			sleep(delay)
+
+	def charge(self, direction, num_bytes):
+		"""
+		Count num_bytes that were sent without waiting.
+		"""
+		self.reserve(direction, num_bytes)
+
+
+class ThrottledReader:
+
+	"""
+	A request body that waits for the bandwidth limiter before every block
+	http.client reads from it.
+
+	@param data: a bytes-like object, or a file object positioned at the start
+		of the data to send.
+	@param hasher: a ContentHasher to feed the bytes read to.
+	"""
+
+	def __init__(self, data, limiter, direction=BandwidthLimiter.UPLOAD, hasher=None):
+		self.limiter = limiter
+		self.direction = direction
+		self.hasher = hasher
+		if hasattr(data, 'read'):
+			self.file = data
+			self.start = data.tell()
+			self.length = os.fstat(data.fileno()).st_size - self.start
+		else:
+			self.file = None
+			self.view = memoryview(data).cast('B')
+			self.length = len(self.view)
+		self.pos = 0
+
+	def __len__(self):
+		return self.length - self.pos
+
+	def __iter__(self):
+		while True:
+			chunk = self.read(OneDriveAPI.STREAM_CHUNK_SIZE)
+			if len(chunk) == 0:
+				return
+			yield chunk
+
+	def seek(self, pos):
+		self.pos = pos
+		if self.file is not None:
+			self.file.seek(self.start + pos)
+
+	def read(self, size=-1):
+		if size < 0 or size > self.length - self.pos:
+			size = self.length - self.pos
+		if self.file is not None:
+			chunk = self.file.read(size)
+		else:
+			chunk = bytes(self.view[self.pos:self.pos + size])
+		if self.hasher is not None:
+			self.hasher.update(self.pos, chunk)
+		self.pos += len(chunk)
+		self.limiter.consume(self.direction, len(chunk))
+		return chunk
+
+
+class AdaptiveBlockSize:
+
+	"""
+	Size transfer blocks after the measured throughput. The size doubles while
+	blocks finish quickly, and halves when they are slow or fail, staying
+	within [min_size, max_size]. Safe to share among threads.
+	"""
+
+	# a block that takes about this many seconds is considered right-sized
+	TARGET_SECONDS = 2.0
+
+	def __init__(self, size, min_size=None, max_size=None):
+		self.min_size = size if min_size is None else min_size
+		self.max_size = size if max_size is None else max_size
+		self.size = min(max(size, self.min_size), self.max_size)
+		self.lock = threading.Lock()
+
+	def get(self):
+		return self.size
+
+	def set(self, size):
+		with self.lock:
+			self.size = min(max(size, self.min_size), self.max_size)
+
+	def on_success(self, num_bytes, seconds):
+		if num_bytes < self.size:
+			# a short tail block says nothing about the link
+			return
+		if seconds < AdaptiveBlockSize.TARGET_SECONDS / 2:
+			self.set(self.size * 2)
+		elif seconds > AdaptiveBlockSize.TARGET_SECONDS * 2:
+			self.set(self.size // 2)
+
+	def on_failure(self):
+		self.set(self.size // 2)
+
+
+class ContentHasher:
+
+	"""
+	Compute the SHA-1 of a file from the bytes a transfer moves anyway, so
+	that the file is not read again to hash it. Safe to share among threads.
+
+	Bytes are fed with their offsets in the file. Bytes fed again, e.g., by a
+	retry, are skipped. Bytes after a gap, e.g., from a range that finished
+	early, are kept until the gap is filled, up to max_pending bytes; past
+	that the hash is given up.
+	"""
+
+	def __init__(self, max_pending=33554432):
+		self.max_pending = max_pending
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		"""
+		Forget the bytes fed so far, e.g., when a download starts over.
+		"""
+		with self.lock:
+			self.sha1 = hashlib.sha1()
+			# the bytes before it are hashed
+			self.offset = 0
+			self.pending = {}
+			self.num_pending_bytes = 0
+			self.is_broken = False
+
+	def update(self, offset, data):
+		with self.lock:
+			if self.is_broken or offset + len(data) <= self.offset:
+				return
+			if offset > self.offset:
+				if offset in self.pending:
+					if len(self.pending[offset]) >= len(data):
+						return
+					self.num_pending_bytes -= len(self.pending[offset])
+				self.num_pending_bytes += len(data)
+				if self.num_pending_bytes > self.max_pending:
+					self.is_broken = True
+					self.pending = {}
+					return
+				# data may be a view of a buffer that is reused
+				self.pending[offset] = bytes(data)
+				return
+			self.sha1.update(data[self.offset - offset:])
+			self.offset = offset + len(data)
+			while True:
+				ready = [o for o in self.pending if o <= self.offset]
+				if len(ready) == 0:
+					break
+				for o in ready:
+					chunk = self.pending.pop(o)
+					self.num_pending_bytes -= len(chunk)
+					if o + len(chunk) > self.offset:
+						self.sha1.update(chunk[self.offset - o:])
+						self.offset = o + len(chunk)
+
+	def get_hexdigest(self, size):
+		"""
+		Return the SHA-1 hex digest if exactly bytes 0 to size - 1 were fed, or None.
+		"""
+		with self.lock:
+			if self.is_broken or self.offset != size:
+				return None
+			return self.sha1.hexdigest()
+
+
+def parse_retry_after(value):
+	"""
+	Return the number of seconds a Retry-After header value asks to wait, or
+	None if it is missing or malformed. The value can be seconds or an HTTP date.
+	"""
+	if value is None:
+		return None
+	try:
+		return float(value)
+	except ValueError:
+		try:
+			return max(0, (email.utils.parsedate_to_datetime(value) - od_glob.now()).total_seconds())
+		except (TypeError, ValueError):
+			return None
+
+
+def parse_content_range(value, range_from, range_to):
+	"""
+	Return the first and the last byte offsets of a Content-Range header value,
+	e.g., 'bytes 12582912-12927920/12927921', or None if it is malformed or is
+	not a part of bytes range_from to range_to that starts at range_from.
+	"""
+	try:
+		range_unit, range_str = value.split(' ')
+		range_range, range_total = range_str.split('/')
+		block_from, block_to = range_range.split('-')
+		block_from, block_to = int(block_from), int(block_to)
+	except ValueError:
+		return None
+	if block_from != range_from or block_to < block_from or block_to > range_to:
+		return None
+	return block_from, block_to
+
+
+class RetryPolicy:
+
+	"""
+	Decide whether and when to retry a failed API call. Rules by error class:
+
+	 * OneDriveAuthError: refresh the token once per call and retry at once.
+	 * ConnectionError: the network is down. Wait until the thread manager
+	   sees it back. Only the call deadline limits these retries.
+	 * OneDriveThrottledError: wait as long as the server's Retry-After asks.
+	 * OneDriveServerInternalError: wait with exponential backoff and full jitter.
+	 * Other errors are not retried.
+
+	Throttled and server errors are retried at most max_attempts times per call
+	and only while the shared retry budget lasts. Every successful call earns
+	budget_ratio of a retry, so a failing service sees a bounded fraction of
+	extra requests instead of a retry storm.
+	"""
+
+	def __init__(self, base_delay, max_delay, max_attempts, deadline=None, budget_ratio=0.2, budget_min=10):
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.max_attempts = max_attempts
+		self.deadline = deadline
+		self.budget_ratio = budget_ratio
+		self.budget_max = budget_min
+		self.budget = budget_min
+		# counters of calls, for whoever watches the health of the service
+		self.num_successes = 0
+		self.num_errors = 0
+		self.lock = threading.Lock()
+
+	def get_delay(self, num_retries, retry_after=None):
+		if retry_after is not None:
+			return min(retry_after, self.max_delay)
+		return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** num_retries))
+
+	def is_past_deadline(self, start_time, delay=0):
+		return self.deadline is not None and time.monotonic() + delay - start_time > self.deadline
+
+	def get_time_left(self, start_time):
+		"""
+		Return the seconds left before the deadline of a call, or None if there is no deadline.
+		"""
+		if self.deadline is None:
+			return None
+		return max(0, self.deadline - (time.monotonic() - start_time))
+
+	def acquire_retry(self):
+		"""
+		Take one retry from the budget. Return False if the budget is used up.
+		"""
+		with self.lock:
+			if self.budget < 1:
+				return False
+			self.budget -= 1
+			return True
+
+	def on_success(self):
+		with self.lock:
+			self.num_successes += 1
+			self.budget = min(self.budget_max, self.budget + self.budget_ratio)
+
+	def on_error(self):
+		"""
+		Count an attempt that was throttled or failed on the server.
+		"""
+		with self.lock:
+			self.num_errors += 1
+
+	def get_retry_delay(self, error, num_retries, start_time):
+		"""
+		Count a throttled or server error of a call and decide whether to retry it.
+
+		@param num_retries: the number of retries the call has had so far.
+		@param start_time: the time.monotonic() when the call started.
+		@return the seconds to wait before the retry, or None to give up.
+		"""
+		self.on_error()
+		delay = self.get_delay(num_retries, getattr(error, 'retry_after', None))
+		if num_retries >= self.max_attempts or self.is_past_deadline(start_time, delay) or not self.acquire_retry():
+			return None
+		return delay
+
+
+class MetadataCache:
+
+	"""
+	A bounded LRU cache of remote metadata shared among threads.
+
+	Each item is stored with a validator, the remote updated_time it was read
+	at, and expires after ttl seconds. Capacity is counted in entries, so a
+	folder listing weighs as much as the number of its children.
+	"""
+
+	def __init__(self, capacity, ttl):
+		self.capacity = capacity
+		self.ttl = ttl
+		self.items = collections.OrderedDict()
+		self.weight = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def get(self, key, validator=None):
+		"""
+		Return the cached value, or None if it is missing, expired, or (when
+		validator is given) read at a different updated_time.
+		"""
+		with self.lock:
+			item = self.items.get(key)
+			if item is not None:
+				value, item_validator, weight, expire_time = item
+				if expire_time < time.monotonic() or (validator is not None and validator != item_validator):
+					del self.items[key]
+					self.weight -= weight
+				else:
+					self.items.move_to_end(key)
+					self.hits += 1
+					return value
+			self.misses += 1
+			return None
+
+	def has(self, key):
+		with self.lock:
+			return key in self.items
+
+	def put(self, key, value, validator=None, weight=1):
+		if weight > self.capacity:
+			return
+		with self.lock:
+			if key in self.items:
+				self.weight -= self.items.pop(key)[2]
+			self.items[key] = (value, validator, weight, time.monotonic() + self.ttl)
+			self.weight += weight
+			while self.weight > self.capacity:
+				self.weight -= self.items.popitem(last=False)[1][2]
+
+	def invalidate(self, key):
+		with self.lock:
+			if key in self.items:
+				self.weight -= self.items.pop(key)[2]
+
+
 class OneDriveAPI:
 
 	CLIENT_SCOPE = ['wl.skydrive', 'wl.skydrive_update', 'wl.offline_access']
@@ -88,9 +567,19 @@ class OneDriveAPI:
 	OAUTH_TOKEN_URI = 'https://login.live.com/oauth20_token.srf'
 	OAUTH_SIGNOUT_URI = 'https://login.live.com/oauth20_logout.srf'
 	API_URI = 'https://apis.live.net/v5.0/'
+	# formatted with the user id
+	BITS_URI = 'https://cid-{0}.users.storage.live.com/'
 	FOLDER_TYPES = ['folder', 'album']
 	UNSUPPORTED_TYPES = ['notebook']
 	ROOT_ENTRY_ID = 'me/skydrive'
+	# bytes to hold in memory at a time when streaming content
+	STREAM_CHUNK_SIZE = 65536
+	# number of downloaded blocks to flush to disk before saving the cursor
+	COMMIT_BLOCKS = 8
+	# number of entries to request per page when listing a folder
+	LIST_PAGE_SIZE = 500
+	# number of hosts to keep connection pools for (API, login, and storage hosts)
+	POOL_HOSTS = 8
 
 	logger = od_glob.get_logger()
 	threadman = od_thread_manager.get_instance()
@@ -98,32 +587,219 @@ class OneDriveAPI:
 	def __init__(self, client_id, client_secret, client_scope=CLIENT_SCOPE, redirect_uri=REDIRECT_URI):
 		self.client_access_token = None
 		self.client_refresh_token = None
+		# monotonic time when the access token expires, if known
+		self.token_expire_time = None
+		# incremented every time the access token is refreshed
+		self.token_generation = 0
+		self.token_lock = threading.Lock()
 		self.client_id = client_id
 		self.client_secret = client_secret
 		self.client_scope = client_scope
 		self.client_redirect_uri = redirect_uri
 		self.http_client = requests.Session()
+		# every worker may have BITS_DOWNLOAD_RANGES requests in flight to one host
+		config = od_glob.get_config_instance()
+		self.http_adapter = HTTPAdapter(pool_connections=OneDriveAPI.POOL_HOSTS,
+			pool_maxsize=config.params['NUM_OF_WORKERS'] * max(1, config.params['BITS_DOWNLOAD_RANGES']))
+		self.http_client.mount('https://', self.http_adapter)
+		self.http_client.mount('http://', self.http_adapter)
+		self.metadata_cache = MetadataCache(config.params['METADATA_CACHE_SIZE'], config.params['METADATA_CACHE_TTL'])
+		self.retry_policy = RetryPolicy(config.params['RETRY_BASE_DELAY'], config.params['RETRY_MAX_DELAY'],
+			config.params['RETRY_MAX_ATTEMPTS'], config.params['API_CALL_DEADLINE'])
+		self.token_refresh_margin = config.params['TOKEN_REFRESH_MARGIN']
+		self.bandwidth = BandwidthLimiter(config.params['BANDWIDTH_LIMIT'], config.params['UPLOAD_LIMIT'],
+			config.params['DOWNLOAD_LIMIT'], config.params['BANDWIDTH_SCHEDULE'])
+
+	def check_throttling(self, response):
+		"""
+		Raise OneDriveThrottledError if the server asks us to slow down.
+		"""
+		if response.status_code == requests.codes.too_many_requests or \
+				response.status_code == requests.codes.service_unavailable:
+			retry_after = parse_retry_after(response.headers.get('retry-after'))
+			response.close()
+			raise OneDriveThrottledError(
+				{'error': 'throttled', 'error_description': 'HTTP ' + str(response.status_code)}, retry_after)
 
 	def parse_response(self, request, error, ok_status=requests.codes.ok):
-		ret = request.json()
-		if request.status_code != ok_status:
-			if 'code' in ret['error']:
+		"""
+		@param ok_status: the expected HTTP status code, or a tuple of them.
+		"""
+		self.check_throttling(request)
+		# metadata is small and goes first; bulk transfers make up for it
+		self.bandwidth.charge(BandwidthLimiter.DOWNLOAD, len(request.content))
+		return self.parse_body(request.status_code, request.content, error, ok_status)
+
+	def parse_body(self, status_code, body, error, ok_status=requests.codes.ok):
+		"""
+		Return the JSON object in the body of a response, or raise the error it tells.
+
+		@param body: the body as bytes.
+		@param ok_status: the expected HTTP status code, or a tuple of them.
+		"""
+		if isinstance(ok_status, int):
+			ok_status = (ok_status, )
+		try:
+			ret = json.loads(body.decode('utf-8'))
+		except ValueError:
+			ret = None
+		if not isinstance(ret, dict):
+			# not a JSON body, e.g., an error page of a proxy
+			ret = {'error': {'code': 'invalid_response', 'message': 'HTTP ' + str(status_code)}}
+		if status_code not in ok_status or 'error' in ret:
+			if isinstance(ret.get('error'), dict) and 'code' in ret['error']:
 				if ret['error']['code'] == 'request_token_expired':
 					raise OneDriveAuthError(ret)
 				elif ret['error']['code'] == 'server_internal_error':
 					raise OneDriveServerInternalError(ret)
+			if status_code >= 500:
+				raise OneDriveServerInternalError(ret)
 			raise error(ret)
 		return ret
 
-	def auto_recover_auth_error(self):
+	def call_with_retry(self, attempt, recover_auth=True, on_retry=None):
+		"""
+		Call attempt(), which sends one request and handles its response, until
+		it returns. Failures are retried according to the rules of RetryPolicy;
+		when the policy gives up, the last error is raised.
+
+		@param recover_auth: whether to refresh the access token on auth errors.
+		@param on_retry: called with the error before every retry.
+		"""
+		policy = self.retry_policy
+		start_time = time.monotonic()
+		num_retries = 0
+		auth_recovered = False
+		while True:
+			if recover_auth:
+				self.refresh_expiring_token()
+			# the token the attempt is sent with
+			token_generation = self.token_generation
+			try:
+				ret = attempt()
+				policy.on_success()
+				return ret
+			except OneDriveAuthError:
+				if not recover_auth or auth_recovered:
+					raise
+				auth_recovered = True
+				self.auto_recover_auth_error(token_generation)
+			except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+				if policy.is_past_deadline(start_time):
+					raise
+				self.logger.info('network connection error.')
+				if on_retry is not None:
+					on_retry(e)
+				if not self.threadman.hang_caller(policy.get_time_left(start_time)):
+					raise
+			except (OneDriveThrottledError, OneDriveServerInternalError) as e:
+				delay = policy.get_retry_delay(e, num_retries, start_time)
+				if delay is None:
+					raise
+				num_retries += 1
+				self.logger.warning('%s %s. Retry in %.1f seconds.', type(e).__name__, e, delay)
+				if on_retry is not None:
+					on_retry(e)
+				sleep(delay)
+
+	def auto_recover_auth_error(self, token_generation=None):
 		"""
 		Note that this function still throws exceptions.
+
+		@param token_generation: the token_generation the failed request was sent
+			with. If another thread has refreshed the token since, it is not
+			refreshed again. If None, the token is always refreshed.
+		"""
+		with self.token_lock:
+			if token_generation is not None and token_generation != self.token_generation:
+				# the refresh this thread waited on has already got a new token
+				return
+			if self.client_refresh_token is None:
+				raise OneDriveAuthError()
+			refreshed_token_set = self.refresh_token(self.client_refresh_token)
+			od_glob.get_config_instance().set_access_token(refreshed_token_set)
+			self.logger.info('auto refreshed API token in face of auth error.')
+
+	def is_token_expiring(self):
+		return self.token_expire_time is not None and self.client_refresh_token is not None and \
+			time.monotonic() + self.token_refresh_margin >= self.token_expire_time
+
+	def refresh_expiring_token(self):
+		"""
+		Refresh the access token if it expires within token_refresh_margin seconds.
+		"""
+		if not self.is_token_expiring():
+			return
+		token_generation = self.token_generation
+		with self.token_lock:
+			if token_generation != self.token_generation:
+				return
+			self.logger.info('access token expires soon. Refresh it.')
+			refreshed_token_set = self.refresh_token(self.client_refresh_token)
+			od_glob.get_config_instance().set_access_token(refreshed_token_set)
+
+	def throttle_upload(self, data, hasher=None):
+		"""
+		Return a request body that sends data within the upload limit.
+
+		@param hasher: a ContentHasher to feed the bytes sent to.
+		"""
+		if data is None or (hasher is None and not self.bandwidth.is_limited(BandwidthLimiter.UPLOAD)):
+			return data
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		return ThrottledReader(data, self.bandwidth, BandwidthLimiter.UPLOAD, hasher)
+
+	def iter_throttled_content(self, response, chunk_size=STREAM_CHUNK_SIZE):
 		"""
-		if self.client_refresh_token is None:
-			raise OneDriveAuthError()
-		refreshed_token_set = self.refresh_token(self.client_refresh_token)
-		od_glob.get_config_instance().set_access_token(refreshed_token_set)
-		self.logger.info('auto refreshed API token in face of auth error.')
+		Yield the body of a streamed response by chunks within the download limit.
+		"""
+		for chunk in response.iter_content(chunk_size):
+			self.bandwidth.consume(BandwidthLimiter.DOWNLOAD, len(chunk))
+			yield chunk
+
+	def get_connection_stats(self):
+		"""
+		Return counters of the HTTP connection pools. Every request that did
+		not open a new connection reused a kept-alive one and saved a handshake.
+		"""
+		num_requests = 0
+		num_connections = 0
+		pools = self.http_adapter.poolmanager.pools
+		for key in pools.keys():
+			pool = pools.get(key)
+			if pool is not None:
+				num_requests += pool.num_requests
+				num_connections += pool.num_connections
+		return {
+			'requests': num_requests,
+			'new_connections': num_connections,
+			'reused_connections': num_requests - num_connections
+		}
+
+	def forget_entry(self, entry_id, folder_id=None):
+		"""
+		Drop cached metadata of an entry we are changing, and the listing of the
+		folder that contains it.
+
+		Callers forget the entry both before and after the request that changes
+		it, as a concurrent read may cache the old state in between.
+
+		@return the id of the folder, if known, to pass to the second call.
+		"""
+		if folder_id is None:
+			prop = self.metadata_cache.get(('prop', entry_id))
+			if prop is not None:
+				folder_id = prop['parent_id']
+		self.metadata_cache.invalidate(('prop', entry_id))
+		self.metadata_cache.invalidate(('list', entry_id, 'files'))
+		if folder_id is not None:
+			self.forget_listing(folder_id)
+		return folder_id
+
+	def forget_listing(self, folder_id):
+		self.metadata_cache.invalidate(('prop', folder_id))
+		self.metadata_cache.invalidate(('list', folder_id, 'files'))
 
 	def get_auth_uri(self, display='touch', locale='en', state=''):
 		"""
@@ -150,9 +826,15 @@ class OneDriveAPI:
 	def set_user_id(self, id):
 		self.user_id = id
 
-	def set_access_token(self, token):
+	def set_access_token(self, token, expires_in=None):
+		"""
+		@param expires_in: number of seconds the token is valid for, if known.
+		"""
 		self.client_access_token = token
 		self.http_client.headers.update({'Authorization': 'Bearer ' + token})
+		if expires_in is not None:
+			self.token_expire_time = time.monotonic() + expires_in
+		self.token_generation += 1
 
 	def set_refresh_token(self, token):
 		self.client_refresh_token = token
@@ -180,18 +862,14 @@ class OneDriveAPI:
 			"grant_type": "authorization_code"
 		}
 
-		try:
-			request = requests.post(
-				OneDriveAPI.OAUTH_TOKEN_URI, data=params, verify=False)
-			response = self.parse_response(request, OneDriveAPIException)
-			self.set_access_token(response['access_token'])
-			self.set_refresh_token(response['refresh_token'])
-			self.set_user_id(response['user_id'])
-			return response
-		except requests.exceptions.ConnectionError:
-			self.logger.info('network connection error.')
-			self.threadman.hang_caller()
-			return self.get_access_token(code, uri)
+		# do not send the old access token to the login server
+		response = self.call_with_retry(lambda: self.parse_response(self.http_client.post(
+			OneDriveAPI.OAUTH_TOKEN_URI, data=params, headers={'Authorization': None}, verify=False),
+			OneDriveAPIException), recover_auth=False)
+		self.set_access_token(response['access_token'], response.get('expires_in'))
+		self.set_refresh_token(response['refresh_token'])
+		self.set_user_id(response['user_id'])
+		return response
 
 	def refresh_token(self, token):
 		params = {
@@ -201,57 +879,42 @@ class OneDriveAPI:
 			"refresh_token": token,
 			"grant_type": 'refresh_token'
 		}
-		while True:
-			try:
-				request = requests.post(OneDriveAPI.OAUTH_TOKEN_URI, data=params)
-				response = self.parse_response(request, OneDriveAPIException)
-				self.set_access_token(response['access_token'])
-				self.set_refresh_token(response['refresh_token'])
-				self.set_user_id(response['user_id'])
-				return response
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
+		response = self.call_with_retry(lambda: self.parse_response(self.http_client.post(
+			OneDriveAPI.OAUTH_TOKEN_URI, data=params, headers={'Authorization': None}),
+			OneDriveAPIException), recover_auth=False)
+		self.set_access_token(response['access_token'], response.get('expires_in'))
+		self.set_refresh_token(response['refresh_token'])
+		self.set_user_id(response['user_id'])
+		return response
 
 	def sign_out(self):
-		while True:
-			try:
-				r = self.http_client.get(OneDriveAPI.OAUTH_SIGNOUT_URI + '?client_id=' + self.client_id + '&redirect_uri=' + self.client_redirect_uri)
-				return self.parse_response(r, OneDriveAuthError)
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
+		return self.call_with_retry(lambda: self.parse_response(self.http_client.get(
+			OneDriveAPI.OAUTH_SIGNOUT_URI + '?client_id=' + self.client_id + '&redirect_uri=' + self.client_redirect_uri),
+			OneDriveAuthError))
 
 	def get_recent_docs(self):
 		raise NotImplementedError('get_recent_docs is not implemented.')
 
 	def get_quota(self, user_id='me'):
-		while True:
-			try:
-				r = self.http_client.get(OneDriveAPI.API_URI + user_id + '/skydrive/quota')
-				return self.parse_response(r, OneDriveAPIException)
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
+		return self.call_with_retry(lambda: self.parse_response(self.http_client.get(
+			OneDriveAPI.API_URI + user_id + '/skydrive/quota'), OneDriveAPIException))
 
 	def get_root_entry_name(self):
 		return self.ROOT_ENTRY_ID
 
-	def get_property(self, entry_id='me/skydrive'):
-		try:
-			r = self.http_client.get(OneDriveAPI.API_URI + entry_id)
-			return self.parse_response(r, OneDriveAPIException)
-		except OneDriveAuthError:
-			self.auto_recover_auth_error()
-			return self.get_property(entry_id)
-		except requests.exceptions.ConnectionError:
-			self.logger.info('network connection error.')
-			self.threadman.hang_caller()
-			return self.get_property(entry_id)
+	def get_property(self, entry_id='me/skydrive', use_cache=True):
+		"""
+		@param use_cache: return the cached property of the entry if it has not expired.
+		"""
+		key = ('prop', entry_id)
+		if use_cache:
+			ret = self.metadata_cache.get(key)
+			if ret is not None:
+				return ret
+		ret = self.call_with_retry(lambda: self.parse_response(self.http_client.get(
+			OneDriveAPI.API_URI + entry_id), OneDriveAPIException))
+		self.metadata_cache.put(key, ret, ret.get('updated_time'))
+		return ret
 
 	def set_property(self, entry_id, **kwargs):
 		"""
@@ -263,16 +926,12 @@ class OneDriveAPI:
 		headers = {
 			'Content-Type': 'application/json',
 		}
-		while True:
-			try:
-				r = self.http_client.put(
-					OneDriveAPI.API_URI + entry_id, data=json.dumps(kwargs), headers=headers)
-				return self.parse_response(r, OneDriveAPIException)
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
+		folder_id = self.forget_entry(entry_id)
+		try:
+			return self.call_with_retry(lambda: self.parse_response(self.http_client.put(
+				OneDriveAPI.API_URI + entry_id, data=json.dumps(kwargs), headers=headers), OneDriveAPIException))
+		finally:
+			self.forget_entry(entry_id, folder_id)
 
 	def get_link(self, entry_id, type='r'):
 		"""
@@ -286,32 +945,59 @@ class OneDriveAPI:
 		else:
 			type = 'embed'
 
-		while True:
-			try:
-				r = self.http_client.get(OneDriveAPI.API_URI + entry_id + '/' + type)
-				return self.parse_response(r, OneDriveAPIException)['source']
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
+		return self.call_with_retry(lambda: self.parse_response(self.http_client.get(
+			OneDriveAPI.API_URI + entry_id + '/' + type), OneDriveAPIException))['source']
 
-	def list_entries(self, folder_id='me/skydrive', type='files'):
+	def list_entries(self, folder_id='me/skydrive', type='files', limit=None, offset=0):
 		"""
 		@param type: 'files' (default) for all files. 'shared' for shared files (used internally).
+		@param limit: if given, return at most limit entries starting from offset.
 		"""
+		if limit is not None:
+			params = {'limit': limit, 'offset': offset}
+		else:
+			params = None
+		return self.call_with_retry(lambda: self.parse_response(self.http_client.get(
+			OneDriveAPI.API_URI + folder_id + '/' + type, params=params), OneDriveAPIException))['data']
+
+	def iter_entries(self, folder_id='me/skydrive', type='files', page_size=None, updated_time=None):
+		"""
+		Yield the entries of a folder page by page, so that only one page of a
+		huge folder is held in memory at a time.
+
+		A cached listing is used if the folder was not updated since it was read.
+		@param updated_time: the folder's current updated_time if the caller knows
+			it, e.g., from the listing of its parent. Otherwise it is requested.
+		"""
+		key = ('list', folder_id, type)
+		entries = None
+		if updated_time is None and self.metadata_cache.has(key):
+			updated_time = self.get_property(folder_id, use_cache=False).get('updated_time')
+		if updated_time is not None:
+			entries = self.metadata_cache.get(key, updated_time)
+		if entries is not None:
+			for entry in entries:
+				yield entry
+			return
+		if page_size is None:
+			page_size = OneDriveAPI.LIST_PAGE_SIZE
+		# huge listings are not kept so as not to flush the whole cache
+		max_cached = self.metadata_cache.capacity // 8
+		entries = []
+		offset = 0
 		while True:
-			try:
-				r = self.http_client.get(OneDriveAPI.API_URI + folder_id + '/' + type)
-				return self.parse_response(r, OneDriveAPIException)['data']
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
-			except OneDriveServerInternalError as e:
-				self.logger.error(e)
-				self.threadman.hang_caller()
+			page = self.list_entries(folder_id, type, limit=page_size, offset=offset)
+			if entries is not None:
+				entries.extend(page)
+				if len(entries) > max_cached:
+					entries = None
+			for entry in page:
+				yield entry
+			if len(page) < page_size:
+				break
+			offset += len(page)
+		if entries is not None:
+			self.metadata_cache.put(key, entries, updated_time, max(1, len(entries)))
 
 	def list_shared_entries(self, user_id='me'):
 		return self.list_entries(user_id + '/skydrive', 'shared')
@@ -322,15 +1008,12 @@ class OneDriveAPI:
 		data = {'name': folder_name}
 		headers = {'Content-Type': 'application/json'}
 		uri = OneDriveAPI.API_URI + parent_id
-		while True:
-			try:
-				r = self.http_client.post(uri, data=json.dumps(data), headers=headers)
-				return self.parse_response(r, OneDriveAPIException, requests.codes.created)
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
+		self.forget_listing(parent_id)
+		try:
+			return self.call_with_retry(lambda: self.parse_response(self.http_client.post(
+				uri, data=json.dumps(data), headers=headers), OneDriveAPIException, requests.codes.created))
+		finally:
+			self.forget_listing(parent_id)
 
 	def cp(self, target_id, dest_folder_id, overwrite=True, type='COPY'):
 		"""
@@ -347,23 +1030,88 @@ class OneDriveAPI:
 		uri = OneDriveAPI.API_URI + target_id + '?overwrite=' + str(overwrite)
 		req = requests.Request(
 			type, uri, data=json.dumps(data), headers=headers).prepare()
-		while True:
-			try:
-				r = self.http_client.send(req)
-				return self.parse_response(r, OneDriveAPIException, requests.codes.created)
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
-			except OneDriveServerInternalError as e:
-				self.logger.error(e)
-				self.threadman.hang_caller()
+		if type == 'MOVE':
+			folder_id = self.forget_entry(target_id)
+		self.forget_listing(dest_folder_id)
+		try:
+			return self.call_with_retry(lambda: self.parse_response(self.http_client.send(req),
+				OneDriveAPIException, requests.codes.created))
+		finally:
+			if type == 'MOVE':
+				self.forget_entry(target_id, folder_id)
+			self.forget_listing(dest_folder_id)
 
 	def mv(self, target_id, dest_folder_id, overwrite=True):
 		return self.cp(target_id, dest_folder_id, overwrite, 'MOVE')
 
-	def bits_put(self, name, folder_id, local_path=None, block_size=1048576):
+	def get_bits_url(self, name, folder_id):
+		"""
+		Return the BITS upload URL of file name in folder folder_id, or None if
+		folder_id is invalid.
+		"""
+		if '!' in folder_id:
+			# subfolder
+			bits_folder_id = folder_id.split('.')[-1]
+			return OneDriveAPI.BITS_URI.format(self.user_id) + "items/" + bits_folder_id + "/" + name
+		elif folder_id != '':
+			# root folder
+			user_id = folder_id.split('.')[-1]
+			return OneDriveAPI.BITS_URI.format(user_id) + "users/0x" + user_id + "/LiveFolders/" + name
+		# elif remote_path is not None:
+		# 	url = "https://cid-" + user_id + ".users.storage.live.com/users/0x" + user_id + "/LiveFolders/" + remote_path
+		return None
+
+	def bits_create_session(self, url, local_path):
+		"""
+		Send a BITS Create-Session request to url.
+
+		@return the session id, or None if the server refuses.
+		"""
+		headers = {
+			'X-Http-Method-Override': 'BITS_POST',
+			'Content-Length': '0',
+			'BITS-Packet-Type': 'Create-Session',
+			'BITS-Supported-Protocols': '{7df0354d-249b-430f-820d-3d2a9bef4931}'
+		}
+		self.logger.debug('getting session token for BITS upload...')
+
+		def attempt():
+			response = self.http_client.request('post', url, headers=headers)
+			self.check_throttling(response)
+			if response.status_code != 201:
+				if 'www-authenticate' in response.headers and 'invalid_token' in response.headers['www-authenticate']:
+					response.close()
+					raise OneDriveAuthError()
+				else:
+					# unknown error should be further analyzed
+					self.logger.debug("failed BITS Create-Session request to upload \"%s\". HTTP %d.", local_path, response.status_code)
+					self.logger.debug(response.headers)
+					response.close()
+					return None
+			session_id = response.headers['bits-session-id']
+			response.close()
+			return session_id
+
+		return self.call_with_retry(attempt)
+
+	def bits_read_fragment(self, fd, buf, offset, length, source_size):
+		"""
+		Read at most length bytes of the file from offset into buf, without
+		allocating a new object for the data.
+
+		@return a tuple (offset, memoryview of the bytes read).
+		"""
+		view = memoryview(buf)[:min(length, source_size - offset)]
+		count = 0
+		while count < len(view):
+			n = os.preadv(fd, [view[count:]], offset + count)
+			if n == 0:
+				break
+			count += n
+		return offset, view[:count]
+
+	def bits_put(self, name, folder_id, local_path=None, block_size=1048576, session=None, on_session=None,
+			min_block_size=None, max_block_size=None, hasher=None):
 		"""
 		Upload a large file with Microsoft BITS API.
 		A detailed document: https://gist.github.com/rgregg/37ba8929768a62131e85
@@ -373,6 +1121,16 @@ class OneDriveAPI:
 		@param folder_id: the folder_id returned by Live API
 		@param local_path: the local path of the file to upload
 		@param remote_path (X): the remote path to put the file.
+		@param session: a dict with keys 'session_id', 'url' and 'cursor' saved from
+			an unfinished upload of the same file. The upload continues from 'cursor'
+			if the server still accepts the session; otherwise a new session starts.
+		@param on_session: called with (session_id, url, cursor) after a session is
+			created and after every fragment the server confirms.
+		@param min_block_size, max_block_size: if given, the fragment size starts
+			at block_size and adapts to the measured throughput within the bounds.
+		@param hasher: a ContentHasher to feed every fragment the server takes to.
+			A reattached session does not send the bytes before its cursor, so
+			they are only fed if the session has to start over.
 
 		@return None if an unrecoverable error occurs; or a file property dict.
 		"""
@@ -384,108 +1142,115 @@ class OneDriveAPI:
 			self.logger.error("cannot get file size of \"" + local_path + "\"")
 			return None
 
-		# produce request url
-		if '!' in folder_id:
-			# subfolder
-			bits_folder_id = folder_id.split('.')[-1]
-			url = "https://cid-" + self.user_id + \
-				".users.storage.live.com/items/" + bits_folder_id + "/" + name
-		elif folder_id != '':
-			# root folder
-			user_id = folder_id.split('.')[-1]
-			url = "https://cid-" + user_id + \
-				".users.storage.live.com/users/0x" + user_id + "/LiveFolders/" + name
-		# elif remote_path is not None:
-		# 	url = "https://cid-" + user_id + ".users.storage.live.com/users/0x" + user_id + "/LiveFolders/" + remote_path
-		else:
+		url = self.get_bits_url(name, folder_id)
+		if url is None:
 			self.logger.error("cannot request BITS. folder_id is invalid.")
 			return None
 
-		# force refresh access token to get largest expiration time
-		try:
-			self.auto_recover_auth_error()
-		except Exception as e:
-			self.logger.error(e)
-			return None
-
-		# BITS: Create-Session
-		headers = {
-			'X-Http-Method-Override': 'BITS_POST',
-			'Content-Length': 0,
-			'BITS-Packet-Type': 'Create-Session',
-			'BITS-Supported-Protocols': '{7df0354d-249b-430f-820d-3d2a9bef4931}'
-		}
-		self.logger.debug('getting session token for BITS upload...')
-		while True:
-			try:
-				response = self.http_client.request('post', url, headers=headers)
-				if response.status_code != 201:
-					if 'www-authenticate' in response.headers and 'invalid_token' in response.headers['www-authenticate']:
-						response.close()
-						raise OneDriveAuthError()
-					else:
-						# unknown error should be further analyzed
-						self.logger.debug("failed BITS Create-Session request to upload \"%s\". HTTP %d.", local_path, response.status_code)
-						self.logger.debug(response.headers)
-						response.close()
-						return None
-				session_id = response.headers['bits-session-id']
-				response.close()
-				break
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
-		del headers
+		# BITS: Create-Session, unless a saved session can be reattached
+		is_resumed = session is not None and session['url'] == url
+		if is_resumed:
+			session_id = session['session_id']
+			source_cursor = session['cursor']
+			self.logger.debug('reattaching to BITS session at byte %d.', source_cursor)
+		else:
+			session_id = self.bits_create_session(url, local_path)
+			if session_id is None:
+				return None
+			source_cursor = 0
+			if on_session is not None:
+				on_session(session_id, url, source_cursor)
 
 		# BITS: upload file by blocks
 		# The autnentication of this part relies on session_id, not access_token.
+		# While one fragment is being sent, the next one is read from disk into
+		# the other of two reused buffers.
 		self.logger.debug('uploading file "%s".', local_path)
 		source_file = open(local_path, 'rb')
 		fcntl.lockf(source_file, fcntl.LOCK_SH)
-		source_cursor = 0
-		while source_cursor < source_size:
-			try:
-				target_cursor = min(source_cursor + block_size, source_size) - 1
-				source_file.seek(source_cursor)
-				data = source_file.read(target_cursor - source_cursor + 1)
+		sizer = AdaptiveBlockSize(block_size, min_block_size, max_block_size)
+		buffers = [bytearray(sizer.get()), bytearray(sizer.get())]
+		pending = None
+		reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix=threading.current_thread().name + '_reader')
+		# resyncs since the last fragment the server took; each counts as a retry of the fragment
+		num_resyncs = 0
+		try:
+			while source_cursor < source_size:
+				if pending is None or pending.result()[0] != source_cursor:
+					# nothing was read ahead, or the cursor moved elsewhere
+					if len(buffers[0]) < sizer.get():
+						buffers[0] = bytearray(sizer.get())
+					pending = reader.submit(self.bits_read_fragment, source_file.fileno(), buffers[0], source_cursor, sizer.get(), source_size)
+				data = pending.result()[1]
+				# the other buffer is free to read ahead into
+				slot = 1 if data.obj is buffers[0] else 0
+				if len(data) == 0:
+					self.logger.error('file "%s" was truncated during upload.', local_path)
+					break
+				target_cursor = source_cursor + len(data) - 1
+				if target_cursor + 1 < source_size:
+					if len(buffers[slot]) < sizer.get():
+						# the block size grew; replace rather than resize the buffer
+						buffers[slot] = bytearray(sizer.get())
+					pending = reader.submit(self.bits_read_fragment, source_file.fileno(), buffers[slot], target_cursor + 1, sizer.get(), source_size)
+				else:
+					pending = None
 				self.logger.debug("uploading block %d - %d (total: %d B)", source_cursor, target_cursor, source_size)
-				response = self.http_client.request('post', url, data=data, headers={
+				headers = {
 					'X-Http-Method-Override': 'BITS_POST',
 					'BITS-Packet-Type': 'Fragment',
 					'BITS-Session-Id': session_id,
 					'Content-Range': 'bytes {}-{}/{}'.format(source_cursor, target_cursor, source_size)
-				})
-				if response.status_code != requests.codes.ok:
+				}
+
+				def attempt():
+					response = self.http_client.request('post', url, data=self.throttle_upload(data), headers=headers)
+					self.check_throttling(response)
+					return response
+
+				start_time = time.monotonic()
+				response = self.call_with_retry(attempt, on_retry=lambda e: sizer.on_failure())
+				if response.status_code == requests.codes.requested_range_not_satisfiable and \
+						'bits-received-content-range' in response.headers:
+					# the server holds a different amount of data than we thought
+					source_cursor = int(response.headers['bits-received-content-range'])
+					response.close()
+					num_resyncs += 1
+					if num_resyncs > self.retry_policy.max_attempts:
+						self.logger.error('BITS session of "%s" keeps refusing fragments at byte %d.', local_path, source_cursor)
+						break
+				elif response.status_code != requests.codes.ok:
 					# unknown error. better log it for future analysis
 					self.logger.debug('an error occurred uploading the block. HTTP %d.', response.status_code)
 					self.logger.debug(response.headers)
 					response.close()
-					fcntl.lockf(source_file, fcntl.LOCK_UN)
-					source_file.close()
+					if is_resumed:
+						# the saved session has probably expired. start over
+						self.logger.info('cannot reattach to BITS session. Start a new one.')
+						is_resumed = False
+						session_id = self.bits_create_session(url, local_path)
+						if session_id is not None:
+							source_cursor = 0
+							if on_session is not None:
+								on_session(session_id, url, source_cursor)
+							continue
 					# should I cancel session? https://msdn.microsoft.com/en-us/library/aa362829%28v=vs.85%29.aspx
-					return None
+					break
 				else:
+					if hasher is not None and not is_resumed:
+						hasher.update(source_cursor, data)
 					source_cursor = int(response.headers['bits-received-content-range'])
 					response.close()
-					del data
-					# sleep(1)
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				del data
-				self.threadman.hang_caller()
-		fcntl.lockf(source_file, fcntl.LOCK_UN)
-		source_file.close()
-
-		# refresh token if expired
-		if od_glob.get_config_instance().is_token_expired():
-			try:
-				self.auto_recover_auth_error()
-			except Exception as e:
-				# this branch is horrible
-				self.logger.error(e)
-				return None
+					num_resyncs = 0
+					sizer.on_success(len(data), time.monotonic() - start_time)
+					if on_session is not None:
+						on_session(session_id, url, source_cursor)
+		finally:
+			reader.shutdown()
+			fcntl.lockf(source_file, fcntl.LOCK_UN)
+			source_file.close()
+		if source_cursor < source_size:
+			return None
 
 		# BITS: close session
 		self.logger.debug('BITS upload completed. Closing session...')
@@ -493,35 +1258,38 @@ class OneDriveAPI:
 			'X-Http-Method-Override': 'BITS_POST',
 			'BITS-Packet-Type': 'Close-Session',
 			'BITS-Session-Id': session_id,
-			'Content-Length': 0
+			'Content-Length': '0'
 		}
-		while True:
-			try:
-				response = self.http_client.request('post', url, headers=headers)
-				if response.status_code != requests.codes.ok and response.status_code != requests.codes.created:
-					# when token expires, server return HTTP 500
-					# www-authenticate: 'Bearer realm="OneDriveAPI", error="expired_token", error_description="Auth token expired. Try refreshing."'
-					if 'www-authenticate' in response.headers and 'expired_token' in response.headers['www-authenticate']:  # 'invalid_token' in response.headers['www-authenticate']:
-						response.close()
-						raise OneDriveAuthError()
-					else:
-						# however, when the token is changed,
-						# we will get HTTP 500 with 'x-clienterrorcode': 'UploadSessionNotFound'
-						self.logger.debug('An error occurred when closing BITS session. HTTP %d', response.status_code)
-						self.logger.debug(response.headers)
-						response.close()
-						return None
-				res_id = response.headers['x-resource-id']
-				response.close()
-				self.logger.debug('BITS session successfully closed.')
-				return self.get_property('file.' + res_id[:res_id.index('!')] + '.' + res_id)
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
 
-	def put(self, name, folder_id='me/skydrive', upload_location=None, local_path=None, data=None, overwrite=True):
+		def attempt():
+			response = self.http_client.request('post', url, headers=headers)
+			self.check_throttling(response)
+			if response.status_code != requests.codes.ok and response.status_code != requests.codes.created:
+				# when token expires, server return HTTP 500
+				# www-authenticate: 'Bearer realm="OneDriveAPI", error="expired_token", error_description="Auth token expired. Try refreshing."'
+				if 'www-authenticate' in response.headers and 'expired_token' in response.headers['www-authenticate']:  # 'invalid_token' in response.headers['www-authenticate']:
+					response.close()
+					raise OneDriveAuthError()
+				else:
+					# however, when the token is changed,
+					# we will get HTTP 500 with 'x-clienterrorcode': 'UploadSessionNotFound'
+					self.logger.debug('An error occurred when closing BITS session. HTTP %d', response.status_code)
+					self.logger.debug(response.headers)
+					response.close()
+					return None
+			res_id = response.headers['x-resource-id']
+			response.close()
+			return res_id
+
+		res_id = self.call_with_retry(attempt)
+		if res_id is None:
+			return None
+		self.logger.debug('BITS session successfully closed.')
+		self.forget_listing(folder_id)
+		return self.get_property('file.' + res_id[:res_id.index('!')] + '.' + res_id, use_cache=False)
+
+	def put(self, name, folder_id='me/skydrive', upload_location=None, local_path=None, data=None, overwrite=True,
+			hasher=None):
 		"""
 		Upload the file or data to a path.
 		Returns a dict with keys 'source', 'name', and 'id'
@@ -532,6 +1300,7 @@ class OneDriveAPI:
 		@param local_path: the local path of the FILE.
 		@param data: the data of the entry. If given, local_path is ignored.
 		@param overwrite: whether or not to overwrite existing files, if any.
+		@param hasher: a ContentHasher to feed the bytes sent to.
 
 		To put an empty file, either local_path points to an empty file or data is set ''.
 		To upload a dir, check if it exists, and then send recursive puts to upload its files.
@@ -567,133 +1336,277 @@ class OneDriveAPI:
 			raise OneDriveValueError(
 				{'error': 'upload_null_content', 'error_description': 'local_path and data cannot both be null.'})
 
-		while True:
+		def attempt():
+			if hasattr(data, 'seek'):
+				# a retry must send the file from the beginning
+				data.seek(0)
+			return self.parse_response(self.http_client.put(uri, data=self.throttle_upload(data, hasher)), OneDriveAPIException,
+				(requests.codes.ok, requests.codes.created))
+
+		try:
+			ret = self.call_with_retry(attempt)
+		finally:
+			if local_path is not None and hasattr(data, 'close'):
+				data.close()
+			if upload_location is None:
+				# the upload may have been done even if the reply was lost
+				self.forget_listing(folder_id)
+		return self.get_property(ret['id'], use_cache=False)
+
+	def get_block(self, entry_id, fd, range_from, range_to, sizer=None, hasher=None):
+		"""
+		Download bytes range_from to range_to (inclusive) of an entry and write
+		them to the same offsets of file descriptor fd.
+
+		@param sizer: an AdaptiveBlockSize to report the transfer speed to.
+		@param hasher: a ContentHasher to feed the bytes written to.
+		@return True if the whole range is written; False if it failed on the way,
+			e.g., the retry policy gave up. Raises OneDriveAPIException if the
+			server refuses the range for good (HTTP 4xx), e.g., the file is gone.
+		"""
+		cursor = range_from
+		# waits for the network count against the deadline of the whole range
+		range_start_time = time.monotonic()
+		while cursor <= range_to:
+			headers = {
+				'Range': 'bytes={0}-{1}'.format(cursor, range_to)
+			}
+
+			def attempt():
+				r = self.http_client.get(OneDriveAPI.API_URI + entry_id + '/content', headers=headers, stream=True)
+				self.check_throttling(r)
+				if r.status_code != requests.codes.ok and r.status_code != requests.codes.partial and \
+						'www-authenticate' in r.headers and 'invalid_token' in r.headers['www-authenticate']:
+					r.close()
+					raise OneDriveAuthError()
+				if r.status_code >= 500:
+					r.close()
+					raise OneDriveServerInternalError({'error': {'code': 'server_error', 'message': 'HTTP ' + str(r.status_code)}})
+				if r.status_code == requests.codes.partial and 'content-range' in r.headers and \
+						parse_content_range(r.headers['content-range'], cursor, range_to) is None:
+					# writing a range other than the one asked for would leave holes in the file
+					r.close()
+					raise OneDriveServerInternalError({'error': {'code': 'bad_content_range',
+						'message': 'Content-Range "{}" for bytes {}-{}'.format(r.headers['content-range'], cursor, range_to)}})
+				return r
+
+			start_time = time.monotonic()
 			try:
-				r = self.http_client.put(uri, data=data)
-				ret = r.json()
-				if r.status_code != requests.codes.ok and r.status_code != requests.codes.created:
-					# TODO: try testing this
-					if 'error' in ret and 'code' in ret['error'] and ret['error']['code'] == 'request_token_expired':
-						raise OneDriveAuthError(ret)
-					else:
-						raise OneDriveAPIException(ret)
-				return self.get_property(ret['id'])
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
-			except OneDriveServerInternalError as e:
+				r = self.call_with_retry(attempt, on_retry=lambda e: sizer.on_failure() if sizer is not None else None)
+			except (OneDriveAPIException, requests.exceptions.RequestException) as e:
 				self.logger.error(e)
-				self.threadman.hang_caller()
+				return False
+			if r.status_code == requests.codes.partial and 'content-range' in r.headers:
+				block_from, block_to = parse_content_range(r.headers['content-range'], cursor, range_to)
+				offset = block_from
+				is_dropped = False
+				try:
+					# written as it arrives so that the download limit applies within a block
+					for chunk in self.iter_throttled_content(r):
+						# never past the range the reply claims
+						chunk = chunk[:block_to + 1 - offset]
+						os.pwrite(fd, chunk, offset)
+						if hasher is not None:
+							hasher.update(offset, chunk)
+						offset += len(chunk)
+				except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+					# continue from the last byte written
+					self.logger.warning('%s %s. Continue from byte %d.', type(e).__name__, e, offset)
+					is_dropped = True
+					if sizer is not None:
+						sizer.on_failure()
+					if offset == block_from and \
+							not self.threadman.hang_caller(self.retry_policy.get_time_left(range_start_time)):
+						# timed out or cancelled, e.g., at shutdown
+						return False
+				except OSError as e:
+					self.logger.error(e)
+					return False
+				finally:
+					r.close()
+				if offset == block_from and not is_dropped:
+					self.logger.error('failed downloading block. Empty reply at byte %d.', offset)
+					return False
+				# only the bytes written count
+				cursor = offset
+				if sizer is not None and offset > block_to:
+					sizer.on_success(block_to - block_from + 1, time.monotonic() - start_time)
+			else:
+				# a server that ignores Range replies 200 with the whole file
+				self.logger.debug('failed downloading block. HTTP %d.', r.status_code)
+				self.logger.debug(r.headers)
+				r.close()
+				if 400 <= r.status_code < 500:
+					raise OneDriveAPIException({'error': {'code': 'download_refused', 'message': 'HTTP ' + str(r.status_code)}})
+				return False
+		return True
 
-	def get_by_blocks(self, entry_id, local_path, file_size, block_size):
+	def get_by_blocks(self, entry_id, local_path, file_size, block_size, num_ranges=1, cursor=0, on_commit=None,
+			min_block_size=None, max_block_size=None, hasher=None):
+		"""
+		Download a large file by blocks. The local file is preallocated and up to
+		num_ranges blocks are fetched concurrently, each written to its own offset.
+
+		@param cursor: resume from this offset. Bytes before it are kept as is.
+		@param on_commit: called with the new cursor every time the bytes before
+			it are flushed to disk, so that the download can be resumed later.
+		@param min_block_size, max_block_size: if given, the block size starts
+			at block_size and adapts to the measured throughput within the bounds.
+		@param hasher: a ContentHasher to feed the bytes written to. Bytes before
+			cursor are not fed, so it is only useful when cursor is 0.
+		@return True if the file is complete; False if the download failed on the
+			way, in which case the contiguous bytes done are still committed.
+			Raises OneDriveAPIException if the server refuses the file for good.
+		"""
 		try:
-			f = open(local_path, 'wb')
+			if cursor > 0:
+				fd = os.open(local_path, os.O_WRONLY)
+			else:
+				fd = os.open(local_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
 		except OSError as e:
 			self.logger.error(e)
 			return False
-		self.logger.debug('download file to "' + local_path + '"...')
-		# fcntl.lockf(f, fcntl.LOCK_SH)
-		cursor = 0
-		while cursor < file_size:
-			self.logger.debug('current cursor: ' + str(cursor))
+		try:
+			os.posix_fallocate(fd, 0, file_size)
+		except OSError:
+			# the filesystem does not support preallocation
+			os.ftruncate(fd, file_size)
+		self.logger.debug('download file to "%s" from %d with %d ranges...', local_path, cursor, num_ranges)
+		sizer = AdaptiveBlockSize(block_size, min_block_size, max_block_size)
+		failed = threading.Event()
+		# the error of a range the server refused
+		refusals = []
+
+		def fetch(range_from, range_to):
+			if failed.is_set():
+				return range_from, range_to, False
+			self.logger.debug('current cursor: ' + str(range_from))
 			try:
-				target = min(cursor + block_size, file_size) - 1
-				r = self.http_client.get(OneDriveAPI.API_URI + entry_id + '/content',
-					headers={
-						'Range': 'bytes={0}-{1}'.format(cursor, target)
-					})
-				if r.status_code == requests.codes.ok or r.status_code == requests.codes.partial:
-					# sample data: 'bytes 12582912-12927920/12927921'
-					range_unit, range_str = r.headers['content-range'].split(' ')
-					range_range, range_total = range_str.split('/')
-					range_from, range_to = range_range.split('-')
-					f.write(r.content)
-					cursor = int(range_to) + 1
-					r.close()
-				else:
-					if 'www-authenticate' in r.headers and 'invalid_token' in r.headers['www-authenticate']:
-						raise OneDriveAuthError()
-					else:
-						self.logger.debug('failed downloading block. HTTP %d.', r.status_code)
-						self.logger.debug(r.headers)
-						self.logger.debug(r.content)
-						return False
-					# return False
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
-		f.close()
+				if self.get_block(entry_id, fd, range_from, range_to, sizer, hasher):
+					return range_from, range_to, True
+			except OneDriveAPIException as e:
+				refusals.append(e)
+			failed.set()
+			return range_from, range_to, False
+
+		try:
+			with ThreadPoolExecutor(max_workers=max(1, num_ranges),
+					thread_name_prefix=threading.current_thread().name + '_range') as executor:
+				# blocks finish out of order; the cursor only passes contiguous ones
+				finished = {}
+				committed = cursor
+				next_offset = cursor
+				running = set()
+				while True:
+					while not failed.is_set() and next_offset < file_size and len(running) < max(1, num_ranges):
+						range_to = min(next_offset + sizer.get(), file_size) - 1
+						running.add(executor.submit(fetch, next_offset, range_to))
+						next_offset = range_to + 1
+					if len(running) == 0:
+						break
+					done, running = wait(running, return_when=FIRST_COMPLETED)
+					for future in done:
+						range_from, range_to, is_done = future.result()
+						if is_done:
+							finished[range_from] = range_to + 1
+					while cursor in finished:
+						cursor = finished.pop(cursor)
+					# after a failure, what is done is committed for the next attempt
+					if on_commit is not None and cursor > committed and (cursor - committed >= OneDriveAPI.COMMIT_BLOCKS * sizer.get() or
+							cursor == file_size or (failed.is_set() and len(running) == 0)):
+						os.fdatasync(fd)
+						on_commit(cursor)
+						committed = cursor
+		finally:
+			os.close(fd)
+		if len(refusals) > 0:
+			raise refusals[0]
+		if failed.is_set():
+			return False
 		self.logger.debug('file saved.')
-		# fcntl.lockf(f, fcntl.LOCK_UN)
 		return True
 
-	def get(self, entry_id, local_path=None):
+	def open_content(self, entry_id):
 		"""
+		Return a streamed response to the content of an entry. The body is not
+		read yet; the caller consumes it with iter_content() or the file-like
+		.raw attribute and must close the response afterwards.
+
 		Fetching content of OneNote files will raise OneDriveAPIException:
 		Resource type 'notebook' doesn't support the path 'content'. (request_url_invalid)
 		"""
-		while True:
+		return self.call_with_retry(lambda: self.request_content(entry_id))
+
+	def request_content(self, entry_id):
+		"""
+		Send one request of open_content(), without retrying it.
+		"""
+		r = self.http_client.get(OneDriveAPI.API_URI + entry_id + '/content', stream=True)
+		if r.status_code != requests.codes.ok:
 			try:
-				r = self.http_client.get(OneDriveAPI.API_URI + entry_id + '/content')
-				if r.status_code != requests.codes.ok:
-					ret = r.json()
-					# TODO: try testing this
-					if 'error' in ret and 'code' in ret['error'] and ret['error']['code'] == 'request_token_expired':
-						raise OneDriveAuthError(ret)
-					else:
-						raise OneDriveAPIException(ret)
-				if local_path is not None:
-					with open(local_path, 'wb') as f:
-						f.write(r.content)
-					return True
-				else:
-					return r.content
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
-			except OneDriveServerInternalError as e:
-				self.logger.error(e)
-				self.threadman.hang_caller()
+				self.parse_response(r, OneDriveAPIException)
+			finally:
+				r.close()
+		return r
+
+	def iter_content(self, entry_id, chunk_size=STREAM_CHUNK_SIZE):
+		"""
+		Yield the content of an entry by chunks of at most chunk_size bytes.
+		"""
+		r = self.open_content(entry_id)
+		try:
+			for chunk in self.iter_throttled_content(r, chunk_size):
+				yield chunk
+		finally:
+			r.close()
+
+	def get(self, entry_id, local_path=None, hasher=None):
+		"""
+		If local_path is given, the content is written to the file chunk by chunk
+		as it arrives, so memory use does not grow with file size. Otherwise the
+		whole content is returned as bytes; use iter_content() or open_content()
+		to process large content in memory.
+
+		@param hasher: a ContentHasher to feed the bytes written to local_path.
+		"""
+		def attempt():
+			# a connection dropped in the middle of the body starts over, within the same retry policy
+			r = self.request_content(entry_id)
+			try:
+				if local_path is None:
+					return b''.join(self.iter_throttled_content(r))
+				if hasher is not None:
+					hasher.reset()
+				with open(local_path, 'wb') as f:
+					for chunk in self.iter_throttled_content(r):
+						if hasher is not None:
+							hasher.update(f.tell(), chunk)
+						f.write(chunk)
+				return True
+			finally:
+				r.close()
+
+		return self.call_with_retry(attempt)
 
 	def rm(self, entry_id):
 		"""
 		OneDrive API always returns HTTP 204.
 		"""
-		while True:
-			try:
-				self.http_client.delete(OneDriveAPI.API_URI + entry_id)
-				return
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
-			except OneDriveServerInternalError as e:
-				self.logger.error(e)
-				self.threadman.hang_caller()
+		folder_id = self.forget_entry(entry_id)
+		def attempt():
+			r = self.http_client.delete(OneDriveAPI.API_URI + entry_id)
+			self.check_throttling(r)
+			r.close()
+
+		try:
+			self.call_with_retry(attempt)
+		finally:
+			self.forget_entry(entry_id, folder_id)
 
 	def get_user_info(self, user_id='me'):
-		while True:
-			try:
-				r = self.http_client.get(OneDriveAPI.API_URI + user_id)
-				return self.parse_response(r, OneDriveAPIException, requests.codes.ok)
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
+		return self.call_with_retry(lambda: self.parse_response(self.http_client.get(
+			OneDriveAPI.API_URI + user_id), OneDriveAPIException, requests.codes.ok))
 
 	def get_contact_list(self, user_id='me'):
-		while True:
-			try:
-				r = self.http_client.get(OneDriveAPI.API_URI + user_id + '/friends')
-				return self.parse_response(r, OneDriveAPIException, requests.codes.ok)
-			except OneDriveAuthError:
-				self.auto_recover_auth_error()
-			except requests.exceptions.ConnectionError:
-				self.logger.info('network connection error.')
-				self.threadman.hang_caller()
+		return self.call_with_retry(lambda: self.parse_response(self.http_client.get(
+			OneDriveAPI.API_URI + user_id + '/friends'), OneDriveAPIException, requests.codes.ok))
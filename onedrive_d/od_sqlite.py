@@ -5,56 +5,256 @@ Database manipulator classes for onedrive-d.
 """
 
 import os
+import heapq
 import threading
 import sqlite3
 from . import od_glob
 
 
+class TaskRecord:
+
+	"""
+	A task in the queue of TaskManager.
+	"""
+
+	__slots__ = ('task_id', 'type', 'local_path', 'remote_id', 'remote_parent_id', 'status', 'args', 'extra_info',
+		'priority', 'deps', 'dependents', 'ready')
+
+	def __init__(self, task_id, type, local_path, remote_id, remote_parent_id, status, args, extra_info, priority):
+		self.task_id = task_id
+		self.type = type
+		self.local_path = local_path
+		self.remote_id = remote_id
+		self.remote_parent_id = remote_parent_id
+		self.status = status
+		self.args = args
+		self.extra_info = extra_info
+		self.priority = priority
+		# ids of the unfinished tasks this task waits for, or None
+		self.deps = None
+		# ids of the tasks waiting for this task, or None
+		self.dependents = None
+		# whether the task is in a heap, ready to be fetched
+		self.ready = False
+
+	def is_bulk(self):
+		return self.type in TaskManager.BULK_TASK_TYPES
+
+	def is_exclusive(self):
+		return self.type in TaskManager.EXCLUSIVE_TASK_TYPES
+
+	def to_dict(self):
+		return {
+			'task_id': self.task_id,
+			'type': self.type,
+			'local_path': self.local_path,
+			'remote_id': self.remote_id,
+			'remote_parent_id': self.remote_parent_id,
+			'status': self.status,
+			'args': self.args,
+			'extra_info': self.extra_info,
+			'priority': self.priority
+		}
+
+
+class TaskJournal:
+
+	"""
+	An on-disk copy of the task queue, so that pending tasks survive restarts.
+
+	Every change to the queue is committed before TaskManager goes on. A task
+	is recorded when added, marked when a worker claims it, and deleted when
+	it is done. Tasks still claimed when the daemon stops were interrupted,
+	so they are added again when the journal is loaded.
+
+	The journal is intact if it holds the whole queue of the last run, which
+	is the case unless it was cleared at shutdown. was_intact tells if it was
+	when it was opened; from then on it is intact again.
+	"""
+
+	def __init__(self, path):
+		self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+		# WAL makes a commit cheap; a crash can only lose the last ones
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		self.conn.execute("""
+			CREATE TABLE IF NOT EXISTS tasks
+			(task_id INTEGER PRIMARY KEY, type TEXT, local_path TEXT, remote_id TEXT, remote_parent_id TEXT,
+			status INT, args TEXT, extra_info TEXT, priority INT)
+		""")
+		self.conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INT)')
+		row = self.conn.execute("SELECT value FROM state WHERE key='intact'").fetchone()
+		self.was_intact = row is not None and row[0] == 1
+		self.set_intact(True)
+
+	def add(self, task, replaced_id=None):
+		self.conn.execute('BEGIN')
+		if replaced_id is not None:
+			self.conn.execute('DELETE FROM tasks WHERE task_id=?', (replaced_id, ))
+		self.conn.execute('INSERT INTO tasks (task_id, type, local_path, remote_id, remote_parent_id, status, args, extra_info, priority) VALUES (?,?,?,?,?,?,?,?,?)',
+			(task.task_id, task.type, task.local_path, task.remote_id, task.remote_parent_id, task.status,
+			task.args, task.extra_info, task.priority))
+		self.conn.execute('COMMIT')
+
+	def claim(self, task_ids):
+		self.conn.execute('BEGIN')
+		self.conn.executemany('UPDATE tasks SET status=1 WHERE task_id=?', [(i, ) for i in task_ids])
+		self.conn.execute('COMMIT')
+
+	def remove(self, task_ids):
+		self.conn.execute('BEGIN')
+		self.conn.executemany('DELETE FROM tasks WHERE task_id=?', [(i, ) for i in task_ids])
+		self.conn.execute('COMMIT')
+
+	def clear(self):
+		self.conn.execute('BEGIN')
+		self.conn.execute('DELETE FROM tasks')
+		self.set_intact(False)
+		self.conn.execute('COMMIT')
+
+	def set_intact(self, is_intact):
+		self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('intact', ?)", (int(is_intact), ))
+
+	def load(self):
+		"""
+		Return the recorded tasks as TaskRecord objects in the order they were added.
+		"""
+		cursor = self.conn.execute('SELECT task_id, type, local_path, remote_id, remote_parent_id, args, extra_info, priority FROM tasks ORDER BY task_id ASC')
+		# claimed tasks were interrupted and are handled again
+		return [TaskRecord(row[0], row[1], row[2], row[3], row[4], 0, row[5], row[6], row[7]) for row in cursor]
+
+	def close(self):
+		self.conn.close()
+
+
 class TaskManager:
 
 	"""
-	Task manager abstracts the task queue implemented in SQLite to better
+	Task manager abstracts the task queue shared by all threads to better
 	control concurrency.
 
+	Tasks are kept in a dict by task id. There is at most one added task per
+	local path: adding a task replaces the added task of the same path. A
+	task added while the path has a fetched task waits for that task to be
+	done, so no change is lost.
+
+	Tasks form a dependency graph. Besides the fetched task of its path, a
+	task waits for the last task added for any of its ancestor dirs if that
+	is an exclusive task (EXCLUSIVE_TASK_TYPES), e.g., a file is uploaded
+	only after the 'mk' task of its parent dir is done. A task is ready when
+	all the tasks it waits for are done. Ready tasks are held back while a
+	fetched task works on an overlapping subtree and either of them is
+	exclusive, and are retried when a fetched task is done. All other ready
+	tasks can be fetched in parallel.
+
+	Ready tasks are fetched by priority, then in the order they were added.
+	Tasks caused by local changes (PRIORITY_INTERACTIVE) go before the ones
+	found by deep scans (PRIORITY_SCAN), and at the same priority metadata
+	tasks go before bulk transfers (BULK_TASK_TYPES). The two kinds are kept
+	in separate heaps of (priority, task id), so that workers of the fast lane
+	only take metadata tasks and are never held by a large transfer. Ids of
+	replaced tasks are left in the heaps and skipped when popped.
+
+	Every TaskManager object adds tasks with its own default priority, so a
+	thread handling a task can have the tasks it adds inherit its priority.
+
+	If a TaskJournal is opened, the queue is also kept on disk.
+
+	Workers claim metadata tasks in batches with get_tasks(). While
+	defer_acks is set, del_task() only notes the task as done, and
+	ack_tasks() deletes the noted tasks under one lock. A lock is thus taken
+	once per batch rather than twice per task.
+
 	task status: 0 (added), 1 (fetched), 2 (done, deletable)
 	task types:
 		for dirs: sy (sync), rm (remove), mk (mkdir on server, postwork=[sy]), tr (move local to trash).
 		for files: af (analyze file), up (upload), dl (download, postwork=[add_row]),
 				mv (move), rf (remove), cp (copy).
 	"""
-	# this semaphore counts the number of tasks in the table
-	task_counter = threading.Semaphore(0)
+
+	PRIORITY_INTERACTIVE = 0
+	PRIORITY_SCAN = 1
+	BULK_TASK_TYPES = ('up', 'dl')
+	# tasks that change the structure of a subtree
+	EXCLUSIVE_TASK_TYPES = ('mk', 'mv', 'rm')
 
 	# logger
 	logger = od_glob.get_logger()
 
 	# mutex lock
 	lock = threading.Lock()
-
-	db = None
+	# notified when a task becomes ready or inc_sem() is called
+	task_cond = threading.Condition(lock)
+	# inc_sem() calls not consumed by dec_sem()
+	num_wakeups = 0
+
+	# task_id -> TaskRecord
+	tasks = {}
+	# local_path -> task_id of the last task added for the path
+	task_paths = {}
+	# is_bulk -> heap of (priority, task_id) of ready tasks
+	task_heaps = {False: [], True: []}
+	# is_bulk -> number of ready tasks
+	num_ready_tasks = {False: 0, True: 0}
+	# ids of the ready tasks held back by fetched tasks
+	held_task_ids = []
+	# local_path -> type of the fetched task of the path
+	fetched_paths = {}
+	# dir path -> number of fetched tasks under the dir
+	num_fetched_under = {}
+	# dir path -> number of fetched exclusive tasks under the dir
+	num_exclusive_under = {}
+	# number of threads in dec_sem()
+	num_waiters = 0
+	last_task_id = 0
+	journal = None
 
 	def __init__(self):
-		# enable auto-commit by setting isolation_level
-		self.acquire_lock()
-		if TaskManager.db is None:
-			TaskManager.db = sqlite3.connect(
-				':memory:', isolation_level=None, check_same_thread=False)
-			TaskManager.db.execute("""
-				CREATE TABLE tasks
-				(type TEXT, local_path TEXT, remote_id TEXT, remote_parent_id TEXT,
-				status INT DEFAULT 0, args TEXT, extra_info TEXT,
-				UNIQUE(local_path) ON CONFLICT ABORT)
-			""")
+		# priority of the tasks added without one
+		self.priority = TaskManager.PRIORITY_SCAN
+		self.defer_acks = False
+		# ids of the tasks done but not yet deleted
+		self.done_task_ids = []
+
+	def open_journal(self, path):
+		"""
+		Keep the queue in a TaskJournal at path and add the tasks recorded there.
+
+		@return the number of tasks restored.
+		"""
+		self.acquire_lock()
+		TaskManager.journal = TaskJournal(path)
+		tasks = TaskManager.journal.load()
+		restored_ids = set()
+		for task in tasks:
+			prev_id = TaskManager.task_paths.get(task.local_path)
+			if prev_id is not None and prev_id not in restored_ids:
+				# the path got a new task before the journal was opened
+				TaskManager.journal.remove([task.task_id])
+				continue
+			# restored tasks keep their ids, so new ones must come after them
+			TaskManager.last_task_id = max(TaskManager.last_task_id, task.task_id)
+			deps = self.get_dependencies(task.local_path)
+			if prev_id is not None:
+				# added while the restored task of the path was being handled
+				deps.add(prev_id)
+			self.insert_task(task, deps)
+			restored_ids.add(task.task_id)
+		TaskManager.task_cond.notify_all()
 		self.release_lock()
-		self.cursor = TaskManager.db.cursor()
+		self.logger.info('restored %d tasks from the task journal.', len(tasks))
+		return len(tasks)
 
 	def close(self):
+		"""
+		Close the journal, if any, and drop the tasks in memory.
+		"""
 		self.acquire_lock()
-		if TaskManager.db is not None:
-			TaskManager.db.commit()
-			TaskManager.db.close()
-			TaskManager.db = None
+		if TaskManager.journal is not None:
+			TaskManager.journal.close()
+			TaskManager.journal = None
 		self.release_lock()
+		self.clean_tasks()
 
 	def acquire_lock(self):
 		TaskManager.lock.acquire()
@@ -62,69 +262,371 @@ class TaskManager:
 	def release_lock(self):
 		TaskManager.lock.release()
 
-	def dec_sem(self):
-		TaskManager.task_counter.acquire()
+	def has_task(self, fast_lane=False, transfers_only=False):
+		"""
+		Must be called with the lock held.
+		"""
+		return (not transfers_only and TaskManager.num_ready_tasks[False] > 0) or \
+			(not fast_lane and TaskManager.num_ready_tasks[True] > 0)
+
+	def dec_sem(self, fast_lane=False, is_released=None, transfers_only=False):
+		"""
+		Block until there is a task to fetch or inc_sem() is called.
+
+		@param fast_lane: only wait for metadata tasks.
+		@param is_released: also stop waiting when this function returns True.
+			It is checked whenever wake_all() is called.
+		@param transfers_only: only wait for bulk tasks.
+		"""
+		with TaskManager.task_cond:
+			TaskManager.num_waiters += 1
+			TaskManager.task_cond.wait_for(lambda: TaskManager.num_wakeups > 0 or
+				self.has_task(fast_lane, transfers_only) or (is_released is not None and is_released()))
+			TaskManager.num_waiters -= 1
+			if TaskManager.num_wakeups > 0:
+				TaskManager.num_wakeups -= 1
 		# self.logger.debug('decremented semaphore.')
 
 	def inc_sem(self):
-		TaskManager.task_counter.release()
+		"""
+		Wake up a thread blocked in dec_sem(), e.g., to let it stop.
+		"""
+		with TaskManager.task_cond:
+			TaskManager.num_wakeups += 1
+			TaskManager.task_cond.notify()
 		# self.logger.debug('incremented semaphore.')
 
-	def add_task(self, type, local_path, remote_id='', remote_parent_id='', status=0, args='', extra_info=''):
+	def wake_all(self):
+		"""
+		Have all threads blocked in dec_sem() check their is_released function.
+		"""
+		with TaskManager.task_cond:
+			TaskManager.task_cond.notify_all()
+
+	def add_task(self, type, local_path, remote_id='', remote_parent_id='', status=0, args='', extra_info='',
+			priority=None, depends_on=()):
+		"""
+		@param priority: PRIORITY_INTERACTIVE or PRIORITY_SCAN. Default: the priority of this object.
+		@param depends_on: ids of other tasks that must be done before this one.
+		@return the id of the new task.
+		"""
 		# print(type + ' ' + local_path)
-		task_added = False
+		if priority is None:
+			priority = self.priority
 		self.acquire_lock()
-		try:
-			# delete old pending tasks
-			self.cursor.execute(
-				'DELETE FROM tasks WHERE local_path=? AND status=0', (local_path, ))
-			# add new task
-			self.cursor.execute('INSERT INTO tasks (type, local_path, remote_id, remote_parent_id, status, args, extra_info) VALUES (?,?,?,?,?,?,?)',
-				(type, local_path, remote_id, remote_parent_id, status, args, extra_info)
-			)
-			self.logger.debug('added task "%s" "%s".', type, local_path)
-			task_added = True
-		except sqlite3.IntegrityError:
-			self.logger.debug('failed to add task "%s" "%s".', type, local_path)
+		# a task done by this thread may be for the same path
+		self.delete_done_tasks()
+		deps = self.get_dependencies(local_path)
+		deps.update(i for i in depends_on if i in TaskManager.tasks)
+		prev_id = TaskManager.task_paths.get(local_path)
+		prev = None
+		if prev_id is not None:
+			if TaskManager.tasks[prev_id].status == 0:
+				# replace the old added task, which is skipped in the heap
+				prev = TaskManager.tasks.pop(prev_id)
+				if prev.ready:
+					TaskManager.num_ready_tasks[prev.is_bulk()] -= 1
+				if prev.deps is not None:
+					deps.update(prev.deps)
+			else:
+				# the path is being worked on; do the new task afterwards
+				self.logger.debug('task "%s" "%s" waits for the fetched task of the path.', type, local_path)
+				deps.add(prev_id)
+				prev_id = None
+		TaskManager.last_task_id += 1
+		task = TaskRecord(TaskManager.last_task_id, type, local_path, remote_id, remote_parent_id, status, args,
+			extra_info, priority)
+		if TaskManager.journal is not None:
+			TaskManager.journal.add(task, prev_id)
+		if prev is not None and prev.dependents is not None:
+			# tasks waiting for the replaced task wait for the new one
+			for dependent_id in prev.dependents:
+				dependent = TaskManager.tasks.get(dependent_id)
+				if dependent is not None and dependent.deps is not None:
+					dependent.deps.discard(prev_id)
+					dependent.deps.add(task.task_id)
+			task.dependents = prev.dependents
+		self.insert_task(task, deps)
+		self.compact_heap(task.is_bulk())
+		self.logger.debug('added task "%s" "%s".', type, local_path)
 		self.release_lock()
-		if task_added:
-			self.inc_sem()
+		return task.task_id
 
-	def get_task(self):
-		self.acquire_lock()
-		self.cursor.execute(
-			'SELECT rowid, type, local_path, remote_id, remote_parent_id, status, args, extra_info FROM tasks WHERE status=0 ORDER BY rowid ASC LIMIT 1')
-		row = self.cursor.fetchone()
-		if row is None:
-			self.release_lock()
+	def get_dependencies(self, local_path):
+		"""
+		Return the set of ids of the exclusive tasks added or fetched for the
+		ancestor dirs of local_path. Must be called with the lock held.
+		"""
+		ret = set()
+		path = os.path.dirname(local_path)
+		while True:
+			task_id = TaskManager.task_paths.get(path)
+			if task_id is not None and TaskManager.tasks[task_id].is_exclusive():
+				ret.add(task_id)
+			parent_path = os.path.dirname(path)
+			if parent_path == path:
+				return ret
+			path = parent_path
+
+	def insert_task(self, task, deps):
+		"""
+		Put a new task in the queue, ready unless it waits for a task in deps.
+		Must be called with the lock held.
+		"""
+		TaskManager.tasks[task.task_id] = task
+		TaskManager.task_paths[task.local_path] = task.task_id
+		if len(deps) > 0:
+			task.deps = deps
+			for dep_id in deps:
+				dep = TaskManager.tasks[dep_id]
+				if dep.dependents is None:
+					dep.dependents = []
+				dep.dependents.append(task.task_id)
+		elif task.status == 0:
+			self.make_ready(task)
+
+	def make_ready(self, task):
+		"""
+		Must be called with the lock held.
+		"""
+		task.ready = True
+		heapq.heappush(TaskManager.task_heaps[task.is_bulk()], (task.priority, task.task_id))
+		TaskManager.num_ready_tasks[task.is_bulk()] += 1
+		# waiters of the fast lane cannot take every task, so wake them all
+		TaskManager.task_cond.notify_all()
+
+	def compact_heap(self, is_bulk):
+		"""
+		Drop the ids of replaced tasks when they outnumber the ready tasks.
+		Must be called with the lock held.
+		"""
+		heap = TaskManager.task_heaps[is_bulk]
+		if len(heap) > 2 * TaskManager.num_ready_tasks[is_bulk] + 1024:
+			heap = [item for item in heap if self.is_ready(item[1])]
+			heapq.heapify(heap)
+			TaskManager.task_heaps[is_bulk] = heap
+
+	def is_ready(self, task_id):
+		task = TaskManager.tasks.get(task_id)
+		return task is not None and task.ready
+
+	def peek_heap(self, is_bulk):
+		"""
+		Return the (priority, task_id) of the next ready task of a heap, or None.
+		Must be called with the lock held.
+		"""
+		heap = TaskManager.task_heaps[is_bulk]
+		while len(heap) > 0:
+			if self.is_ready(heap[0][1]):
+				return heap[0]
+			heapq.heappop(heap)
+		return None
+
+	def is_held_back(self, task):
+		"""
+		Tell if a fetched task works on a subtree overlapping the one of task,
+		and either of them is exclusive. Must be called with the lock held.
+		"""
+		if task.is_exclusive():
+			num_under = TaskManager.num_fetched_under
+		else:
+			num_under = TaskManager.num_exclusive_under
+		if num_under.get(task.local_path, 0) > 0:
+			return True
+		path = task.local_path
+		while True:
+			fetched_type = TaskManager.fetched_paths.get(path)
+			if fetched_type is not None and (task.is_exclusive() or fetched_type in TaskManager.EXCLUSIVE_TASK_TYPES):
+				return True
+			parent_path = os.path.dirname(path)
+			if parent_path == path:
+				return False
+			path = parent_path
+
+	def update_fetched_paths(self, task, delta):
+		"""
+		Count a task as fetched (delta=1) or no longer fetched (delta=-1).
+		Must be called with the lock held.
+		"""
+		if delta > 0:
+			TaskManager.fetched_paths[task.local_path] = task.type
+		else:
+			TaskManager.fetched_paths.pop(task.local_path, None)
+		path = task.local_path
+		while True:
+			parent_path = os.path.dirname(path)
+			if parent_path == path:
+				break
+			path = parent_path
+			TaskManager.num_fetched_under[path] = TaskManager.num_fetched_under.get(path, 0) + delta
+			if TaskManager.num_fetched_under[path] == 0:
+				del TaskManager.num_fetched_under[path]
+			if task.is_exclusive():
+				TaskManager.num_exclusive_under[path] = TaskManager.num_exclusive_under.get(path, 0) + delta
+				if TaskManager.num_exclusive_under[path] == 0:
+					del TaskManager.num_exclusive_under[path]
+
+	def get_task(self, fast_lane=False, transfers_only=False):
+		"""
+		@param fast_lane: only fetch metadata tasks.
+		@param transfers_only: only fetch bulk tasks.
+		"""
+		tasks = self.get_tasks(1, fast_lane, transfers_only)
+		if len(tasks) == 0:
 			return None
-		self.cursor.execute('UPDATE tasks SET status=1 WHERE rowid=?', (row[0], ))
-		self.release_lock()
-		data = {
-			'task_id': row[0],
-			'type': row[1],
-			'local_path': row[2],
-			'remote_id': row[3],
-			'remote_parent_id': row[4],
-			'status': row[5],
-			'args': row[6],
-			'extra_info': row[7]
-		}
-		return data
+		return tasks[0]
+
+	def get_tasks(self, max_count, fast_lane=False, transfers_only=False):
+		"""
+		Fetch the next task and, if it is a metadata task, up to max_count - 1
+		metadata tasks that follow it. A batch takes no more than its share
+		of the ready tasks among the threads waiting for tasks, so that it
+		does not hold back work those threads could do.
+
+		@param fast_lane: only fetch metadata tasks.
+		@param transfers_only: only fetch bulk tasks.
+		@return a list of tasks, empty if there is none.
+		"""
+		ret = []
+		self.acquire_lock()
+		max_count = max(1, min(max_count, TaskManager.num_ready_tasks[False] // (TaskManager.num_waiters + 1)))
+		while len(ret) < max_count:
+			if transfers_only:
+				metadata_head = None
+			else:
+				metadata_head = self.peek_heap(False)
+			if fast_lane:
+				bulk_head = None
+			else:
+				bulk_head = self.peek_heap(True)
+			if metadata_head is None and bulk_head is None:
+				break
+			# at the same priority, metadata goes first
+			is_bulk = metadata_head is None or (bulk_head is not None and bulk_head[0] < metadata_head[0])
+			if is_bulk and len(ret) > 0:
+				# transfers are claimed alone
+				break
+			priority, task_id = heapq.heappop(TaskManager.task_heaps[is_bulk])
+			task = TaskManager.tasks[task_id]
+			task.ready = False
+			TaskManager.num_ready_tasks[is_bulk] -= 1
+			if self.is_held_back(task):
+				TaskManager.held_task_ids.append(task_id)
+				continue
+			ret.append(task.to_dict())
+			task.status = 1
+			self.update_fetched_paths(task, 1)
+			if is_bulk:
+				break
+		if TaskManager.journal is not None and len(ret) > 0:
+			TaskManager.journal.claim([task['task_id'] for task in ret])
+		self.release_lock()
+		return ret
 
 	def del_task(self, task_id):
+		if self.defer_acks:
+			self.done_task_ids.append(task_id)
+			return
+		self.acquire_lock()
+		self.remove_task(task_id)
+		if TaskManager.journal is not None:
+			TaskManager.journal.remove([task_id])
+		self.release_lock()
+
+	def ack_tasks(self):
+		"""
+		Delete the tasks noted as done while defer_acks was set.
+		"""
+		if len(self.done_task_ids) > 0:
+			self.acquire_lock()
+			self.delete_done_tasks()
+			self.release_lock()
+
+	def delete_done_tasks(self):
+		"""
+		Must be called with the lock held.
+		"""
+		if len(self.done_task_ids) > 0:
+			for task_id in self.done_task_ids:
+				self.remove_task(task_id)
+			if TaskManager.journal is not None:
+				TaskManager.journal.remove(self.done_task_ids)
+			self.done_task_ids = []
+
+	def remove_task(self, task_id):
+		"""
+		Delete a task and release the tasks that wait for it.
+		Must be called with the lock held.
+		"""
+		# the task may be done after the queue was persisted and dropped at shutdown,
+		# in which case it is only removed from the journal
+		task = TaskManager.tasks.pop(task_id, None)
+		if task is None:
+			return
+		if task.ready:
+			TaskManager.num_ready_tasks[task.is_bulk()] -= 1
+		if TaskManager.task_paths.get(task.local_path) == task_id:
+			del TaskManager.task_paths[task.local_path]
+		if task.dependents is not None:
+			for dependent_id in task.dependents:
+				dependent = TaskManager.tasks.get(dependent_id)
+				if dependent is not None and dependent.deps is not None:
+					dependent.deps.discard(task_id)
+					if len(dependent.deps) == 0:
+						dependent.deps = None
+						self.make_ready(dependent)
+		if task.status == 1:
+			self.update_fetched_paths(task, -1)
+			# the held back tasks may go now; those still held back are held again when fetched
+			held_task_ids, TaskManager.held_task_ids = TaskManager.held_task_ids, []
+			for held_task_id in held_task_ids:
+				held_task = TaskManager.tasks.get(held_task_id)
+				if held_task is not None and held_task.status == 0 and held_task.deps is None and not held_task.ready:
+					self.make_ready(held_task)
+
+	def count_tasks(self):
+		"""
+		Return the number of tasks that are added or being handled.
+		"""
+		self.acquire_lock()
+		ret = len(TaskManager.tasks)
+		self.release_lock()
+		return ret
+
+	def count_ready_tasks(self):
+		"""
+		Return the number of tasks that could be fetched right now.
+		"""
 		self.acquire_lock()
-		self.cursor.execute('DELETE FROM tasks WHERE rowid=?', (task_id, ))
+		ret = TaskManager.num_ready_tasks[False] + TaskManager.num_ready_tasks[True]
 		self.release_lock()
+		return ret
+
+	def clean_tasks(self, persist=False):
+		"""
+		Drop all tasks.
 
-	def clean_tasks(self):
+		@param persist: keep the tasks in the journal for the next start.
+		"""
 		self.acquire_lock()
-		self.cursor.execute('DELETE FROM tasks')
+		if TaskManager.journal is not None and not persist:
+			TaskManager.journal.clear()
+		TaskManager.tasks.clear()
+		TaskManager.task_paths.clear()
+		TaskManager.task_heaps = {False: [], True: []}
+		TaskManager.num_ready_tasks = {False: 0, True: 0}
+		TaskManager.held_task_ids = []
+		TaskManager.fetched_paths.clear()
+		TaskManager.num_fetched_under.clear()
+		TaskManager.num_exclusive_under.clear()
 		self.release_lock()
 
 	def dump(self):
+		"""
+		Return the tasks in the order they were added.
+		"""
 		self.acquire_lock()
-		ret = TaskManager.db.iterdump()
+		ret = [TaskManager.tasks[i].to_dict() for i in sorted(TaskManager.tasks)]
 		self.release_lock()
 		return ret
 
@@ -140,6 +642,10 @@ class EntryManager:
 		self.conn = sqlite3.connect(
 			config.APP_CONF_PATH + '/' + EntryManager.db_name, isolation_level=None)
 		self.cursor = self.conn.cursor()
+		# every update is committed on its own, so an fsync per commit would dominate syncing.
+		# In WAL mode a crash can only lose the last commits, which the next deep scan redoes.
+		self.cursor.execute('PRAGMA journal_mode=WAL')
+		self.cursor.execute('PRAGMA synchronous=NORMAL')
 		self.acquire_lock()
 		if not EntryManager.db_initialized:
 			self.cursor.execute("""
@@ -148,6 +654,31 @@ class EntryManager:
 				remote_parent_id TEXT PRIMARY_KEY, size INT, client_updated_time TEXT, status TEXT, visited INT,
 				UNIQUE(parent_path, name) ON CONFLICT REPLACE)
 			""")
+			self.cursor.execute("""
+				CREATE TABLE IF NOT EXISTS transfers
+				(local_path TEXT UNIQUE PRIMARY KEY, type TEXT, remote_id TEXT, size INT,
+				client_updated_time TEXT, cursor INT, extra_info TEXT)
+			""")
+			# state of each dir when it was last synced, for incremental deep scans
+			self.cursor.execute("""
+				CREATE TABLE IF NOT EXISTS dirs
+				(local_path TEXT UNIQUE PRIMARY KEY, remote_id TEXT, updated_time TEXT, local_mtime INT)
+			""")
+			# SHA-1 of local files, valid as long as the inode, size and mtime (in ns) are the same
+			self.cursor.execute("""
+				CREATE TABLE IF NOT EXISTS hashes
+				(inode INT, size INT, mtime INT, sha1 TEXT, PRIMARY KEY(inode, size, mtime))
+			""")
+			# SHA-1 of remote file versions that were uploaded or downloaded
+			self.cursor.execute("""
+				CREATE TABLE IF NOT EXISTS remote_hashes
+				(remote_id TEXT UNIQUE PRIMARY KEY, updated_time TEXT, size INT, sha1 TEXT)
+			""")
+			# remote file versions that have the content of a local file, as long as its inode, size and mtime are the same
+			self.cursor.execute("""
+				CREATE TABLE IF NOT EXISTS remote_copies
+				(remote_id TEXT UNIQUE PRIMARY KEY, updated_time TEXT, size INT, inode INT, mtime INT)
+			""")
 			self.cursor.execute('UPDATE entries SET visited=0')
 			self.conn.commit()
 			EntryManager.db_initialized = True
@@ -290,6 +821,7 @@ class EntryManager:
 	def del_entry_by_remote_id(self, remote_id):
 		self.acquire_lock()
 		self.cursor.execute('DELETE FROM entries WHERE remote_id=?', (remote_id, ))
+		self.cursor.execute('DELETE FROM remote_hashes WHERE remote_id=?', (remote_id, ))
 		self.release_lock()
 
 	def del_entry_by_path(self, local_path):
@@ -312,4 +844,138 @@ class EntryManager:
 				'DELETE FROM entries WHERE parent_path LIKE ? OR parent_path=?', (parent_path + '/%', parent_path))
 			self.cursor.execute(
 				'DELETE FROM entries WHERE parent_path=? AND name=?', (path, basename))
+			self.cursor.execute(
+				'DELETE FROM dirs WHERE local_path LIKE ? OR local_path=?', (parent_path + '/%', parent_path))
+		self.release_lock()
+
+	def mark_subtree_visited(self, local_path):
+		"""
+		Keep the records under a dir that a deep scan skips.
+		"""
+		self.acquire_lock()
+		self.cursor.execute('UPDATE entries SET visited=1 WHERE parent_path LIKE ? OR parent_path=?',
+			(local_path + '/%', local_path))
+		self.release_lock()
+
+	def get_dir_state(self, local_path):
+		"""
+		Return the remote updated_time and local mtime (in ns) of a dir when it
+		was last synced, or None.
+		"""
+		self.acquire_lock()
+		self.cursor.execute('SELECT local_path, remote_id, updated_time, local_mtime FROM dirs WHERE local_path=?',
+			(local_path, ))
+		row = self.cursor.fetchone()
+		self.release_lock()
+		if row is not None:
+			row = {
+				'local_path': row[0],
+				'remote_id': row[1],
+				'updated_time': row[2],
+				'local_mtime': row[3]
+			}
+		return row
+
+	def update_dir_state(self, local_path, remote_id, updated_time, local_mtime):
+		self.acquire_lock()
+		self.cursor.execute('INSERT OR REPLACE INTO dirs (local_path, remote_id, updated_time, local_mtime) VALUES (?,?,?,?)',
+			(local_path, remote_id, updated_time, local_mtime))
+		self.release_lock()
+
+	def del_dir_state(self, local_path):
+		self.acquire_lock()
+		self.cursor.execute('DELETE FROM dirs WHERE local_path=?', (local_path, ))
+		self.release_lock()
+
+	def get_content_hash(self, inode, size, mtime):
+		self.acquire_lock()
+		self.cursor.execute('SELECT sha1 FROM hashes WHERE inode=? AND size=? AND mtime=?', (inode, size, mtime))
+		row = self.cursor.fetchone()
+		self.release_lock()
+		if row is not None:
+			return row[0]
+		return None
+
+	def update_content_hash(self, inode, size, mtime, sha1):
+		self.acquire_lock()
+		# older versions of the file are of no use
+		self.cursor.execute('DELETE FROM hashes WHERE inode=?', (inode, ))
+		self.cursor.execute('INSERT INTO hashes (inode, size, mtime, sha1) VALUES (?,?,?,?)', (inode, size, mtime, sha1))
+		self.release_lock()
+
+	def get_remote_hash(self, remote_id, updated_time, size):
+		"""
+		Return the SHA-1 of a remote file if it is still the version we transferred.
+		"""
+		self.acquire_lock()
+		self.cursor.execute('SELECT sha1 FROM remote_hashes WHERE remote_id=? AND updated_time=? AND size=?',
+			(remote_id, updated_time, size))
+		row = self.cursor.fetchone()
+		self.release_lock()
+		if row is not None:
+			return row[0]
+		return None
+
+	def update_remote_hash(self, remote_id, updated_time, size, sha1):
+		self.acquire_lock()
+		self.cursor.execute('INSERT OR REPLACE INTO remote_hashes (remote_id, updated_time, size, sha1) VALUES (?,?,?,?)',
+			(remote_id, updated_time, size, sha1))
+		self.release_lock()
+
+	def get_remote_copy(self, remote_id, updated_time, size):
+		"""
+		Return (inode, mtime) of the local file a remote file version was
+		transferred from or to, or None.
+		"""
+		self.acquire_lock()
+		self.cursor.execute('SELECT inode, mtime FROM remote_copies WHERE remote_id=? AND updated_time=? AND size=?',
+			(remote_id, updated_time, size))
+		row = self.cursor.fetchone()
+		self.release_lock()
+		if row is not None:
+			return (row[0], row[1])
+		return None
+
+	def update_remote_copy(self, remote_id, updated_time, size, inode, mtime):
+		self.acquire_lock()
+		self.cursor.execute('INSERT OR REPLACE INTO remote_copies (remote_id, updated_time, size, inode, mtime) VALUES (?,?,?,?,?)',
+			(remote_id, updated_time, size, inode, mtime))
+		self.release_lock()
+
+	def get_transfer(self, local_path):
+		"""
+		Return the saved state of an unfinished transfer to local_path, or None.
+		"""
+		self.acquire_lock()
+		self.cursor.execute('SELECT local_path, type, remote_id, size, client_updated_time, cursor, extra_info FROM transfers WHERE local_path=?',
+			(local_path, ))
+		row = self.cursor.fetchone()
+		self.release_lock()
+		if row is not None:
+			row = {
+				'local_path': row[0],
+				'type': row[1],
+				'remote_id': row[2],
+				'size': row[3],
+				'client_updated_time': row[4],
+				'cursor': row[5],
+				'extra_info': row[6]
+			}
+		return row
+
+	def update_transfer(self, local_path, type, remote_id, size, client_updated_time, cursor=0, extra_info=''):
+		self.acquire_lock()
+		self.cursor.execute(
+			'INSERT OR REPLACE INTO transfers (local_path, type, remote_id, size, client_updated_time, cursor, extra_info) VALUES (?,?,?,?,?,?,?)',
+			(local_path, type, remote_id, size, client_updated_time, cursor, extra_info))
+		self.release_lock()
+
+	def update_transfer_cursor(self, local_path, cursor):
+		self.acquire_lock()
+		self.cursor.execute('UPDATE transfers SET cursor=? WHERE local_path=?', (cursor, local_path))
+		self.release_lock()
+
+	def del_transfer(self, local_path):
+		self.acquire_lock()
+		self.cursor.execute('DELETE FROM transfers WHERE local_path=?', (local_path, ))
 		self.release_lock()
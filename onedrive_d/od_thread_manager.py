@@ -2,12 +2,16 @@
 
 """
 Thread Manager for onedrive_d
+
+The thread manager keeps the state of the network connection. Threads that
+run into a network error wait in hang_caller() while the manager probes the
+server with backoff, and are all woken up as soon as a probe succeeds.
 """
 
 import time
 import socket
 import threading
-import queue
+import concurrent.futures
 from . import od_glob
 
 instance = None
@@ -23,51 +27,118 @@ def get_instance():
 
 class NetworkingThreadManager(threading.Thread):
 
+	# the server to probe for connectivity
+	PROBE_HOST = 'onedrive.com'
+	PROBE_PORT = 80
+
 	def __init__(self):
 		super().__init__()
 		self.name = 'thread_mgr'
 		self.daemon = True
-		self.sleep_queue = queue.Queue()
-		self.conditions = {}
 		self.logger = od_glob.get_logger()
-		self.wait_interval = od_glob.get_config_instance().params['NETWORK_ERROR_RETRY_INTERVAL']
+		config = od_glob.get_config_instance()
+		self.wait_interval = config.params['NETWORK_ERROR_RETRY_INTERVAL']
+		self.max_wait_interval = config.params['NETWORK_ERROR_RETRY_MAX_INTERVAL']
+		self.connected = True
+		self.cond = threading.Condition()
+		# increased by cancel_waits() to release the waiting threads
+		self.cancel_generation = 0
+		# futures resolved on the next recovery, for callers that cannot block
+		self.futures = []
+
+	def report_error(self):
+		"""
+		Tell the manager that the network seems down, so that it starts probing.
+		"""
+		with self.cond:
+			if self.connected:
+				self.logger.info('network seems down. Start probing.')
+				self.connected = False
+				self.cond.notify_all()
 
-	def hang_caller(self):
+	def hang_caller(self, timeout=None):
 		"""
-		Put whatever thread that calls this function to sleep.
-		The ThreadManager thread must not call this function.
+		Put whatever thread that calls this function to sleep until the network
+		is back. The ThreadManager thread must not call this function.
+
+		@param timeout: give up waiting after this many seconds. None means never.
+		@return True if the network is back; False if timed out or cancelled.
 		"""
-		self.conditions[
-			threading.current_thread().ident] = cond = threading.Condition()
-		self.sleep_queue.put(threading.current_thread())
-		cond.acquire()
+		self.report_error()
 		self.logger.info('put to sleep due to networking error.')
-		cond.wait()
-		cond.release()
-		self.logger.info('waken up by ThreadManager.')
-		del self.conditions[threading.current_thread().ident]
+		ret = self.wait_for_connection(timeout)
+		if ret:
+			self.logger.info('waken up by ThreadManager.')
+		return ret
+
+	def wait_for_connection(self, timeout=None):
+		"""
+		Block until the network is up, for at most timeout seconds.
+
+		@return True if the network is up; False if timed out or cancelled.
+		"""
+		with self.cond:
+			cancel_generation = self.cancel_generation
+			self.cond.wait_for(lambda: self.connected or self.cancel_generation != cancel_generation, timeout)
+			return self.connected
+
+	def get_connection_future(self):
+		"""
+		Return a concurrent.futures.Future that is done when the network is up.
+		asyncio code can wait for it with asyncio.wrap_future().
+		"""
+		future = concurrent.futures.Future()
+		with self.cond:
+			if self.connected:
+				future.set_result(True)
+			else:
+				self.futures.append(future)
+		return future
+
+	def cancel_waits(self):
+		"""
+		Release all threads waiting for the network, e.g., when stopping.
+		"""
+		with self.cond:
+			self.cancel_generation += 1
+			futures, self.futures = self.futures, []
+			self.cond.notify_all()
+		for future in futures:
+			future.set_result(False)
 
-	def is_connected(self, host_name='onedrive.com', host_port='80'):
+	def is_connected(self, host_name=None, host_port=None):
 		"""
 		Test if the machine can reach the host:port.
 		"""
+		if host_name is None:
+			host_name = self.PROBE_HOST
+		if host_port is None:
+			host_port = self.PROBE_PORT
 		try:
 			host_ip = socket.gethostbyname(host_name)
 			s = socket.create_connection((host_ip, host_port), 1)
 			s.shutdown(socket.SHUT_RDWR)
 			s.close()
-			self.logger.debug('able to realize "' + host_name + ':' + host_port + '".')
+			self.logger.debug('able to realize "%s:%s".', host_name, host_port)
 			return True
-		except:
-			self.logger.debug('cannot realize "' + host_name + ':' + host_port + '".')
+		except OSError:
+			self.logger.debug('cannot realize "%s:%s".', host_name, host_port)
 		return False
 
 	def run(self):
 		self.logger.debug('started.')
 		while True:
-			t = self.sleep_queue.get()
+			with self.cond:
+				self.cond.wait_for(lambda: not self.connected)
+			# one probe loop for all waiting threads
+			wait_interval = self.wait_interval
 			while not self.is_connected():
-				time.sleep(self.wait_interval)
-			self.conditions[t.ident].acquire()
-			self.conditions[t.ident].notify()
-			self.conditions[t.ident].release()
+				time.sleep(wait_interval)
+				wait_interval = min(wait_interval * 2, self.max_wait_interval)
+			with self.cond:
+				self.connected = True
+				futures, self.futures = self.futures, []
+				self.cond.notify_all()
+			for future in futures:
+				future.set_result(True)
+			self.logger.info('network is back.')
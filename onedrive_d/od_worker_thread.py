@@ -14,8 +14,11 @@ with the remote entry.
 import os
 import sys
 import json
+import time
+import hashlib
 import threading
 import queue
+import requests
 from send2trash import send2trash
 from . import od_glob
 from . import od_inotify_thread
@@ -23,31 +26,26 @@ from . import od_onedrive_api
 from . import od_sqlite
 
 
-class WorkerThread(threading.Thread):
+class TaskHandler:
+
+	"""
+	Handles the tasks of TaskManager. The thread calling handle_task() must
+	set self.taskmgr and self.entrymgr to its own managers first.
+	"""
 
-	worker_list = []
-	worker_lock = threading.Lock()
 	logger = od_glob.get_logger()
 	config = od_glob.get_config_instance()
 	api = od_onedrive_api.get_instance()
-
-	def __init__(self):
-		super().__init__()
-		self.daemon = True
-		self.running = True
-		self.is_busy = False
-		WorkerThread.worker_lock.acquire()
-		self.name = 'worker' + str(len(WorkerThread.worker_list))
-		WorkerThread.worker_list.append(self)
-		WorkerThread.worker_lock.release()
-
-	def stop(self):
-		self.running = False
+	# suffix of partially downloaded files, which are never synced
+	PART_FILE_SUFFIX = '.od_part'
+	HASH_CHUNK_SIZE = 1048576
+	# local writes of the daemon, which the inotify thread must not take for user changes
+	echoes = od_inotify_thread.INotifyThread.echoes
 
 	def remove_dir(self, task):
 		if os.path.exists(task['local_path']) and os.path.isdir(task['local_path']):
 			try:
-				send2trash(task['local_path'])
+				self.trash(task['local_path'])
 			except OSError as e:
 				self.logger.error(e)
 		if not os.path.exists(task['local_path']):
@@ -58,7 +56,7 @@ class WorkerThread(threading.Thread):
 	def remove_file(self, task):
 		if os.path.exists(task['local_path']) and os.path.isfile(task['local_path']):
 			try:
-				send2trash(task['local_path'])
+				self.trash(task['local_path'])
 			except OSError as e:
 				self.logger.error(e)
 		if not os.path.exists(task['local_path']):
@@ -69,16 +67,30 @@ class WorkerThread(threading.Thread):
 	def sync_dir(self, task):
 
 		try:
+			# taken before listing so that changes made during the sync are seen next time
+			local_mtime = os.stat(task['local_path']).st_mtime_ns
 			local_entries = self.list_dir(task['local_path'])
 		except OSError as e:
 			self.logger.error(e)
 			self.taskmgr.del_task(task['task_id'])
 			return
 
-		remote_entries = self.api.list_entries(folder_id=task['remote_id'])
 		is_recursive_task = 'recursive,' in task['args']
+		# skip the subdirs that have not changed since they were last synced
+		is_incremental_task = 'incremental,' in task['args']
+		# the listing of the parent tells when this folder was last updated
+		if task['extra_info'] != '':
+			updated_time = json.loads(task['extra_info']).get('updated_time')
+		else:
+			updated_time = None
+		# the folder may change between pages, shifting an entry into the next one
+		seen_names = set()
+
+		for entry in self.api.iter_entries(folder_id=task['remote_id'], updated_time=updated_time):
 
-		for entry in remote_entries:
+			if entry['name'] in seen_names:
+				continue
+			seen_names.add(entry['name'])
 
 			# skip the entry if ignorable
 			if self.config.ignore_list and \
@@ -142,7 +154,10 @@ class WorkerThread(threading.Thread):
 				self.entrymgr.update_entry(local_path, entry)
 
 				if is_recursive_task:
-					self.taskmgr.add_task(type=task['type'], local_path=local_path, remote_id=entry['id'], remote_parent_id=entry['parent_id'], args=task['args'])
+					if is_incremental_task and self.is_dir_unchanged(local_path, entry):
+						self.entrymgr.mark_subtree_visited(local_path)
+					else:
+						self.taskmgr.add_task(type=task['type'], local_path=local_path, remote_id=entry['id'], remote_parent_id=entry['parent_id'], args=task['args'], extra_info=json.dumps(entry))
 
 				local_entries.remove(entry['name'])
 			elif entry['type'] not in self.api.UNSUPPORTED_TYPES:
@@ -183,7 +198,7 @@ class WorkerThread(threading.Thread):
 						# there was an old record about this dir before
 						# but now the dir in remote is gone
 						try:
-							send2trash(local_path)
+							self.trash(local_path)
 							self.entrymgr.del_entry_by_parent(parent_path=local_path)
 						except OSError as e:
 							self.logger.error(e)
@@ -196,6 +211,33 @@ class WorkerThread(threading.Thread):
 				# in analyze_file_path will not modify local_entries.
 				self.analyze_file_path(local_path, task['remote_id'], None, local_entries)
 
+		if updated_time is not None:
+			self.entrymgr.update_dir_state(task['local_path'], task['remote_id'], updated_time, local_mtime)
+		self.taskmgr.del_task(task['task_id'])
+
+	def is_dir_unchanged(self, local_path, entry):
+		"""
+		Tell if neither the local dir nor the remote folder has changed since
+		the dir was last synced.
+
+		A folder's updated_time and a dir's mtime only change with their
+		immediate children, so an unchanged dir may still have changes deeper
+		in its subtree. Those are found by inotify or the next full scan.
+		"""
+		state = self.entrymgr.get_dir_state(local_path)
+		if state is None or state['remote_id'] != entry['id'] or state['updated_time'] != entry['updated_time']:
+			return False
+		try:
+			return os.stat(local_path).st_mtime_ns == state['local_mtime']
+		except OSError:
+			return False
+
+	def give_up_task(self, task):
+		"""
+		Delete a task that failed. Its parent dir is synced again by the next
+		deep scan, which retries the task.
+		"""
+		self.entrymgr.del_dir_state(os.path.dirname(task['local_path']))
 		self.taskmgr.del_task(task['task_id'])
 
 	def analyze_file_path(self, local_path, remote_parent_id, entry, local_entries):
@@ -252,7 +294,7 @@ class WorkerThread(threading.Thread):
 							# locally.
 							try:
 								self.logger.info('sending file "' + local_path + '" to trash.')
-								send2trash(local_path)
+								self.trash(local_path)
 								self.entrymgr.del_entry_by_remote_id(previous_entry['remote_id'])
 							except OSError as e:
 								self.logger.error(e)
@@ -270,6 +312,8 @@ class WorkerThread(threading.Thread):
 						# same mtime and file size, hopefully we can trust they are the same
 						# just fix the record
 						self.entrymgr.update_entry(local_path=local_path, obj=entry)
+					elif self.is_same_content(local_path, local_fsize, entry):
+						self.adopt_remote_entry(local_path, entry)
 					else:
 						self.logger.warning('case1: ' + str(local_mtime) + ',' +
 											str(local_fsize) + ' vs ' + str(remote_mtime) + ',' + str(entry['size']))
@@ -285,7 +329,10 @@ class WorkerThread(threading.Thread):
 					# we have a previous record for reference
 					if previous_entry['remote_id'] == entry['id']:
 						# at least they are the same entry
-						if local_mtime > remote_mtime and entry['client_updated_time'] == previous_entry['client_updated_time']:
+						if local_mtime != remote_mtime and self.is_same_content(local_path, local_fsize, entry):
+							# only the timestamps differ
+							self.adopt_remote_entry(local_path, entry)
+						elif local_mtime > remote_mtime and entry['client_updated_time'] == previous_entry['client_updated_time']:
 							# the local file is strictly newer, so upload it
 							self.taskmgr.add_task('up', local_path, entry['id'], entry['parent_id'])
 						elif local_mtime < remote_mtime and local_mtime == od_glob.str_to_time(previous_entry['client_updated_time']):
@@ -309,6 +356,9 @@ class WorkerThread(threading.Thread):
 						else:
 							# local record and remote record match perfectly
 							pass
+					elif self.is_same_content(local_path, local_fsize, entry):
+						# same path and content, but no longer same entry seen by server
+						self.adopt_remote_entry(local_path, entry)
 					else:
 						# same path, but no longer same entry seen by server
 						# one must have replaced the other
@@ -333,6 +383,94 @@ class WorkerThread(threading.Thread):
 			raise Exception(
 				"analyze_file_path: local_path and entry cannot both be NULL.")
 
+	def hash_file(self, local_path):
+		"""
+		Return the SHA-1 hex digest of the content of a file.
+		"""
+		h = hashlib.sha1()
+		with open(local_path, 'rb') as f:
+			while True:
+				chunk = f.read(TaskHandler.HASH_CHUNK_SIZE)
+				if len(chunk) == 0:
+					break
+				h.update(chunk)
+		return h.hexdigest()
+
+	def get_content_hash(self, local_path):
+		"""
+		Return the SHA-1 of a local file. It is computed only if the index in
+		entries.db has none for the current inode, size and mtime of the file.
+		"""
+		st = os.stat(local_path)
+		ret = self.entrymgr.get_content_hash(st.st_ino, st.st_size, st.st_mtime_ns)
+		if ret is None:
+			ret = self.hash_file(local_path)
+			if self.get_file_fingerprint(local_path) == '{}:{}:{}'.format(st.st_ino, st.st_size, st.st_mtime_ns):
+				# not changed while being hashed
+				self.entrymgr.update_content_hash(st.st_ino, st.st_size, st.st_mtime_ns, ret)
+		return ret
+
+	def is_same_content(self, local_path, local_fsize, entry):
+		"""
+		Tell if a local file has the same content as the remote entry. The
+		server does not tell content hashes, so only versions that onedrive-d
+		uploaded or downloaded before can be compared, by the SHA-1 of the bytes
+		transferred. The local file is hashed only if it has changed since.
+		"""
+		if local_fsize != entry['size']:
+			return False
+		try:
+			copy = self.entrymgr.get_remote_copy(entry['id'], entry['updated_time'], entry['size'])
+			if copy is not None:
+				st = os.stat(local_path)
+				if (st.st_ino, st.st_mtime_ns) == copy:
+					return True
+			remote_hash = self.entrymgr.get_remote_hash(entry['id'], entry['updated_time'], entry['size'])
+			if remote_hash is None:
+				return False
+			return self.get_content_hash(local_path) == remote_hash
+		except OSError as e:
+			self.logger.error(e)
+			return False
+
+	def record_same_content(self, local_path, entry, fingerprint=None, content_hash=None):
+		"""
+		Fix the mtime of a local file to that of the remote entry, and record
+		that they have the same content as long as the file is not changed.
+		The file is not read here.
+
+		@param fingerprint: the fingerprint of the file when it had the content
+			of the entry, e.g., before it was uploaded. Default: the current one.
+		@param content_hash: the SHA-1 of the content, computed from the bytes
+			transferred. Default: the known hash of the file, if any.
+		"""
+		st = os.stat(local_path)
+		is_unchanged = fingerprint is None or fingerprint == '{}:{}:{}'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+		if content_hash is None:
+			# a known hash of the file is still valid after its mtime is fixed
+			content_hash = self.entrymgr.get_content_hash(st.st_ino, st.st_size, st.st_mtime_ns)
+		t = od_glob.str_to_timestamp(entry['client_updated_time'])
+		os.utime(local_path, (t, t))
+		if not is_unchanged:
+			return
+		st = os.stat(local_path)
+		self.entrymgr.update_remote_copy(entry['id'], entry['updated_time'], entry['size'], st.st_ino, st.st_mtime_ns)
+		if content_hash is not None:
+			self.entrymgr.update_content_hash(st.st_ino, st.st_size, st.st_mtime_ns, content_hash)
+			self.entrymgr.update_remote_hash(entry['id'], entry['updated_time'], entry['size'], content_hash)
+
+	def adopt_remote_entry(self, local_path, entry):
+		"""
+		Record that a local file is the remote entry, which has the same content,
+		and fix the local mtime instead of transferring the file.
+		"""
+		self.logger.info('file "%s" has the same content as the remote one. Fix the record.', local_path)
+		self.entrymgr.update_entry(local_path, entry)
+		try:
+			self.record_same_content(local_path, entry)
+		except OSError as e:
+			self.logger.error(e)
+
 	def make_remote_dir(self, task):
 		if os.path.exists(task['local_path']):
 			name = os.path.basename(task['local_path'])
@@ -351,62 +489,229 @@ class WorkerThread(threading.Thread):
 			self.taskmgr.del_task(task['task_id'])
 
 	def upload_file(self, task):
-		try:
-			local_fsize = os.path.getsize(task['local_path'])
-		except OSError as e:
-			self.logger.error(e)
-			self.taskmgr.del_task(task['task_id'])
+		source = self.get_upload_source(task)
+		if source is None:
 			return
-		parent_path, basename = os.path.split(task['local_path'])
+		local_fsize, fingerprint = source
+		hasher = od_onedrive_api.ContentHasher()
 		if local_fsize >= self.config.params['BITS_FILE_MIN_SIZE']:
-			# remote_path = task['local_path'][len(self.config.params['ONEDRIVE_ROOT_PATH']) + 1:]
-			new_entry = self.api.bits_put(basename,
-				folder_id=task['remote_parent_id'],
-				local_path=task['local_path'],
-				# remote_path = remote_path,
-				block_size=self.config.params['BITS_BLOCK_SIZE'])
+			new_entry = self.upload_file_by_bits(task['local_path'], task['remote_parent_id'], hasher)
 			if new_entry is None:
 				self.logger.error('failed to BITS upload "' + task['local_path'] + '".')
-				self.taskmgr.del_task(task['task_id'])
+				self.give_up_task(task)
 				return
 		else:
-			new_entry = self.api.put(basename,
+			new_entry = self.api.put(os.path.basename(task['local_path']),
 				folder_id=task['remote_parent_id'],
-				local_path=task['local_path'])
-			# new_entry['parent_id'] = task['remote_parent_id']
-		# fix timestamp
+				local_path=task['local_path'],
+				hasher=hasher)
+		self.finish_upload(task, new_entry, fingerprint, hasher.get_hexdigest(local_fsize))
+
+	def get_upload_source(self, task):
+		"""
+		Return the size and the fingerprint of the file to upload. They are
+		taken before uploading, so that a change during the upload is not
+		mistaken for the uploaded content. Give up the task and return None if
+		the file cannot be accessed.
+		"""
+		try:
+			st = os.stat(task['local_path'])
+			return st.st_size, '{}:{}:{}'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+		except OSError as e:
+			self.logger.error(e)
+			self.give_up_task(task)
+			return None
+
+	def finish_upload(self, task, new_entry, fingerprint, content_hash=None):
+		"""
+		Record the uploaded file and fix its timestamp.
+
+		@param content_hash: the SHA-1 of the bytes sent, if they were all hashed.
+		"""
 		self.entrymgr.update_entry(task['local_path'], new_entry)
 		try:
-			t = od_glob.str_to_timestamp(new_entry['client_updated_time'])
-			os.utime(task['local_path'], (t, t))
+			self.record_same_content(task['local_path'], new_entry, fingerprint, content_hash)
 		except OSError as e:
 			self.logger.error(e)
 		self.taskmgr.del_task(task['task_id'])
 
+	def get_file_fingerprint(self, local_path):
+		"""
+		Return a string that changes whenever the content of the file may have changed.
+		"""
+		st = os.stat(local_path)
+		return '{}:{}:{}'.format(st.st_ino, st.st_size, st.st_mtime_ns)
+
+	def upload_file_by_bits(self, local_path, remote_parent_id, hasher=None):
+		"""
+		Upload a large file by BITS API. The session is saved after every fragment
+		so that an upload interrupted by a restart continues from the offset the
+		server confirmed, as long as the local file is unchanged.
+
+		@param hasher: a ContentHasher to feed the fragments sent to.
+		"""
+		try:
+			session, save_session = self.get_upload_session(local_path, remote_parent_id)
+		except OSError as e:
+			self.logger.error(e)
+			return None
+		new_entry = self.api.bits_put(os.path.basename(local_path),
+			folder_id=remote_parent_id,
+			local_path=local_path,
+			block_size=self.config.params['BITS_BLOCK_SIZE'],
+			session=session,
+			on_session=save_session,
+			min_block_size=self.config.params['BITS_BLOCK_SIZE_MIN'],
+			max_block_size=self.config.params['BITS_BLOCK_SIZE_MAX'],
+			hasher=hasher)
+		self.entrymgr.del_transfer(local_path)
+		return new_entry
+
+	def get_upload_session(self, local_path, remote_parent_id):
+		"""
+		Return the saved BITS session to continue uploading local_path with, or
+		None if there is none or the file has changed since, and the function
+		that saves the session of this upload.
+		"""
+		fingerprint = self.get_file_fingerprint(local_path)
+		session = None
+		prev = self.entrymgr.get_transfer(local_path)
+		if prev is not None and prev['type'] == 'up' and prev['remote_id'] == remote_parent_id:
+			session = json.loads(prev['extra_info'])
+			if session['fingerprint'] != fingerprint:
+				self.logger.info('file "%s" changed since last upload attempt. Start a new session.', local_path)
+				session = None
+			else:
+				session['cursor'] = prev['cursor']
+
+		def save_session(session_id, url, cursor):
+			self.entrymgr.update_transfer(local_path, 'up', remote_parent_id, 0, '', cursor,
+				json.dumps({'session_id': session_id, 'url': url, 'fingerprint': fingerprint}))
+
+		return session, save_session
+
 	def download_file(self, task):
-		entry = json.loads(task['extra_info'])
-		if entry['size'] >= self.config.params['BITS_FILE_MIN_SIZE']:
-			# download large files by blocks
-			if not self.api.get_by_blocks(task['remote_id'], task['local_path'], entry['size'], self.config.params['BITS_BLOCK_SIZE']):
-				self.logger.error(
-					'failed to download to file "%s" by blocks.', task['local_path'])
-				self.taskmgr.del_task(task['task_id'])
-				return
-		else:
-			# use single HTTP request to download small files
-			if not self.api.get(task['remote_id'], task['local_path']):
-				self.logger.error('failed to download file "%s".', task['local_path'])
-				self.taskmgr.del_task(task['task_id'])
-				return
+		# the downloaded file, its partial file and its mtime fix all cause inotify events
+		self.echoes.expect(task['local_path'], self.get_part_path(task['local_path']))
+		try:
+			entry = json.loads(task['extra_info'])
+			hasher = od_onedrive_api.ContentHasher()
+			if entry['size'] >= self.config.params['BITS_FILE_MIN_SIZE']:
+				# download large files by blocks
+				if not self.download_file_by_blocks(task['local_path'], entry, hasher):
+					self.logger.error(
+						'failed to download to file "%s" by blocks.', task['local_path'])
+					self.give_up_task(task)
+					return
+			else:
+				# use single HTTP request to download small files, to the partial file so that
+				# a failure leaves the local file as it was
+				is_done = False
+				try:
+					is_done = self.api.get(task['remote_id'], self.get_part_path(task['local_path']), hasher)
+				finally:
+					if not is_done:
+						self.discard_part_file(task['local_path'])
+				if not self.finish_part_file(task['local_path'], is_done):
+					self.logger.error('failed to download file "%s".', task['local_path'])
+					self.give_up_task(task)
+					return
+			self.finish_download(task, entry, hasher.get_hexdigest(entry['size']))
+		finally:
+			self.echoes.settle(task['local_path'], self.get_part_path(task['local_path']))
+
+	def finish_download(self, task, entry, content_hash=None):
+		"""
+		Record the downloaded file and fix its timestamp.
+
+		@param content_hash: the SHA-1 of the bytes received, if they were all hashed.
+		"""
 		if 'add_row,' in task['args']:
 			self.entrymgr.update_entry(task['local_path'], entry)
 		try:
-			t = od_glob.str_to_timestamp(entry['client_updated_time'])
-			os.utime(task['local_path'], (t, t))
+			self.record_same_content(task['local_path'], entry, content_hash=content_hash)
 		except OSError as e:
 			self.logger.error(e)
 		self.taskmgr.del_task(task['task_id'])
 
+	def download_file_by_blocks(self, local_path, entry, hasher=None):
+		"""
+		Download to a partial file next to local_path and rename it when done.
+		If the daemon stopped in the middle of a previous download of the same
+		remote version, continue from the last committed block.
+
+		@param hasher: a ContentHasher to feed the bytes received to. A resumed
+			download does not receive the whole file, so it is not hashed.
+		"""
+		cursor = self.get_download_cursor(local_path, entry)
+		try:
+			is_done = self.api.get_by_blocks(entry['id'], self.get_part_path(local_path), entry['size'],
+				self.config.params['BITS_BLOCK_SIZE'], self.config.params['BITS_DOWNLOAD_RANGES'],
+				cursor=cursor, on_commit=lambda c: self.entrymgr.update_transfer_cursor(local_path, c),
+				min_block_size=self.config.params['BITS_BLOCK_SIZE_MIN'],
+				max_block_size=self.config.params['BITS_BLOCK_SIZE_MAX'],
+				hasher=hasher if cursor == 0 else None)
+		except od_onedrive_api.OneDriveAPIException as e:
+			# the server refused this version of the file; the partial file is useless
+			self.logger.error(e)
+			self.discard_part_file(local_path)
+			return False
+		return self.finish_part_file(local_path, is_done)
+
+	def get_download_cursor(self, local_path, entry):
+		"""
+		Return the offset to continue downloading entry to the partial file
+		of local_path from, and record the transfer if it is a new one.
+		"""
+		prev = self.entrymgr.get_transfer(local_path)
+		if prev is not None and prev['type'] == 'dl' and prev['remote_id'] == entry['id'] and \
+				prev['size'] == entry['size'] and prev['client_updated_time'] == entry['client_updated_time'] and \
+				os.path.isfile(self.get_part_path(local_path)):
+			self.logger.info('resume downloading "%s" from byte %d.', local_path, prev['cursor'])
+			return prev['cursor']
+		self.entrymgr.update_transfer(local_path, 'dl', entry['id'], entry['size'], entry['client_updated_time'])
+		return 0
+
+	def finish_part_file(self, local_path, is_done):
+		"""
+		Move the partial file of a complete download to local_path.
+
+		@param is_done: whether the partial file is complete. If not, the file
+			and its cursor are kept, so that the next attempt resumes.
+		@return True if local_path is the downloaded file.
+		"""
+		if not is_done:
+			return False
+		try:
+			os.replace(self.get_part_path(local_path), local_path)
+			self.entrymgr.del_transfer(local_path)
+			return True
+		except OSError as e:
+			self.logger.error(e)
+		self.discard_part_file(local_path)
+		return False
+
+	def get_transfer_size(self, task):
+		"""
+		Return the number of bytes a transfer task moves, or 0 if it is unknown.
+		"""
+		try:
+			if task['type'] == 'dl':
+				return json.loads(task['extra_info'])['size']
+			return os.path.getsize(task['local_path'])
+		except (OSError, ValueError, KeyError):
+			return 0
+
+	def discard_part_file(self, local_path):
+		"""
+		Delete the partial file of local_path and its transfer record.
+		"""
+		self.entrymgr.del_transfer(local_path)
+		try:
+			os.remove(self.get_part_path(local_path))
+		except OSError:
+			pass
+
 	def move_remote_entry(self, task):
 		if os.path.exists(task['local_path']):
 			new_entry = self.api.mv(target_id=task['remote_id'],
@@ -422,20 +727,10 @@ class WorkerThread(threading.Thread):
 				self.logger.error(e)
 		self.taskmgr.del_task(task['task_id'])
 
-	def run(self):
-		self.taskmgr = od_sqlite.TaskManager()
-		self.entrymgr = od_sqlite.EntryManager()
-		while self.running:		# not self.stop_event.is_set():
-			self.taskmgr.dec_sem()
-			task = self.taskmgr.get_task()
-			if task is None:
-				self.logger.debug('got null task.')
-				continue
-
-			self.logger.debug('got task: %s on "%s"', task['type'], task['local_path'])
-
-			self.is_busy = True
-			od_inotify_thread.INotifyThread.pause_event.set()
+	def handle_task(self, task):
+		# the tasks added while handling this one inherit its priority
+		self.taskmgr.priority = task['priority']
+		try:
 			if task['type'] == 'sy':
 				self.sync_dir(task)
 			elif task['type'] == 'rm':
@@ -456,11 +751,14 @@ class WorkerThread(threading.Thread):
 				pass
 			else:
 				raise Exception('Unknown task type "' + task['type'] + '".')
-			od_inotify_thread.INotifyThread.pause_event.clear()
-			self.is_busy = False
-		self.taskmgr = None
-		self.entrymgr.close()
-		self.logger.debug('stopped.')
+		except (od_onedrive_api.OneDriveAPIException, requests.exceptions.RequestException) as e:
+			# the retry policy gave up on the request. The next deep scan will retry the task.
+			self.logger.error('failed task %s on "%s": %s', task['type'], task['local_path'], e)
+			self.give_up_task(task)
+		except Exception as e:
+			# e.g., a local I/O or database error, or a malformed task. The task is dropped, not the worker.
+			self.logger.exception('failed task %s on "%s": %s', task['type'], task['local_path'], e)
+			self.give_up_task(task)
 
 	def list_dir(self, path):
 		"""
@@ -468,7 +766,7 @@ class WorkerThread(threading.Thread):
 		"""
 		ent_list = []
 		ent_count = {}
-		entries = os.listdir(path)
+		entries = [ent for ent in os.listdir(path) if not ent.endswith(TaskHandler.PART_FILE_SUFFIX)]
 		if self.config.ignore_list is not None:
 			entries = self.config.ignore_list.filter_list(entries, path)
 		for ent in entries:
@@ -481,7 +779,7 @@ class WorkerThread(threading.Thread):
 					0] + ' (case_conflict_' + str(ent_count[ent_dup]) + ')' + ent_name[1]
 				ent_dup = ent.lower()
 				try:
-					os.rename(path + '/' + ent_old, path + '/' + ent)
+					self.rename(path + '/' + ent_old, path + '/' + ent)
 					ent_list.append(ent)
 					ent_count[ent_dup] = 0
 				except OSError as e:
@@ -492,6 +790,33 @@ class WorkerThread(threading.Thread):
 				ent_count[ent_dup] = 0
 		return ent_list
 
+	def trash(self, local_path):
+		"""
+		Send a local file or dir to trash without the inotify thread taking it for a user change.
+		"""
+		self.echoes.expect(local_path)
+		try:
+			send2trash(local_path)
+		finally:
+			self.echoes.settle(local_path)
+
+	def rename(self, path, new_path):
+		"""
+		Rename a local path without the inotify thread taking it for a user change.
+		"""
+		self.echoes.expect(path, new_path)
+		try:
+			os.rename(path, new_path)
+		finally:
+			self.echoes.settle(path, new_path)
+
+	def get_part_path(self, local_path):
+		"""
+		Return the path of the hidden partial file to download local_path into.
+		"""
+		parent_path, basename = os.path.split(local_path)
+		return parent_path + '/.' + basename + TaskHandler.PART_FILE_SUFFIX
+
 	def resolve_type_conflict(self, path, isdir):
 		if isdir:
 			t = 'dir'
@@ -515,7 +840,7 @@ class WorkerThread(threading.Thread):
 		new_path = name + ' (' + t + ')' + ext
 		if not os.path.exists(new_path):
 			try:
-				os.rename(path, new_path)
+				self.rename(path, new_path)
 				return new_path
 			except OSError as e:
 				self.logger.error(e)
@@ -526,9 +851,252 @@ class WorkerThread(threading.Thread):
 				new_path = name + ' (' + t + ', ' + str(i) + ')' + ext
 				if not os.path.exists(new_path):
 					try:
-						os.rename(path, new_path)
+						self.rename(path, new_path)
 						return new_path
 					except OSError as e:
 						self.logger.error(e)
 						return None
 				i += 1
+
+
+class WorkerThread(TaskHandler, threading.Thread):
+
+	def __init__(self, pool, name, fast_lane=False):
+		"""
+		@param pool: the WorkerPool the worker belongs to.
+		@param fast_lane: only handle metadata tasks, so that small operations
+			never wait behind large transfers.
+		"""
+		super().__init__()
+		self.daemon = True
+		self.name = name
+		self.is_busy = False
+		self.pool = pool
+		self.fast_lane = fast_lane
+
+	def is_released(self):
+		"""
+		Tell if the worker may be retired. Checked while waiting for tasks.
+		"""
+		return self.pool.stopping or (not self.fast_lane and self.pool.num_to_retire > 0)
+
+	def run(self):
+		self.taskmgr = od_sqlite.TaskManager()
+		self.entrymgr = od_sqlite.EntryManager()
+		while True:
+			self.taskmgr.dec_sem(self.fast_lane, self.is_released)
+			if self.pool.claim_retirement(self):
+				break
+			tasks = self.taskmgr.get_tasks(self.config.params['TASK_BATCH_SIZE'], self.fast_lane)
+			if len(tasks) == 0:
+				self.logger.debug('got null task.')
+				continue
+
+			self.is_busy = True
+			if tasks[0]['type'] in od_sqlite.TaskManager.BULK_TASK_TYPES:
+				# transfers are claimed alone
+				num_bytes = self.get_transfer_size(tasks[0])
+			else:
+				num_bytes = None
+			start_time = time.monotonic()
+			# the tasks of the batch are deleted together at the end
+			self.taskmgr.defer_acks = True
+			num_handled = 0
+			try:
+				for task in tasks:
+					self.logger.debug('got task: %s on "%s"', task['type'], task['local_path'])
+					self.handle_task(task)
+					num_handled += 1
+			except Exception as e:
+				# even giving up the task failed
+				self.logger.exception(e)
+			finally:
+				# tasks left claimed would hold their paths and dependents forever. The next deep scan redoes them.
+				for task in tasks[num_handled:]:
+					self.taskmgr.del_task(task['task_id'])
+				self.taskmgr.defer_acks = False
+				self.taskmgr.ack_tasks()
+				self.is_busy = False
+			self.pool.on_tasks_done(len(tasks), time.monotonic() - start_time, num_bytes)
+		self.taskmgr = None
+		self.entrymgr.close()
+		self.logger.debug('stopped.')
+
+
+class WorkerPool(threading.Thread):
+
+	"""
+	Keeps between NUM_OF_WORKERS and MAX_NUM_OF_WORKERS worker threads, of
+	which NUM_OF_FAST_LANE_WORKERS only handle metadata tasks.
+
+	Every WORKER_SCALE_INTERVAL seconds the pool looks at the last interval:
+
+	 * If more than WORKER_MAX_ERROR_RATE of the API calls were throttled or
+	   failed on the server, or the network is down, more requests would only
+	   make it worse, so the pool is halved.
+	 * If more tasks are ready than there are idle workers, the pool grows by
+	   a quarter, unless tasks took WORKER_MAX_LATENCY_RATIO times longer than
+	   usual, which means the server or the disk is already saturated.
+	   Metadata tasks and transfers are timed apart, and a transfer counts
+	   as one task plus one per BITS_BLOCK_SIZE bytes, so that a large file
+	   is not taken for saturation.
+	 * If no task is ready, one idle worker is retired.
+
+	Only workers of the general lane are added or retired. A worker is
+	retired when it next waits for a task, so it never drops one.
+	"""
+
+	logger = od_glob.get_logger()
+	config = od_glob.get_config_instance()
+	api = od_onedrive_api.get_instance()
+
+	def __init__(self):
+		super().__init__()
+		self.name = 'worker_pool'
+		self.daemon = True
+		self.lock = threading.Lock()
+		self.stop_event = threading.Event()
+		self.stopping = False
+		self.taskmgr = od_sqlite.TaskManager()
+		# keep at least one worker for transfers
+		self.num_fast_lane_workers = min(self.config.params['NUM_OF_FAST_LANE_WORKERS'], self.config.params['NUM_OF_WORKERS'] - 1)
+		self.min_workers = self.config.params['NUM_OF_WORKERS'] - self.num_fast_lane_workers
+		self.max_workers = max(self.min_workers, self.config.params['MAX_NUM_OF_WORKERS'] - self.num_fast_lane_workers)
+		self.workers = []
+		self.last_worker_id = 0
+		# number of general workers asked to retire
+		self.num_to_retire = 0
+		# by whether the tasks are transfers: tasks handled and seconds spent on them in the current interval
+		self.num_tasks_done = {False: 0, True: 0}
+		self.task_seconds = {False: 0, True: 0}
+		# usual seconds per task, following slow drifts
+		self.base_latency = {False: None, True: None}
+		self.num_api_successes = 0
+		self.num_api_errors = 0
+
+	def start_worker(self, fast_lane=False):
+		"""
+		Must be called with the lock held.
+		"""
+		self.last_worker_id += 1
+		worker = WorkerThread(self, ('fast_worker' if fast_lane else 'worker') + str(self.last_worker_id), fast_lane)
+		self.workers.append(worker)
+		worker.start()
+
+	def get_general_workers(self):
+		return [w for w in self.workers if not w.fast_lane]
+
+	def claim_retirement(self, worker):
+		"""
+		Called by a worker woken up from waiting for tasks.
+
+		@return True if the worker should exit.
+		"""
+		with self.lock:
+			if not self.stopping:
+				if worker.fast_lane or self.num_to_retire == 0:
+					return False
+				self.num_to_retire -= 1
+			self.workers.remove(worker)
+			self.logger.debug('retired %s.', worker.name)
+			return True
+
+	def on_tasks_done(self, num_tasks, seconds, num_bytes=None):
+		"""
+		@param num_bytes: the size of the transfer, if the task is one.
+		"""
+		is_bulk = num_bytes is not None
+		if is_bulk:
+			num_tasks += num_bytes / self.config.params['BITS_BLOCK_SIZE']
+		with self.lock:
+			self.num_tasks_done[is_bulk] += num_tasks
+			self.task_seconds[is_bulk] += seconds
+
+	def resize(self, num_workers):
+		"""
+		Start or retire general workers so that there will be num_workers of them.
+		"""
+		with self.lock:
+			if self.stopping:
+				return
+			delta = num_workers - (len(self.get_general_workers()) - self.num_to_retire)
+			if delta > 0:
+				# cancel pending retirements first
+				num_cancelled = min(delta, self.num_to_retire)
+				self.num_to_retire -= num_cancelled
+				for i in range(num_cancelled, delta):
+					self.start_worker()
+			elif delta < 0:
+				self.num_to_retire -= delta
+		if delta < 0:
+			self.taskmgr.wake_all()
+		if delta != 0:
+			self.logger.info('resized the worker pool to %d workers.', num_workers + self.num_fast_lane_workers)
+
+	def get_target_size(self):
+		"""
+		Return how many general workers the pool should have, from the
+		statistics of the last interval.
+		"""
+		with self.lock:
+			num_workers = len(self.get_general_workers()) - self.num_to_retire
+			num_idle_workers = len([w for w in self.get_general_workers() if not w.is_busy])
+			num_tasks_done, self.num_tasks_done = self.num_tasks_done, {False: 0, True: 0}
+			task_seconds, self.task_seconds = self.task_seconds, {False: 0, True: 0}
+		policy = self.api.retry_policy
+		num_successes = policy.num_successes - self.num_api_successes
+		num_errors = policy.num_errors - self.num_api_errors
+		self.num_api_successes = policy.num_successes
+		self.num_api_errors = policy.num_errors
+
+		is_saturated = False
+		for is_bulk in (False, True):
+			if num_tasks_done[is_bulk] == 0:
+				continue
+			latency = task_seconds[is_bulk] / num_tasks_done[is_bulk]
+			base_latency = self.base_latency[is_bulk]
+			if base_latency is not None and latency > self.config.params['WORKER_MAX_LATENCY_RATIO'] * base_latency:
+				is_saturated = True
+			if base_latency is None or latency < base_latency:
+				self.base_latency[is_bulk] = latency
+			else:
+				self.base_latency[is_bulk] += (latency - base_latency) * 0.05
+
+		if not self.api.threadman.connected or \
+				num_errors > self.config.params['WORKER_MAX_ERROR_RATE'] * (num_successes + num_errors):
+			return max(self.min_workers, num_workers // 2)
+		num_ready_tasks = self.taskmgr.count_ready_tasks()
+		if num_ready_tasks > num_idle_workers and not is_saturated:
+			return min(self.max_workers, num_workers + max(1, num_workers // 4))
+		if num_ready_tasks == 0 and num_idle_workers > 0:
+			return max(self.min_workers, num_workers - 1)
+		return num_workers
+
+	def stop(self):
+		"""
+		Retire all workers and wait for them to exit.
+		"""
+		with self.lock:
+			self.stopping = True
+			workers = list(self.workers)
+		self.stop_event.set()
+		self.taskmgr.wake_all()
+		# workers waiting for the network give up their tasks
+		self.api.threadman.cancel_waits()
+		for w in workers:
+			self.logger.debug('waiting for thread %s.', w.name)
+			w.join()
+
+	def run(self):
+		with self.lock:
+			if self.stopping:
+				return
+			for i in range(self.num_fast_lane_workers):
+				self.start_worker(fast_lane=True)
+			for i in range(self.min_workers):
+				self.start_worker()
+		self.num_api_successes = self.api.retry_policy.num_successes
+		self.num_api_errors = self.api.retry_policy.num_errors
+		while not self.stop_event.wait(self.config.params['WORKER_SCALE_INTERVAL']):
+			self.resize(self.get_target_size())
+		self.logger.debug('stopped.')
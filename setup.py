@@ -41,7 +41,9 @@ setup(
 		'Topic :: Utilities'],
 	install_requires=[
 		'requests', 'urllib3', 'certifi', 'send2trash', 'daemonocle'],
-	packages=find_packages(),
+	extras_require={
+		'asyncio': ['aiohttp']},
+	packages=find_packages(exclude=['benchmark']),
 	include_package_data=True,
 	package_data={'onedrive_d': ['res/*.png', 'res/*.ini']},
 	# scripts=['daemon/onedrive-daemon','daemon/onedrive-utils'],